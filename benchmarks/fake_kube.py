@@ -0,0 +1,94 @@
+"""
+In-memory stand-in for the parts of the Kubernetes API used by the
+operator outside of kopf: Secret creation and lookup, and status patches
+"""
+import argparse
+import asyncio
+import random
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+
+def merge_patch(target: dict, patch: dict) -> dict:
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class FakeKube:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.objects = {}
+        self.requests = Counter()
+        self.version = 0
+
+    @staticmethod
+    def not_found(path: str) -> web.Response:
+        return web.json_response(
+            {"kind": "Status", "status": "Failure", "reason": "NotFound", "message": path, "code": 404},
+            status=404,
+        )
+
+    def stamp(self, obj: dict) -> dict:
+        self.version += 1
+        meta = obj.setdefault("metadata", {})
+        meta.setdefault("uid", str(uuid.uuid4()))
+        meta["resourceVersion"] = str(self.version)
+        return obj
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path = request.path.rstrip("/")
+        self.requests[request.method] += 1
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if request.method == "GET":
+            obj = self.objects.get(path)
+            return web.json_response(obj) if obj else self.not_found(path)
+        if request.method == "POST":
+            obj = await request.json()
+            key = f"{path}/{obj['metadata']['name']}"
+            if key in self.objects:
+                return web.json_response({"kind": "Status", "reason": "AlreadyExists", "code": 409}, status=409)
+            self.objects[key] = self.stamp(obj)
+            return web.json_response(obj, status=201)
+        if request.method == "PATCH":
+            # Custom resources are created by the benchmark driver without
+            # a round trip, so patches upsert instead of failing with 404
+            obj = self.objects.setdefault(path, {"metadata": {"name": path.rsplit("/", 1)[-1]}})
+            merge_patch(obj, await request.json())
+            return web.json_response(self.stamp(obj))
+        if request.method == "DELETE":
+            return web.json_response({}) if self.objects.pop(path, None) else self.not_found(path)
+        raise web.HTTPMethodNotAllowed(request.method, [])
+
+    async def bench_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": dict(self.requests), "objects": len(self.objects)})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/_bench/stats", self.bench_stats)
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        return app
+
+
+def serve(port: int, latency: float) -> None:
+    web.run_app(FakeKube(latency).app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=6443)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean injected latency in seconds")
+    args = parser.parse_args()
+    serve(args.port, args.latency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""
+In-memory stand-in for the radosgw admin API and the S3 calls issued
+by the operator. Latency and error rate are injected on every request
+"""
+import argparse
+import asyncio
+import random
+import re
+import secrets
+import string
+import uuid
+from collections import Counter, defaultdict
+from xml.etree import ElementTree
+
+from aiohttp import web
+
+CREDENTIAL = re.compile(r"Credential=([^/]+)/")
+
+
+class FakeRGW:
+    def __init__(self, latency: float, jitter: float, error_rate: float, churn: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.churn = churn
+        self.users = {}
+        self.buckets = {}
+        self.key_owners = {}
+        self.owned = defaultdict(set)
+        self.requests = Counter()
+        self.errors = Counter()
+
+    # Helpers
+
+    async def delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    @staticmethod
+    def admin_error(code: str, status: int = 404) -> web.Response:
+        return web.json_response({"Code": code}, status=status)
+
+    @staticmethod
+    def s3_error(code: str, status: int) -> web.Response:
+        body = f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code></Error>"
+        return web.Response(status=status, text=body, content_type="application/xml")
+
+    @staticmethod
+    def new_key(uid: str, access_key: str = None, secret_key: str = None) -> dict:
+        chars = string.ascii_uppercase + string.digits
+        return {
+            "user": uid,
+            "access_key": access_key or "".join(secrets.choice(chars) for _ in range(20)),
+            "secret_key": secret_key or secrets.token_urlsafe(30),
+        }
+
+    def bucket_stats(self, bucket: dict) -> dict:
+        usage = bucket["usage"]["rgw.main"]
+        if self.churn and random.random() < self.churn:
+            usage["num_objects"] += random.randint(1, 100)
+            usage["size_kb"] += random.randint(1, 10000)
+        return {k: v for k, v in bucket.items() if k != "objects"}
+
+    def user_stats(self, uid: str) -> dict:
+        size_kb = objects = 0
+        for name in self.owned[uid]:
+            usage = self.buckets[name]["usage"]["rgw.main"]
+            size_kb += usage["size_kb"]
+            objects += usage["num_objects"]
+        return {"size_kb": size_kb, "size_kb_actual": size_kb, "num_objects": objects}
+
+    # Admin API
+
+    async def admin_user(self, request: web.Request) -> web.Response:
+        q = request.query
+        uid = q.get("uid")
+        if "key" in q:
+            return self.admin_user_key(request.method, q)
+        if "quota" in q:
+            if uid not in self.users:
+                return self.admin_error("NoSuchUser")
+            self.users[uid]["user_quota"] = {
+                "enabled": q.get("enabled") == "true",
+                "max_size_kb": int(q.get("max-size-kb", -1)),
+                "max_objects": int(q.get("max-objects", -1)),
+            }
+            return web.json_response({})
+        if request.method == "GET":
+            if uid not in self.users:
+                return self.admin_error("NoSuchUser")
+            user = dict(self.users[uid])
+            if q.get("stats") == "True":
+                user["stats"] = self.user_stats(uid)
+            return web.json_response(user)
+        if request.method == "PUT":
+            if uid in self.users:
+                return self.admin_error("UserExists", 409)
+            self.users[uid] = {
+                "user_id": uid,
+                "display_name": q.get("display-name", ""),
+                "suspended": int(q.get("suspended") == "True"),
+                "max_buckets": int(q.get("max-buckets", 1000)),
+                "keys": [],
+                "user_quota": {"enabled": False, "max_size_kb": -1, "max_objects": -1},
+            }
+            return web.json_response(self.users[uid])
+        if request.method == "POST":
+            if uid not in self.users:
+                return self.admin_error("NoSuchUser")
+            self.users[uid]["display_name"] = q.get("display-name", "")
+            return web.json_response(self.users[uid])
+        if request.method == "DELETE":
+            user = self.users.pop(uid, None)
+            if user is None:
+                return self.admin_error("NoSuchUser")
+            for key in user["keys"]:
+                self.key_owners.pop(key["access_key"], None)
+            return web.Response(status=200)
+        raise web.HTTPMethodNotAllowed(request.method, [])
+
+    def admin_user_key(self, method: str, q) -> web.Response:
+        if method == "PUT":
+            uid = q.get("uid")
+            if uid not in self.users:
+                return self.admin_error("NoSuchUser")
+            key = self.new_key(uid, q.get("access-key"), q.get("secret-key"))
+            if key["access_key"] in self.key_owners:
+                return self.admin_error("KeyExists", 409)
+            self.users[uid]["keys"].append(key)
+            self.key_owners[key["access_key"]] = uid
+            return web.json_response(self.users[uid]["keys"])
+        if method == "DELETE":
+            uid = self.key_owners.pop(q.get("access-key"), None)
+            if uid is None:
+                return self.admin_error("InvalidAccessKey")
+            self.users[uid]["keys"] = [
+                k for k in self.users[uid]["keys"] if k["access_key"] != q.get("access-key")
+            ]
+            return web.Response(status=200)
+        raise web.HTTPMethodNotAllowed(method, [])
+
+    async def admin_bucket(self, request: web.Request) -> web.Response:
+        q = request.query
+        name = q.get("bucket")
+        if "quota" in q:
+            if name not in self.buckets:
+                return self.admin_error("NoSuchBucket")
+            self.buckets[name]["bucket_quota"] = {
+                "enabled": q.get("enabled") == "true",
+                "max_size_kb": int(q.get("max-size-kb", -1)),
+                "max_objects": int(q.get("max-objects", -1)),
+            }
+            return web.json_response({})
+        if request.method == "GET":
+            stats = q.get("stats") == "True"
+            if name is not None:
+                if name not in self.buckets:
+                    return self.admin_error("NoSuchBucket")
+                return web.json_response(self.bucket_stats(self.buckets[name]))
+            buckets = [
+                b for b in self.buckets.values() if "uid" not in q or b["owner"] == q["uid"]
+            ]
+            if stats:
+                return web.json_response([self.bucket_stats(b) for b in buckets])
+            return web.json_response([b["bucket"] for b in buckets])
+        if request.method == "PUT":
+            if name not in self.buckets:
+                return self.admin_error("NoSuchBucket")
+            self.owned[self.buckets[name]["owner"]].discard(name)
+            self.buckets[name]["owner"] = q.get("uid")
+            self.owned[q.get("uid")].add(name)
+            return web.Response(status=200)
+        if request.method == "DELETE":
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                return self.admin_error("NoSuchBucket")
+            if bucket["objects"] and q.get("purge-objects") != "True":
+                return self.admin_error("BucketNotEmpty", 409)
+            del self.buckets[name]
+            self.owned[bucket["owner"]].discard(name)
+            return web.Response(status=200)
+        raise web.HTTPMethodNotAllowed(request.method, [])
+
+    @staticmethod
+    def metadata_listing(keys, q) -> web.Response:
+        if "max-entries" not in q:
+            return web.json_response(list(keys))
+        keys = sorted(k for k in keys if k > q.get("marker", ""))
+        page = keys[: int(q["max-entries"])]
+        truncated = len(page) < len(keys)
+        return web.json_response(
+            {
+                "keys": page,
+                "truncated": truncated,
+                "count": len(page),
+                "marker": page[-1] if truncated else "",
+            }
+        )
+
+    async def admin_metadata(self, request: web.Request) -> web.Response:
+        kind = request.match_info["kind"]
+        key = request.query.get("key")
+        if kind == "user":
+            if key is None:
+                return self.metadata_listing(self.users, request.query)
+            if key not in self.users:
+                return self.admin_error("NoSuchKey")
+            return web.json_response({"key": key, "data": self.users[key]})
+        if kind == "bucket":
+            if key is None:
+                return self.metadata_listing(self.buckets, request.query)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return self.admin_error("NoSuchKey")
+            return web.json_response(
+                {
+                    "key": key,
+                    "data": {
+                        "owner": bucket["owner"],
+                        "bucket": {"name": key, "bucket_id": bucket["id"]},
+                    },
+                }
+            )
+        return self.admin_error("NoSuchKey")
+
+    # S3 API
+
+    def s3_owner(self, request: web.Request):
+        match = CREDENTIAL.search(request.headers.get("Authorization", ""))
+        return self.key_owners.get(match.group(1)) if match else None
+
+    async def s3_list_buckets(self, request: web.Request) -> web.Response:
+        owner = self.s3_owner(request)
+        if owner is None:
+            return self.s3_error("InvalidAccessKeyId", 403)
+        entries = "".join(
+            f"<Bucket><Name>{name}</Name>"
+            f"<CreationDate>2021-01-01T00:00:00.000Z</CreationDate></Bucket>"
+            for name in sorted(self.owned[owner])
+        )
+        body = (
+            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+            "<ListAllMyBucketsResult><Owner><ID>{0}</ID><DisplayName>{0}</DisplayName></Owner>"
+            "<Buckets>{1}</Buckets></ListAllMyBucketsResult>"
+        ).format(owner, entries)
+        return web.Response(text=body, content_type="application/xml")
+
+    async def s3_bucket(self, request: web.Request) -> web.Response:
+        owner = self.s3_owner(request)
+        if owner is None:
+            return self.s3_error("InvalidAccessKeyId", 403)
+        name = request.match_info["bucket"]
+        await request.read()
+        q = request.query
+        bucket = self.buckets.get(name)
+        if request.method == "PUT" and not q:
+            if bucket is not None and bucket["owner"] != owner:
+                return self.s3_error("BucketAlreadyExists", 409)
+            if bucket is None:
+                self.buckets[name] = {
+                    "bucket": name,
+                    "id": uuid.uuid4().hex,
+                    "owner": owner,
+                    "usage": {"rgw.main": {"size_kb": 0, "size_kb_actual": 0, "num_objects": 0}},
+                    "bucket_quota": {"enabled": False, "max_size_kb": -1, "max_objects": -1},
+                    "objects": {},
+                }
+                self.owned[owner].add(name)
+            return web.Response(status=200)
+        if bucket is None:
+            return self.s3_error("NoSuchBucket", 404)
+        if request.method == "DELETE":
+            del self.buckets[name]
+            self.owned[owner].discard(name)
+            return web.Response(status=204)
+        if request.method == "PUT" and "policy" in q:
+            return web.Response(status=204)
+        if request.method == "PUT" and ("lifecycle" in q or "versioning" in q or "object-lock" in q):
+            return web.Response(status=200)
+        if request.method == "GET" and "versions" in q:
+            return self.s3_list_versions(bucket, q)
+        if request.method == "GET" and "uploads" in q:
+            body = "<ListMultipartUploadsResult><IsTruncated>false</IsTruncated></ListMultipartUploadsResult>"
+            return web.Response(text=body, content_type="application/xml")
+        if request.method == "POST" and "delete" in q:
+            return self.s3_delete_objects(bucket, await request.read())
+        return self.s3_error("NotImplemented", 501)
+
+    def s3_list_versions(self, bucket: dict, q) -> web.Response:
+        keys = sorted(k for k in bucket["objects"] if k > q.get("key-marker", ""))
+        page = keys[: int(q.get("max-keys", 1000))]
+        truncated = len(page) < len(keys)
+        versions = "".join(
+            f"<Version><Key>{key}</Key><VersionId>null</VersionId><IsLatest>true</IsLatest>"
+            f"<Size>{bucket['objects'][key]}</Size></Version>"
+            for key in page
+        )
+        markers = (
+            f"<NextKeyMarker>{page[-1]}</NextKeyMarker><NextVersionIdMarker>null</NextVersionIdMarker>"
+            if truncated
+            else ""
+        )
+        body = (
+            f"<ListVersionsResult><IsTruncated>{str(truncated).lower()}</IsTruncated>"
+            f"{markers}{versions}</ListVersionsResult>"
+        )
+        return web.Response(text=body, content_type="application/xml")
+
+    def s3_delete_objects(self, bucket: dict, body: bytes) -> web.Response:
+        deleted = []
+        for key in ElementTree.fromstring(body).iter():
+            if key.tag.endswith("Key") and bucket["objects"].pop(key.text, None) is not None:
+                deleted.append(key.text)
+        usage = bucket["usage"]["rgw.main"]
+        usage["num_objects"] = len(bucket["objects"])
+        usage["size_kb"] = sum(bucket["objects"].values()) // 1024
+        return web.Response(text="<DeleteResult></DeleteResult>", content_type="application/xml")
+
+    def seed_objects(self, name: str, count: int, size: int) -> None:
+        bucket = self.buckets[name]
+        bucket["objects"].update((f"object-{i:08d}", size) for i in range(count))
+        bucket["usage"]["rgw.main"]["num_objects"] = len(bucket["objects"])
+
+    # Plumbing
+
+    @web.middleware
+    async def inject(self, request: web.Request, handler):
+        if request.path.startswith("/_bench"):
+            return await handler(request)
+        api = "admin" if request.path.startswith("/admin/") else "s3"
+        self.requests[f"{api} {request.method}"] += 1
+        await self.delay()
+        if self.should_fail():
+            self.errors[api] += 1
+            if api == "admin":
+                return self.admin_error("InternalError", 500)
+            return self.s3_error("InternalError", 500)
+        return await handler(request)
+
+    async def bench_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "users": len(self.users),
+                "buckets": len(self.buckets),
+            }
+        )
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.inject], client_max_size=16 * 1024 ** 2)
+        app.router.add_get("/_bench/stats", self.bench_stats)
+        app.router.add_route("*", "/admin/user", self.admin_user)
+        app.router.add_route("*", "/admin/bucket", self.admin_bucket)
+        app.router.add_route("*", "/admin/metadata/{kind}", self.admin_metadata)
+        app.router.add_get("/", self.s3_list_buckets)
+        app.router.add_route("*", "/{bucket}", self.s3_bucket)
+        return app
+
+
+def serve(port: int, latency: float, jitter: float, error_rate: float, churn: float) -> None:
+    rgw = FakeRGW(latency, jitter, error_rate, churn)
+    web.run_app(rgw.app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=7480)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean injected latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Standard deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with 500")
+    parser.add_argument("--churn", type=float, default=0.0, help="Share of buckets changing per stats call")
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.jitter, args.error_rate, args.churn)
+
+
+if __name__ == "__main__":
+    main()
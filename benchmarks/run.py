@@ -0,0 +1,480 @@
+"""
+Load test of the operator handlers against local radosgw, S3 and
+Kubernetes stand-ins. No network access is required.
+
+For every size, a fresh process creates that many User, AccessKey and
+Bucket resources and reconciles them the way kopf would, then runs the
+stats loops for a steady-state period. Reported are time-to-ready
+percentiles, radosgw requests per second, event-loop lag and RSS.
+
+    python benchmarks/run.py --sizes 1000 10000 50000 --latency 0.005 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from queue import Empty
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS), "rgwoperator"))
+sys.path.insert(0, BENCHMARKS)
+
+import fake_kube  # noqa: E402
+import fake_rgw  # noqa: E402
+
+LIFECYCLE = json.dumps({"Rules": [{"Status": "Enabled", "Expiration": {"Days": 31}, "ID": "expire"}]})
+KUBECONFIG = """
+apiVersion: v1
+kind: Config
+clusters:
+- name: bench
+  cluster:
+    server: http://127.0.0.1:{port}
+contexts:
+- name: bench
+  context:
+    cluster: bench
+    user: bench
+current-context: bench
+users:
+- name: bench
+  user:
+    token: bench
+"""
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summary(values) -> dict:
+    return {
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else float("nan"),
+    }
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fetch_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/_bench/stats", timeout=30) as r:
+        return json.load(r)
+
+
+def wait_for(port: int) -> None:
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            fetch_stats(port)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def requests_total(stats: dict, prefix: str = "") -> int:
+    return sum(v for k, v in stats["requests"].items() if k.startswith(prefix))
+
+
+class LagMonitor:
+    """
+    Samples how late the event loop wakes up a sleeping task
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.monotonic() - started - self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> list:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class Harness:
+    """
+    Invokes the operator handlers the way kopf does and maintains the
+    indexes kopf would build from the watch streams
+    """
+
+    def __init__(self, args, kube_port: int):
+        from kopf._core.actions import execution
+        from kopf._core.intents import causes
+
+        self.args = args
+        self.kube_port = kube_port
+        self.execution = execution
+        self.causes = causes
+        self.logger = logging.getLogger("bench")
+        self.indices = {
+            name: defaultdict(list)
+            for name in (
+                "users_by_name",
+                "users_by_rgw_id",
+                "access_keys_by_name",
+                "buckets_by_access_key",
+                "buckets_by_name",
+                "secrets_by_name",
+            )
+        }
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.time_to_ready = defaultdict(list)
+        self.attempts = Counter()
+        self.failures = Counter()
+        self.session = None
+
+    def index(self, name: str, entries: dict) -> None:
+        for key, value in entries.items():
+            self.indices[name][key].append(value)
+
+    async def invoke(self, fn, plural: str, body: dict, patch):
+        import kopf
+
+        cause = self.causes.ResourceCause(
+            logger=self.logger,
+            indices=self.indices,
+            memo=kopf.Memo(),
+            resource=kopf.Resource("s3.hanse-merkur.de", "v1alpha1", plural),
+            patch=patch,
+            body=kopf.Body(body),
+        )
+        token = self.execution.cause_var.set(cause)
+        try:
+            await fn(**cause.kwargs)
+        finally:
+            self.execution.cause_var.reset(token)
+
+    async def reconcile(self, kind: str, fn, body: dict, depends_on=None) -> bool:
+        """
+        Runs the create handler until it succeeds. Temporary errors and
+        unexpected exceptions are retried after --retry-delay seconds
+        """
+        import kopf
+
+        if depends_on is not None and not await depends_on:
+            self.failures[kind] += 1
+            return False
+        started = time.monotonic()
+        body["metadata"]["creationTimestamp"] = (
+            datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        )
+        for _ in range(self.args.max_attempts):
+            self.attempts[kind] += 1
+            patch = kopf.Patch()
+            try:
+                async with self.semaphore:
+                    await self.invoke(fn, kind, body, patch)
+            except kopf.PermanentError as e:
+                self.logger.warning("%s %s failed permanently: %s", kind, body["metadata"]["name"], e)
+                break
+            except Exception as e:
+                self.logger.debug("%s %s will be retried: %s", kind, body["metadata"]["name"], e)
+                # kopf applies the patch of a failed handler as well
+                body.setdefault("status", {}).update(patch.get("status", {}))
+                await asyncio.sleep(self.args.retry_delay)
+            else:
+                body.setdefault("status", {}).update(patch.get("status", {}))
+                self.time_to_ready[kind].append(time.monotonic() - started)
+                return True
+        self.failures[kind] += 1
+        return False
+
+    async def watch_secret(self, namespace: str, name: str) -> None:
+        """
+        Stands in for the Secret watch event the access key handler causes
+        """
+        import cache
+
+        url = f"http://127.0.0.1:{self.kube_port}/api/v1/namespaces/{namespace}/secrets/{name}"
+        async with self.session.get(url) as response:
+            body = await response.json()
+        if cache.is_access_key_secret(body):
+            self.index("secrets_by_name", cache.secrets_by_name(namespace=namespace, name=name, meta=body["metadata"]))
+
+
+def resources(size: int):
+    for i in range(size):
+        namespace = f"bench-{i % 100}"
+        user = {
+            "apiVersion": "s3.hanse-merkur.de/v1alpha1",
+            "kind": "User",
+            "metadata": {"name": f"user-{i}", "uid": f"user-uid-{i}", "annotations": {}},
+            "spec": {
+                "userId": f"user-{i}",
+                "contactName": f"Benchmark user {i}",
+                "quotas": {"enabled": True, "maxBuckets": 10, "maxSize": 1024000, "maxObjects": 1000000},
+            },
+        }
+        access_key = {
+            "apiVersion": "s3.hanse-merkur.de/v1alpha1",
+            "kind": "AccessKey",
+            "metadata": {"name": f"key-{i}", "namespace": namespace, "uid": f"key-uid-{i}"},
+            "spec": {"owner": f"user-{i}", "secretName": f"key-{i}", "description": "benchmark"},
+        }
+        bucket = {
+            "apiVersion": "s3.hanse-merkur.de/v1alpha1",
+            "kind": "Bucket",
+            "metadata": {"name": f"bucket-{i}", "namespace": namespace, "uid": f"bucket-uid-{i}"},
+            "spec": {
+                "bucketName": f"bench-bucket-{i}",
+                "ownerAccessKey": f"key-{i}",
+                "bucketPolicy": "private",
+                "lifeCyclePolicy": LIFECYCLE,
+                "objectLock": False,
+                "objectVersioning": False,
+                "quotas": {"enabled": True, "maxSize": 102400, "maxObjects": 100000},
+            },
+        }
+        yield user, access_key, bucket
+
+
+async def benchmark(size: int, args, rgw_port: int, kube_port: int) -> dict:
+    import aiohttp
+
+    cache = importlib.import_module("cache")
+    utils = importlib.import_module("utils")
+    s3users = importlib.import_module("s3users")
+    s3accesskeys = importlib.import_module("s3accesskeys")
+    s3buckets = importlib.import_module("s3buckets")
+
+    harness = Harness(args, kube_port)
+    harness.session = aiohttp.ClientSession()
+    utils.connect_rgw()
+    lag = LagMonitor()
+    result = {"size": size}
+
+    async def user_flow(user):
+        name = user["metadata"]["name"]
+        if not await harness.reconcile("users", s3users.create_user_on_demand, user):
+            return False
+        harness.index(
+            "users_by_rgw_id",
+            s3users.users_by_rgw_id(name=name, spec=user["spec"], annotations=user["metadata"]["annotations"]),
+        )
+        return True
+
+    async def access_key_flow(access_key, user_ready):
+        meta = access_key["metadata"]
+        if not await harness.reconcile("accesskeys", s3accesskeys.add_access_key, access_key, user_ready):
+            return False
+        await harness.watch_secret(meta["namespace"], access_key["spec"]["secretName"])
+        return True
+
+    async def bucket_flow(bucket, key_ready):
+        meta = bucket["metadata"]
+        if not await harness.reconcile("buckets", s3buckets.add_bucket, bucket, key_ready):
+            return False
+        harness.index(
+            "buckets_by_name",
+            s3buckets.buckets_by_name(namespace=meta["namespace"], name=meta["name"], spec=bucket["spec"]),
+        )
+        return True
+
+    # All resources exist up front, as after applying the manifests at once
+    flows = []
+    for user, access_key, bucket in resources(size):
+        harness.index("users_by_name", cache.users_by_name(name=user["metadata"]["name"], body=user))
+        meta = access_key["metadata"]
+        harness.index(
+            "access_keys_by_name",
+            cache.access_keys_by_name(namespace=meta["namespace"], name=meta["name"], body=access_key),
+        )
+        harness.index(
+            "buckets_by_access_key",
+            cache.buckets_by_access_key(
+                namespace=bucket["metadata"]["namespace"], name=bucket["metadata"]["name"], spec=bucket["spec"]
+            ),
+        )
+        user_ready = asyncio.ensure_future(user_flow(user))
+        key_ready = asyncio.ensure_future(access_key_flow(access_key, user_ready))
+        flows.extend((user_ready, key_ready, bucket_flow(bucket, key_ready)))
+
+    before = fetch_stats(rgw_port)
+    lag.start()
+    started = time.monotonic()
+    await asyncio.gather(*flows)
+    elapsed = time.monotonic() - started
+    create_lag = await lag.stop()
+    after = fetch_stats(rgw_port)
+    result["create"] = {
+        "seconds": elapsed,
+        "time_to_ready": {kind: summary(values) for kind, values in harness.time_to_ready.items()},
+        "attempts": dict(harness.attempts),
+        "failures": dict(harness.failures),
+        "rgw_rps": (requests_total(after) - requests_total(before)) / elapsed,
+        "lag": summary(create_lag),
+        "rss_mb": rss_mb(),
+    }
+
+    rgw_before = fetch_stats(rgw_port)
+    kube_before = fetch_stats(kube_port)
+    lag.start()
+    utils.start_background(
+        s3buckets.run_bucket_stats_collector(harness.indices["buckets_by_name"]), name="bucket-stats"
+    )
+    utils.start_background(
+        s3users.run_user_stats_sweep(harness.indices["users_by_rgw_id"]), name="user-stats"
+    )
+    await asyncio.sleep(args.steady)
+    await utils.stop_background()
+    steady_lag = await lag.stop()
+    rgw_after = fetch_stats(rgw_port)
+    kube_after = fetch_stats(kube_port)
+    result["steady"] = {
+        "seconds": args.steady,
+        "rgw_rps": (requests_total(rgw_after) - requests_total(rgw_before)) / args.steady,
+        "kube_rps": (requests_total(kube_after) - requests_total(kube_before)) / args.steady,
+        "lag": summary(steady_lag),
+        "rss_mb": rss_mb(),
+    }
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    await harness.session.close()
+    await utils.close_rgw()
+    utils.close_kube_api()
+    utils.shutdown_executors()
+    return result
+
+
+def run_size(size: int, args, rgw_port: int, kube_port: int, results) -> None:
+    with tempfile.NamedTemporaryFile("w", suffix=".kubeconfig", delete=False) as f:
+        f.write(KUBECONFIG.format(port=kube_port))
+    os.environ.update(
+        {
+            "KUBECONFIG": f.name,
+            "TENANT": "bench",
+            "OBJ_SERVER": f"127.0.0.1:{rgw_port}",
+            "OBJ_ACCESS_KEY_ID": "bench",
+            "OBJ_SECRET_ACCESS_KEY": "bench",
+            "S3_ENDPOINT_URL": f"http://127.0.0.1:{rgw_port}",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+    )
+    for key, value in (("BUCKET_STATS_INTERVAL", "5"), ("USER_STATS_INTERVAL", "5")):
+        os.environ.setdefault(key, value)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    logging.getLogger("bench").setLevel(logging.DEBUG if args.verbose else logging.ERROR)
+    try:
+        results.put(asyncio.run(benchmark(size, args, rgw_port, kube_port)))
+    finally:
+        os.unlink(f.name)
+
+
+def report(result: dict) -> None:
+    create, steady = result["create"], result["steady"]
+    print(f"== {result['size']} users, access keys and buckets")
+    print(f"   reconciled in {create['seconds']:.1f}s, {create['rgw_rps']:.0f} radosgw requests/s")
+    for kind, ttr in create["time_to_ready"].items():
+        print(
+            f"   {kind:<11} time-to-ready p50 {ttr['p50']:.3f}s  p90 {ttr['p90']:.3f}s  "
+            f"p99 {ttr['p99']:.3f}s  max {ttr['max']:.3f}s  attempts {create['attempts'].get(kind, 0)}  "
+            f"failed {create['failures'].get(kind, 0)}"
+        )
+    for phase, data in (("create", create), ("steady", steady)):
+        lag = data["lag"]
+        print(
+            f"   {phase:<11} loop lag p50 {lag['p50'] * 1000:.1f}ms  p99 {lag['p99'] * 1000:.1f}ms  "
+            f"max {lag['max'] * 1000:.1f}ms  rss {data['rss_mb']:.0f}MB"
+        )
+    print(
+        f"   steady      {steady['rgw_rps']:.1f} radosgw requests/s  "
+        f"{steady['kube_rps']:.1f} kubernetes requests/s"
+    )
+    print(f"   peak rss    {result['peak_rss_mb']:.0f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--latency", type=float, default=0.005, help="Mean radosgw latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.002, help="Standard deviation of the radosgw latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of radosgw requests failing with 500")
+    parser.add_argument("--churn", type=float, default=0.1, help="Share of buckets changing per stats call")
+    parser.add_argument("--kube-latency", type=float, default=0.002, help="Mean Kubernetes API latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=1000, help="Handlers running at the same time")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="Delay before retrying a failed handler")
+    parser.add_argument("--max-attempts", type=int, default=10)
+    parser.add_argument("--steady", type=float, default=60, help="Seconds of steady-state stats collection")
+    parser.add_argument("--rgw-port", type=int, default=17480)
+    parser.add_argument("--kube-port", type=int, default=16443)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for size in args.sizes:
+        servers = [
+            ctx.Process(
+                target=fake_rgw.serve,
+                args=(args.rgw_port, args.latency, args.jitter, args.error_rate, args.churn),
+                daemon=True,
+            ),
+            ctx.Process(target=fake_kube.serve, args=(args.kube_port, args.kube_latency), daemon=True),
+        ]
+        for server in servers:
+            server.start()
+        try:
+            wait_for(args.rgw_port)
+            wait_for(args.kube_port)
+            queue = ctx.Queue()
+            worker = ctx.Process(target=run_size, args=(size, args, args.rgw_port, args.kube_port, queue))
+            worker.start()
+            while True:
+                try:
+                    result = queue.get(timeout=1)
+                    break
+                except Empty:
+                    if not worker.is_alive():
+                        raise RuntimeError(f"Benchmark of {size} resources failed")
+            worker.join()
+        finally:
+            for server in servers:
+                server.terminate()
+                server.join()
+        report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
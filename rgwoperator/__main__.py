@@ -1,10 +1,30 @@
+import argparse
 import asyncio
+import os
+import sys
 
 import kopf
 
+
 def main():
+    parser = argparse.ArgumentParser(prog="rgwoperator")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="Run the operator (default)")
+    import_parser = commands.add_parser(
+        "import", help="Create Users, AccessKeys and Buckets for existing radosgw users and buckets"
+    )
+    # The modules import each other by their top-level names, as under kopf run
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bulkimport
+
+    bulkimport.add_arguments(import_parser)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        bulkimport.main(args)
+        return
     loop = asyncio.get_event_loop()
     loop.run_until_complete(kopf.operator())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
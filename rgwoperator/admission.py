@@ -0,0 +1,297 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from os import getenv
+from typing import Callable, Deque, Dict, Optional
+
+import aiohttp
+import kopf
+from aiorgwadmin.exceptions import InternalError, RGWAdminException, ServerDown
+from botocore.exceptions import ClientError, HTTPClientError
+
+from metrics import ADMISSION_LIMIT, ADMISSION_QUEUED, ADMISSION_REJECTED, CIRCUIT_STATE
+
+rgw_rate_limit = float(getenv("RGW_RATE_LIMIT", "100"))
+rgw_rate_burst = int(getenv("RGW_RATE_BURST", "200"))
+rgw_min_in_flight = int(getenv("RGW_MIN_IN_FLIGHT", "4"))
+rgw_latency_target = float(getenv("RGW_LATENCY_TARGET", "1"))
+s3_rate_limit = float(getenv("S3_RATE_LIMIT", "100"))
+s3_rate_burst = int(getenv("S3_RATE_BURST", "200"))
+circuit_failure_threshold = int(getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+circuit_reset_timeout = float(getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+OVERLOAD_CODES = {"SlowDown", "ServiceUnavailable", "RequestTimeout", "InternalError"}
+
+_admissions: Dict[str, "Admission"] = {}
+
+
+class CircuitOpenError(kopf.TemporaryError):
+    """
+    Raised instead of calling a backend whose circuit breaker is open.
+    Handlers that let it propagate are retried after the jittered delay
+    """
+
+    def __init__(self, backend: str, delay: float):
+        super().__init__(f"Circuit breaker of {backend} is open", delay=delay)
+        self.backend = backend
+
+
+class TokenBucket:
+    """
+    Limits the call rate to `rate` per second with bursts of up to
+    `burst` calls, a rate of 0 disables the limit. Callers reserve a
+    token up front and sleep off any deficit, so waiting callers are
+    served in order
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.waiting = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return
+        self.waiting += 1
+        try:
+            await asyncio.sleep(-self._tokens / self.rate)
+        finally:
+            self.waiting -= 1
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit adjusted AIMD-style: calls finishing within the
+    latency target raise the limit by about one per round trip, slow or
+    overloaded calls cut it by 30% at most once per latency target
+    """
+
+    def __init__(self, minimum: int, maximum: int, latency_target: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._decreased = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just before the cancellation
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def observe(self, latency: float, overloaded: bool) -> None:
+        now = time.monotonic()
+        if overloaded or latency > self.latency_target:
+            if now - self._decreased >= self.latency_target:
+                self._decreased = now
+                self.limit = max(self.minimum, self.limit * 0.7)
+        elif self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failed calls and rejects calls
+    until `reset_timeout` passed. A single probe call then decides
+    whether the circuit closes again or stays open for another timeout
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def retry_delay(self) -> float:
+        """
+        Time until the next probe, spread by up to one reset timeout so
+        rejected handlers do not all return at once
+        """
+        remaining = 0.0
+        if self._opened is not None:
+            remaining = max(0.0, self._opened + self.reset_timeout - time.monotonic())
+        return remaining + random.uniform(0, self.reset_timeout)
+
+    def enter(self) -> bool:
+        """
+        Returns whether the call may proceed, reserving the probe when
+        the circuit is half open
+        """
+        state = self.state
+        if state == "half_open":
+            self._probing = True
+        return state != "open"
+
+    def record(self, failed: Optional[bool]) -> None:
+        """
+        Records the outcome of an admitted call. None for calls that
+        ended without an answer from the backend, such as cancellations
+        """
+        if failed is None:
+            self._probing = False
+        elif failed:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self._opened = time.monotonic()
+            self._probing = False
+        else:
+            self.failures = 0
+            self._opened = None
+            self._probing = False
+
+
+class Admission:
+    """
+    Admission of calls to one backend: circuit breaker, rate limit and
+    adaptive concurrency limit, in that order
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        rate: TokenBucket,
+        limit: AdaptiveLimit,
+        breaker: CircuitBreaker,
+        is_overload: Callable[[BaseException], bool],
+    ):
+        self.backend = backend
+        self.rate = rate
+        self.limit = limit
+        self.breaker = breaker
+        self.is_overload = is_overload
+
+    def reject_if_open(self) -> None:
+        if self.breaker.state == "open":
+            ADMISSION_REJECTED.labels(self.backend).inc()
+            raise CircuitOpenError(self.backend, self.breaker.retry_delay())
+
+    @asynccontextmanager
+    async def slot(self):
+        self.reject_if_open()
+        try:
+            await self.rate.acquire()
+            await self.limit.acquire()
+        finally:
+            self.update_metrics()
+        if not self.breaker.enter():
+            # Opened while this call was queued
+            self.limit.release()
+            ADMISSION_REJECTED.labels(self.backend).inc()
+            raise CircuitOpenError(self.backend, self.breaker.retry_delay())
+
+        started = time.monotonic()
+        failed = None
+        try:
+            yield
+            failed = False
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            failed = self.is_overload(e)
+            raise
+        finally:
+            self.limit.observe(time.monotonic() - started, bool(failed))
+            self.limit.release()
+            self.breaker.record(failed)
+            self.update_metrics()
+
+    def update_metrics(self) -> None:
+        state = self.breaker.state
+        for value in ("closed", "open", "half_open"):
+            CIRCUIT_STATE.labels(self.backend, value).set(int(value == state))
+        ADMISSION_LIMIT.labels(self.backend).set(int(self.limit.limit))
+        ADMISSION_QUEUED.labels(self.backend).set(self.rate.waiting + self.limit.waiting)
+
+
+def is_rgw_overload(e: BaseException) -> bool:
+    if isinstance(e, (ServerDown, InternalError, aiohttp.ClientError, asyncio.TimeoutError)):
+        return True
+    # Unknown error codes are raised as the base exception with the code as message
+    return type(e) is RGWAdminException and str(e) in OVERLOAD_CODES
+
+
+def is_s3_overload(e: BaseException) -> bool:
+    if isinstance(e, (HTTPClientError, asyncio.TimeoutError)):
+        return True
+    if isinstance(e, ClientError):
+        error = e.response.get("Error", {})
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return error.get("Code") in OVERLOAD_CODES or status >= 500
+    return False
+
+
+def configure_admission(backend: str, max_in_flight: int) -> None:
+    """
+    Places an admission layer in front of the backend. The adaptive
+    limit never exceeds `max_in_flight`
+    """
+    if backend == "rgw":
+        rate, burst, minimum, is_overload = (
+            rgw_rate_limit, rgw_rate_burst, rgw_min_in_flight, is_rgw_overload
+        )
+    else:
+        rate, burst, minimum, is_overload = s3_rate_limit, s3_rate_burst, 1, is_s3_overload
+    _admissions[backend] = Admission(
+        backend,
+        TokenBucket(rate, burst),
+        AdaptiveLimit(min(minimum, max_in_flight), max_in_flight, rgw_latency_target),
+        CircuitBreaker(circuit_failure_threshold, circuit_reset_timeout),
+        is_overload,
+    )
+
+
+@asynccontextmanager
+async def admit(backend: str):
+    """
+    Holds an admission slot of the backend for the duration of one call.
+    Backends without admission layer are passed through
+    """
+    admission = _admissions.get(backend)
+    if admission is None:
+        yield
+        return
+    async with admission.slot():
+        yield
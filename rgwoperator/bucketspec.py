@@ -0,0 +1,97 @@
+# Bucket helpers shared by the handler modules. kopf loads every handler
+# module as a script of its own, so importing one from another would load
+# it twice and register its handlers twice. This module registers none
+
+import copy
+import json
+from typing import Optional
+
+import kopf
+
+PUBLIC_POLICY = {
+    "Statement": [
+        {
+            "Action": ["s3:GetObject"],
+            "Effect": "Allow",
+            "Principal": "*",
+            "Resource": [],
+            "Sid": "PublicRead",
+        }
+    ],
+    "Version": "2012-10-17",
+}
+
+
+def desired_bucket_settings(spec) -> dict:
+    """
+    Parses the spec into the desired state of every bucket sub-resource.
+    Sub-resources mapped to None are left untouched
+    """
+    bucket_name = spec["bucketName"]
+    bucket_policy = spec["bucketPolicy"]
+    life_cycle_policy = spec.get("lifeCyclePolicy", None)
+    object_lock_config = spec.get("objectLockConfig", None)
+    quotas = spec.get("quotas", None)
+
+    policy = None
+    if bucket_policy == "public":
+        # Standard public ACL from the AWS documentation.
+        # Allows read-only access to all objects
+        policy = copy.deepcopy(PUBLIC_POLICY)
+        policy["Statement"][0]["Resource"].append(f"arn:aws:s3:::{bucket_name}/*")
+    elif bucket_policy == "custom" and "customBucketPolicy" in spec:
+        try:
+            policy = json.loads(spec["customBucketPolicy"])
+        except json.JSONDecodeError:
+            raise kopf.PermanentError("Failed to parse customBucketPolicy")
+
+    lifecycle = None
+    if life_cycle_policy is not None:
+        try:
+            lifecycle = json.loads(life_cycle_policy)
+            # BUG https://github.com/ceph/ceph/pull/26518
+            for rule in lifecycle["Rules"]:
+                if "Prefix" not in rule:
+                    rule["Prefix"] = ""
+        except json.JSONDecodeError:
+            raise kopf.PermanentError("Failed to parse lifeCyclePolicy")
+
+    object_lock = None
+    if spec.get("objectLock", False) and object_lock_config is not None:
+        try:
+            object_lock = json.loads(object_lock_config)
+            # Ensure the key is present in the object
+            if "ObjectLockEnabled" not in object_lock:
+                object_lock["ObjectLockEnabled"] = "Enabled"
+        except json.JSONDecodeError:
+            raise kopf.PermanentError("Failed to parse objectLockConfig")
+
+    quota = None
+    if quotas and quotas["enabled"]:
+        quota = {"maxSize": quotas["maxSize"], "maxObjects": quotas["maxObjects"]}
+
+    return {
+        "policy": policy,
+        "lifecycle": lifecycle,
+        "objectLock": object_lock,
+        "versioning": "Enabled" if spec.get("objectVersioning", False) else "Suspended",
+        "quota": quota,
+    }
+
+
+def immutable_bucket_changes(old_spec, new_spec) -> Optional[str]:
+    """
+    Returns why an update is not allowed if it changes a field that is
+    fixed once the bucket exists
+    """
+    if old_spec["bucketName"] != new_spec["bucketName"]:
+        return "Cannot change bucket name"
+    if old_spec["ownerAccessKey"] != new_spec["ownerAccessKey"]:
+        return "Cannot change owner"
+    if old_spec.get("objectLock", False) != new_spec.get("objectLock", False):
+        return "Cannot change object locking post-creation"
+    return None
+
+
+def is_bucket_ready(body, **_) -> bool:
+    return body.status.get("ready", False)
@@ -0,0 +1,327 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict, Optional, Tuple
+
+import pykube
+from aiorgwadmin.exceptions import NoSuchBucket, NoSuchUser
+from pykube.exceptions import HTTPError
+
+from s3struct import AccessKey, Bucket, Secret, User
+from utils import (
+    close_kube_api,
+    close_rgw,
+    get_kube_api,
+    get_rgw,
+    run_blocking,
+    shutdown_executors,
+)
+
+tenant = os.getenv("TENANT", "dev")
+
+ANNOTATION_PREFIX = "s3.hanse-merkur.de"
+# Names of Kubernetes objects, see RFC 1123 subdomains
+NAME_PATTERN = re.compile(r"^[a-z0-9]([-a-z0-9.]{0,251}[a-z0-9])?$")
+
+
+class Checkpoint:
+    """
+    Progress of an import, written after every batch so an interrupted
+    import resumes after the last completed batch
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.state = {"phase": "users", "marker": None, "counts": {}}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.state.update(json.load(f))
+
+    def count(self, kind: str, result: str, n: int = 1) -> None:
+        counts = self.state["counts"].setdefault(kind, {})
+        counts[result] = counts.get(result, 0) + n
+
+    def save(self, **changes) -> None:
+        self.state.update(changes)
+        if not self.path:
+            return
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+class Importer:
+    def __init__(self, args, checkpoint: Checkpoint):
+        self.args = args
+        self.checkpoint = checkpoint
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.started = time.monotonic()
+        self.created = 0
+
+    def report(self, phase: str) -> None:
+        elapsed = time.monotonic() - self.started
+        counts = ", ".join(
+            f"{kind} " + "/".join(f"{n} {result}" for result, n in sorted(results.items()))
+            for kind, results in sorted(self.checkpoint.state["counts"].items())
+        )
+        logging.info(
+            "%s: %s, %.1f objects/s",
+            phase,
+            counts or "nothing imported",
+            self.created / elapsed if elapsed else 0.0,
+        )
+
+    async def create(self, kind, obj: dict) -> None:
+        """
+        Creates the resource. Resources that already exist are counted as
+        existing, so a repeated import is harmless
+        """
+        name = obj["metadata"]["name"]
+        if self.args.dry_run:
+            self.checkpoint.count(kind.endpoint, "planned")
+            return
+        async with self.semaphore:
+            try:
+                await run_blocking("kube", kind(get_kube_api(), obj).create)
+            except HTTPError as e:
+                if e.code != 409:
+                    logging.error("Failed to create %s %s: %s", kind.kind, name, e)
+                    self.checkpoint.count(kind.endpoint, "failed")
+                    return
+                self.checkpoint.count(kind.endpoint, "existing")
+                return
+        self.created += 1
+        self.checkpoint.count(kind.endpoint, "created")
+
+    async def fetch_user(self, uid: str) -> Optional[dict]:
+        async with self.semaphore:
+            try:
+                return await get_rgw().get_user(uid=uid)
+            except NoSuchUser:
+                return None
+
+    async def fetch_bucket(self, name: str) -> Optional[dict]:
+        async with self.semaphore:
+            try:
+                return await get_rgw().get_bucket(bucket=name)
+            except NoSuchBucket:
+                return None
+
+
+def user_mapping(uid: str, include_unprefixed: bool) -> Optional[Tuple[str, bool]]:
+    """
+    Maps a radosgw user id onto the userId of its User and whether the
+    skip-tenant annotation is needed
+    """
+    if "$" in uid:
+        # Users of radosgw tenants are not managed by the operator
+        return None
+    if uid.startswith(f"{tenant}-"):
+        return uid[len(tenant) + 1:], False
+    if include_unprefixed:
+        return uid, True
+    return None
+
+
+def user_manifest(user_id: str, skip_tenant: bool, info: dict) -> dict:
+    annotations = {f"{ANNOTATION_PREFIX}/allow-import": "true"}
+    if skip_tenant:
+        annotations[f"{ANNOTATION_PREFIX}/skip-tenant"] = "true"
+    spec = {
+        "userId": user_id,
+        "contactName": info.get("display_name") or user_id,
+        "suspended": bool(info.get("suspended")),
+    }
+    quota = info.get("user_quota") or {}
+    if quota.get("enabled"):
+        spec["quotas"] = {
+            "enabled": True,
+            "maxSize": quota.get("max_size_kb", -1),
+            "maxObjects": quota.get("max_objects", -1),
+            "maxBuckets": info.get("max_buckets", -1),
+        }
+    return {
+        "apiVersion": User.version,
+        "kind": User.kind,
+        "metadata": {"name": user_id, "annotations": annotations},
+        "spec": spec,
+    }
+
+
+def access_key_manifest(namespace: str, secret_name: str, owner: str) -> dict:
+    return {
+        "apiVersion": AccessKey.version,
+        "kind": AccessKey.kind,
+        "metadata": {"name": secret_name, "namespace": namespace},
+        "spec": {
+            "owner": owner,
+            "secretName": secret_name,
+            "description": f"Imported access key of {owner}",
+        },
+    }
+
+
+def bucket_manifest(namespace: str, access_key: str, bucket: dict) -> dict:
+    spec = {"bucketName": bucket["bucket"], "ownerAccessKey": access_key, "bucketPolicy": "private"}
+    quota = bucket.get("bucket_quota") or {}
+    if quota.get("enabled"):
+        spec["quotas"] = {
+            "enabled": True,
+            "maxSize": quota.get("max_size_kb", -1),
+            "maxObjects": quota.get("max_objects", -1),
+        }
+    return {
+        "apiVersion": Bucket.version,
+        "kind": Bucket.kind,
+        "metadata": {
+            "name": bucket["bucket"],
+            "namespace": namespace,
+            "annotations": {f"{ANNOTATION_PREFIX}/allow-import": "true"},
+        },
+        "spec": spec,
+    }
+
+
+def list_key_secrets(namespace) -> Dict[str, Tuple[str, str]]:
+    """
+    Maps the access key ids of existing credential Secrets to the Secret
+    """
+    secrets = {}
+    for secret in Secret.objects(get_kube_api(), namespace=namespace):
+        access_key_id = secret.get_secret("aws_access_key_id") if secret.obj.get("data") else None
+        if access_key_id:
+            secrets[access_key_id] = (secret.namespace, secret.name)
+    return secrets
+
+
+def list_access_keys() -> Dict[str, Tuple[str, str]]:
+    """
+    Maps User names to one of their AccessKeys, imported or not
+    """
+    keys = {}
+    for access_key in AccessKey.objects(get_kube_api(), namespace=pykube.all):
+        keys.setdefault(access_key.obj["spec"]["owner"], (access_key.namespace, access_key.name))
+    return keys
+
+
+async def import_users(importer: Importer, secrets: Dict[str, Tuple[str, str]]) -> None:
+    """
+    Pages through the user metadata listing and creates a User per user,
+    and an AccessKey for each of its keys held by an existing Secret
+    """
+    args, checkpoint = importer.args, importer.checkpoint
+    rgw = get_rgw()
+    marker = checkpoint.state["marker"]
+    while True:
+        page = await rgw.get_metadata("user", max_entries=args.batch_size, marker=marker)
+        mapped = {}
+        for uid in page["keys"]:
+            mapping = user_mapping(uid, args.include_unprefixed)
+            if mapping is None or not NAME_PATTERN.match(mapping[0]):
+                checkpoint.count("users", "ignored")
+                continue
+            mapped[uid] = mapping
+        infos = await asyncio.gather(*(importer.fetch_user(uid) for uid in mapped))
+        creates = []
+        for (uid, (user_id, skip_tenant)), info in zip(mapped.items(), infos):
+            if info is None:
+                continue
+            creates.append(importer.create(User, user_manifest(user_id, skip_tenant, info)))
+            for key in info.get("keys", []):
+                if key["access_key"] in secrets:
+                    namespace, name = secrets[key["access_key"]]
+                    creates.append(
+                        importer.create(AccessKey, access_key_manifest(namespace, name, user_id))
+                    )
+        await asyncio.gather(*creates)
+        marker = page.get("marker") if page.get("truncated") else None
+        if marker is None:
+            checkpoint.save(phase="buckets", marker=None)
+            return
+        checkpoint.save(marker=marker)
+        importer.report("users")
+
+
+async def import_buckets(importer: Importer) -> None:
+    """
+    Pages through the bucket metadata listing and creates a Bucket per
+    bucket of an imported user in the namespace of an AccessKey of that user
+    """
+    args, checkpoint = importer.args, importer.checkpoint
+    access_keys = await run_blocking("kube", list_access_keys)
+    rgw = get_rgw()
+    marker = checkpoint.state["marker"]
+    while True:
+        page = await rgw.get_metadata("bucket", max_entries=args.batch_size, marker=marker)
+        names = []
+        for name in page["keys"]:
+            if not NAME_PATTERN.match(name):
+                checkpoint.count("buckets", "ignored")
+                continue
+            names.append(name)
+        infos = await asyncio.gather(*(importer.fetch_bucket(name) for name in names))
+        creates = []
+        for bucket in infos:
+            if bucket is None:
+                continue
+            mapping = user_mapping(bucket.get("owner", ""), args.include_unprefixed)
+            access_key = access_keys.get(mapping[0]) if mapping else None
+            if access_key is None:
+                checkpoint.count("buckets", "ignored")
+                continue
+            creates.append(importer.create(Bucket, bucket_manifest(*access_key, bucket)))
+        await asyncio.gather(*creates)
+        marker = page.get("marker") if page.get("truncated") else None
+        if marker is None:
+            checkpoint.save(phase="done", marker=None)
+            return
+        checkpoint.save(marker=marker)
+        importer.report("buckets")
+
+
+async def run_import(args) -> None:
+    # A dry run leaves the checkpoint of a real import untouched
+    checkpoint = Checkpoint(None if args.dry_run else args.checkpoint)
+    importer = Importer(args, checkpoint)
+    if checkpoint.state["phase"] == "done":
+        logging.info("Import already completed according to %s", args.checkpoint)
+        return
+    try:
+        if checkpoint.state["phase"] == "users":
+            secrets = await run_blocking("kube", list_key_secrets, args.namespace or pykube.all)
+            await import_users(importer, secrets)
+        if checkpoint.state["phase"] == "buckets":
+            await import_buckets(importer)
+    finally:
+        importer.report("import finished" if checkpoint.state["phase"] == "done" else "import stopped")
+        await close_rgw()
+        close_kube_api()
+        shutdown_executors()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--checkpoint", help="File recording the progress, an existing file resumes the import"
+    )
+    parser.add_argument("--batch-size", type=int, default=100, help="Users or buckets per batch")
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Concurrent radosgw and Kubernetes calls"
+    )
+    parser.add_argument("--namespace", help="Only look for credential Secrets in this namespace")
+    parser.add_argument(
+        "--include-unprefixed",
+        action="store_true",
+        help="Also import users without the tenant prefix, annotated with skip-tenant",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Count the resources without creating them"
+    )
+
+
+def main(args) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(run_import(args))
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from os import getenv
+from typing import Optional, Tuple
+
+import kopf
+from pykube.exceptions import ObjectDoesNotExist
+
+from metrics import CACHE_LAST_EVENT, CACHE_LOOKUPS
+from s3struct import AccessKey, Secret, User
+from utils import get_kube_api, is_annotation_set, run_blocking
+
+secret_cache_size = int(getenv("SECRET_CACHE_SIZE", "256"))
+
+# (namespace, name) -> (resourceVersion, Secret) of recently read Secrets
+_secrets: "OrderedDict[Tuple[str, str], Tuple[str, dict]]" = OrderedDict()
+
+
+def _reference(body) -> dict:
+    """
+    Keeps only the fields required to resolve references between resources
+    """
+    return {
+        "apiVersion": body["apiVersion"],
+        "kind": body["kind"],
+        "metadata": {
+            "name": body["metadata"]["name"],
+            "namespace": body["metadata"].get("namespace"),
+            "uid": body["metadata"]["uid"],
+            "annotations": dict(body["metadata"].get("annotations", {})),
+        },
+        "spec": dict(body.get("spec", {})),
+    }
+
+
+@kopf.index("s3.hanse-merkur.de", "v1alpha1", "user")
+def users_by_name(name, body, **_):
+    CACHE_LAST_EVENT.labels("users").set_to_current_time()
+    return {name: _reference(body)}
+
+
+@kopf.index("s3.hanse-merkur.de", "v1alpha1", "accesskeys")
+def access_keys_by_name(namespace, name, body, **_):
+    CACHE_LAST_EVENT.labels("accesskeys").set_to_current_time()
+    return {(namespace, name): _reference(body)}
+
+
+@kopf.index("s3.hanse-merkur.de", "v1alpha1", "buckets")
+def buckets_by_access_key(namespace, name, spec, **_):
+    CACHE_LAST_EVENT.labels("buckets").set_to_current_time()
+    return {(namespace, spec["ownerAccessKey"]): name}
+
+
+def is_access_key_secret(body, **_) -> bool:
+    return "aws_access_key_id" in (body.get("data") or {})
+
+
+@kopf.index("", "v1", "secrets", when=is_access_key_secret)
+def secrets_by_name(namespace, name, meta, **_):
+    """
+    Keeps only the resourceVersion, the secret material is not indexed
+    """
+    CACHE_LAST_EVENT.labels("secrets").set_to_current_time()
+    return {(namespace, name): meta.get("resourceVersion")}
+
+
+async def _lookup(index: kopf.Index, key, kind: str, query, name: str) -> Optional[dict]:
+    """
+    Resolves a reference from the watch-backed index.
+    Falls back to the API server for objects not seen yet
+    """
+    store = index.get(key)
+    if store:
+        CACHE_LOOKUPS.labels(kind, "hit").inc()
+        return next(iter(store))
+    CACHE_LOOKUPS.labels(kind, "miss").inc()
+    try:
+        return (await run_blocking("kube", query.get_by_name, name)).obj
+    except ObjectDoesNotExist:
+        return None
+
+
+async def get_user(users_by_name: kopf.Index, name: str) -> Optional[dict]:
+    return await _lookup(
+        users_by_name, name, "users", User.objects(get_kube_api()), name
+    )
+
+
+async def get_access_key(access_keys_by_name: kopf.Index, namespace: str, name: str) -> Optional[dict]:
+    return await _lookup(
+        access_keys_by_name,
+        (namespace, name),
+        "accesskeys",
+        AccessKey.objects(get_kube_api(), namespace=namespace),
+        name,
+    )
+
+
+async def get_secret(secrets_by_name: kopf.Index, namespace: str, name: str) -> Optional[Secret]:
+    """
+    Returns the Secret from a bounded LRU of recently read Secrets while
+    its resourceVersion matches the index, otherwise from the API server
+    """
+    key = (namespace, name)
+    store = secrets_by_name.get(key)
+    version = next(iter(store)) if store else None
+    cached = _secrets.get(key)
+    if version is not None and cached is not None and cached[0] == version:
+        _secrets.move_to_end(key)
+        CACHE_LOOKUPS.labels("secrets", "hit").inc()
+        return Secret(get_kube_api(), {**cached[1], "data": dict(cached[1]["data"])})
+    CACHE_LOOKUPS.labels("secrets", "miss").inc()
+    try:
+        secret = await run_blocking(
+            "kube", Secret.objects(get_kube_api(), namespace=namespace).get_by_name, name
+        )
+    except ObjectDoesNotExist:
+        _secrets.pop(key, None)
+        return None
+    metadata = secret.obj["metadata"]
+    obj = {
+        "metadata": {"name": name, "namespace": namespace},
+        "data": dict(secret.obj.get("data") or {}),
+    }
+    if is_access_key_secret(obj):
+        _secrets[key] = (metadata.get("resourceVersion"), obj)
+        _secrets.move_to_end(key)
+        while len(_secrets) > secret_cache_size:
+            _secrets.popitem(last=False)
+    return Secret(get_kube_api(), {**obj, "data": dict(obj["data"])})
+
+
+def get_rgw_user_id(user: dict, tenant: str) -> str:
+    if is_annotation_set(user["metadata"].get("annotations", {}), "skip-tenant"):
+        return user["spec"]["userId"]
+    return f"{tenant}-{user['spec']['userId']}"
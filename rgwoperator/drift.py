@@ -0,0 +1,377 @@
+import asyncio
+import bisect
+import logging
+from collections import Counter, defaultdict
+from os import getenv
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import kopf
+from aiorgwadmin.exceptions import NoSuchBucket, NoSuchUser
+
+from bucketspec import is_bucket_ready
+from cache import get_rgw_user_id
+from metrics import DRIFT, DRIFT_LAST_PASS, instrument_handler
+from sharding import owns_shard
+from utils import get_rgw, start_background
+from warmup import list_rgw_metadata
+
+tenant = getenv("TENANT", "dev")
+drift_interval = int(getenv("DRIFT_INTERVAL", "600"))
+drift_page_size = int(getenv("DRIFT_PAGE_SIZE", "1000"))
+drift_concurrency = int(getenv("DRIFT_CONCURRENCY", "8"))
+drift_user_batch = int(getenv("DRIFT_USER_BATCH", "1000"))
+drift_bucket_batch = int(getenv("DRIFT_BUCKET_BATCH", "1000"))
+
+KINDS = ("user", "key", "bucket")
+TYPES = ("missing", "orphaned", "owner_mismatch", "quota_mismatch")
+
+# Findings of the previous pass, so only new drift is announced
+_reported: Set[Tuple[str, str, str]] = set()
+# Keys and quota of managed users, refreshed in batches
+_user_info: Dict[str, dict] = {}
+_user_cursor = ""
+# Owner and quota of buckets, refreshed in batches
+_bucket_info: Dict[str, dict] = {}
+_bucket_cursor = ""
+
+
+class Finding(NamedTuple):
+    kind: str
+    type: str
+    name: str
+    message: str
+    # Resource the finding is reported on, if any
+    ref: Optional[dict] = None
+
+
+def _reference(body) -> dict:
+    return {
+        "apiVersion": body["apiVersion"],
+        "kind": body["kind"],
+        "metadata": {
+            "name": body["metadata"]["name"],
+            "namespace": body["metadata"].get("namespace"),
+            "uid": body["metadata"]["uid"],
+        },
+    }
+
+
+@kopf.index("s3.hanse-merkur.de", "v1alpha1", "buckets", when=is_bucket_ready)
+def buckets_for_drift(namespace, spec, body, **_):
+    return {
+        spec["bucketName"]: {
+            "ref": _reference(body),
+            "accessKey": (namespace, spec["ownerAccessKey"]),
+            "quotas": dict(spec.get("quotas") or {}),
+        }
+    }
+
+
+def quota_mismatch(quotas: dict, actual: Optional[dict]) -> Optional[str]:
+    """
+    Compares an enabled quota of a spec with the radosgw quota
+    """
+    if not quotas.get("enabled"):
+        return None
+    actual = actual or {}
+    if not actual.get("enabled"):
+        return "quota is disabled in radosgw"
+    for field, key in (("maxSize", "max_size_kb"), ("maxObjects", "max_objects")):
+        if field in quotas and quotas[field] != actual.get(key):
+            return f"{field} is {actual.get(key)} in radosgw, expected {quotas[field]}"
+    return None
+
+
+def detect_drift(
+    rgw_users: Iterable[str],
+    rgw_user_info: Dict[str, dict],
+    rgw_buckets: Iterable[str],
+    rgw_bucket_info: Dict[str, dict],
+    users: Dict[str, dict],
+    access_keys: Dict[Tuple[str, str], dict],
+    access_key_refs: Dict[Tuple[str, str], dict],
+    buckets: Dict[str, dict],
+) -> List[Finding]:
+    """
+    Joins the radosgw listings with the cached resources through dicts
+    keyed by radosgw user id, access key id and bucket name. Keys, owners
+    and quotas are only compared once their info was fetched.
+
+    users maps User names to their reference, access_keys maps ready
+    AccessKeys to their spec and status and buckets maps bucket names of
+    ready Buckets to their owner AccessKey and quotas
+    """
+    findings = []
+    rgw_users = set(rgw_users)
+    uids = {name: get_rgw_user_id(user, tenant) for name, user in users.items()}
+    managed = {uid: name for name, uid in uids.items()}
+
+    for uid, name in managed.items():
+        user = users[name]
+        if uid not in rgw_users:
+            message = f"User {uid} does not exist in radosgw"
+            findings.append(Finding("user", "missing", uid, message, user))
+            continue
+        info = rgw_user_info.get(uid)
+        if info is None:
+            continue
+        quotas = user["spec"].get("quotas") or {}
+        mismatch = quota_mismatch(quotas, info.get("user_quota"))
+        if mismatch is None and quotas.get("enabled") and "maxBuckets" in quotas:
+            actual = info.get("max_buckets")
+            if actual != quotas["maxBuckets"]:
+                mismatch = f"maxBuckets is {actual} in radosgw, expected {quotas['maxBuckets']}"
+        if mismatch:
+            findings.append(Finding("user", "quota_mismatch", uid, f"User {uid}: {mismatch}", user))
+    for uid in rgw_users:
+        if uid.startswith(f"{tenant}-") and uid not in managed:
+            findings.append(Finding("user", "orphaned", uid, f"User {uid} has no User resource"))
+
+    # Keys are only compared for users whose info was fetched once
+    expected_keys: Dict[str, Set[str]] = defaultdict(set)
+    for key, entry in access_keys.items():
+        uid = uids.get(entry["spec"]["owner"])
+        if uid not in rgw_user_info:
+            continue
+        status = entry["status"]
+        previous = (status.get("rotation") or {}).get("previousAccessKeyId")
+        expected_keys[uid].update(filter(None, (status.get("accessKeyId"), previous)))
+        actual = {k["access_key"] for k in rgw_user_info[uid].get("keys", [])}
+        if status.get("accessKeyId") and status["accessKeyId"] not in actual:
+            findings.append(
+                Finding(
+                    "key",
+                    "missing",
+                    status["accessKeyId"],
+                    f"Access key {status['accessKeyId']} of AccessKey {key[0]}/{key[1]} "
+                    f"does not exist for user {uid}",
+                    access_key_refs.get(key),
+                )
+            )
+    for uid, info in rgw_user_info.items():
+        for k in info.get("keys", []):
+            if k["access_key"] not in expected_keys[uid]:
+                findings.append(
+                    Finding(
+                        "key",
+                        "orphaned",
+                        k["access_key"],
+                        f"Access key {k['access_key']} of user {uid} has no AccessKey resource",
+                        users.get(managed.get(uid)),
+                    )
+                )
+
+    rgw_buckets = set(rgw_buckets)
+    for name in rgw_buckets:
+        bucket = rgw_bucket_info.get(name)
+        if bucket is None:
+            continue
+        owner = bucket["owner"]
+        entry = buckets.get(name)
+        if entry is None:
+            if owner in managed or owner.startswith(f"{tenant}-"):
+                message = f"Bucket {name} of {owner} has no Bucket resource"
+                findings.append(Finding("bucket", "orphaned", name, message))
+            continue
+        access_key = access_key_refs.get(entry["accessKey"])
+        expected = uids.get(access_key["spec"]["owner"]) if access_key else None
+        if expected is not None and owner != expected:
+            findings.append(
+                Finding(
+                    "bucket",
+                    "owner_mismatch",
+                    name,
+                    f"Bucket {name} is owned by {owner or 'nobody'}, expected {expected}",
+                    entry["ref"],
+                )
+            )
+        mismatch = quota_mismatch(entry["quotas"], bucket.get("bucket_quota"))
+        if mismatch:
+            message = f"Bucket {name}: {mismatch}"
+            findings.append(Finding("bucket", "quota_mismatch", name, message, entry["ref"]))
+    for name in buckets.keys() - rgw_buckets:
+        message = f"Bucket {name} does not exist in radosgw"
+        findings.append(Finding("bucket", "missing", name, message, buckets[name]["ref"]))
+    return findings
+
+
+def publish_drift(findings: List[Finding]) -> None:
+    """
+    Exports the counts of all findings and announces new findings as
+    events on their resource. Orphans have no resource and are logged
+    """
+    global _reported
+    counts = Counter((f.kind, f.type) for f in findings)
+    for kind in KINDS:
+        for type_ in TYPES:
+            DRIFT.labels(kind, type_).set(counts[kind, type_])
+    DRIFT_LAST_PASS.set_to_current_time()
+
+    current = {(f.kind, f.type, f.name) for f in findings}
+    new = [f for f in findings if (f.kind, f.type, f.name) not in _reported]
+    _reported = current
+    orphans = []
+    for finding in new:
+        if finding.ref is not None:
+            kopf.warn(finding.ref, reason="Drift", message=finding.message)
+        if finding.type == "orphaned":
+            orphans.append(finding.message)
+    if orphans:
+        logging.warning(
+            "Drift detection found %d new orphans: %s%s",
+            len(orphans),
+            "; ".join(orphans[:20]),
+            f"; ... {len(orphans) - 20} more" if len(orphans) > 20 else "",
+        )
+
+
+def trim_user_info(info: dict) -> dict:
+    """
+    Keeps the fields compared by the drift detection, without secrets
+    """
+    return {
+        "keys": [{"access_key": key["access_key"]} for key in info.get("keys", [])],
+        "user_quota": info.get("user_quota"),
+        "max_buckets": info.get("max_buckets"),
+    }
+
+
+def trim_bucket_info(info: dict) -> dict:
+    """
+    Keeps the fields compared by the drift detection, without usage
+    """
+    return {"owner": info.get("owner", ""), "bucket_quota": info.get("bucket_quota")}
+
+
+def next_batch(keys: Set[str], cursor: str, size: int) -> List[str]:
+    """
+    Returns the next `size` keys after the cursor in key order, wrapping around
+    """
+    ordered = sorted(keys)
+    start = bisect.bisect_right(ordered, cursor)
+    return (ordered[start:] + ordered[:start])[:size]
+
+
+def _first(index: kopf.Index) -> dict:
+    return {key: next(iter(store)) for key, store in index.items() if store}
+
+
+@instrument_handler("drift", "timer")
+async def detect_drift_pass(
+    users_by_name: kopf.Index,
+    users_by_rgw_id: kopf.Index,
+    access_keys_by_name: kopf.Index,
+    access_keys_for_rotation: kopf.Index,
+    buckets_for_drift: kopf.Index,
+) -> List[Finding]:
+    """
+    Pages through the user and bucket names, then refreshes the keys and
+    quota of up to DRIFT_USER_BATCH managed users and the owner and quota
+    of up to DRIFT_BUCKET_BATCH buckets. A pass costs one call per page
+    and at most one call per refreshed user or bucket, and never holds
+    the usage of all buckets. The others are compared with the info of
+    an earlier pass, so a new orphan or mismatch may take a few passes
+    to be found
+    """
+    global _user_cursor, _bucket_cursor
+    rgw = get_rgw()
+    ready = {name for names in users_by_rgw_id.values() for name in names}
+    users = {name: next(iter(users_by_name[name])) for name in ready if users_by_name.get(name)}
+    access_keys = _first(access_keys_for_rotation)
+    access_key_refs = _first(access_keys_by_name)
+    buckets = _first(buckets_for_drift)
+
+    rgw_users, rgw_buckets = await asyncio.gather(
+        list_rgw_metadata(rgw, "user", drift_page_size),
+        list_rgw_metadata(rgw, "bucket", drift_page_size),
+    )
+    rgw_user_set, rgw_bucket_set = set(rgw_users), set(rgw_buckets)
+    semaphore = asyncio.Semaphore(drift_concurrency)
+
+    async def fetch_user(uid):
+        async with semaphore:
+            try:
+                return uid, await rgw.get_user(uid=uid)
+            except NoSuchUser:
+                return uid, None
+
+    async def fetch_bucket(name):
+        async with semaphore:
+            try:
+                return name, await rgw.get_bucket(bucket=name)
+            except NoSuchBucket:
+                return name, None
+
+    managed = {get_rgw_user_id(user, tenant) for user in users.values()} & rgw_user_set
+    for uid in _user_info.keys() - managed:
+        del _user_info[uid]
+    for name in _bucket_info.keys() - rgw_bucket_set:
+        del _bucket_info[name]
+    user_batch = next_batch(managed, _user_cursor, drift_user_batch)
+    bucket_batch = next_batch(rgw_bucket_set, _bucket_cursor, drift_bucket_batch)
+    user_infos, bucket_infos = await asyncio.gather(
+        asyncio.gather(*(fetch_user(uid) for uid in user_batch)),
+        asyncio.gather(*(fetch_bucket(name) for name in bucket_batch)),
+    )
+    if user_batch:
+        _user_cursor = user_batch[-1]
+    if bucket_batch:
+        _bucket_cursor = bucket_batch[-1]
+    for uid, info in user_infos:
+        if info is None:
+            _user_info.pop(uid, None)
+        else:
+            _user_info[uid] = trim_user_info(info)
+    for name, info in bucket_infos:
+        if info is None:
+            _bucket_info.pop(name, None)
+        else:
+            _bucket_info[name] = trim_bucket_info(info)
+
+    findings = detect_drift(
+        rgw_user_set,
+        _user_info,
+        rgw_bucket_set,
+        _bucket_info,
+        users,
+        access_keys,
+        access_key_refs,
+        buckets,
+    )
+    publish_drift(findings)
+    return findings
+
+
+async def run_drift_detection(**indexes):
+    while True:
+        await asyncio.sleep(drift_interval)
+        # The whole installation is compared, by a single replica
+        if not owns_shard(0):
+            continue
+        try:
+            await detect_drift_pass(**indexes)
+        except Exception:
+            logging.exception("Failed to detect drift")
+
+
+@kopf.on.startup()
+async def start_drift_detection(
+    users_by_name: kopf.Index,
+    users_by_rgw_id: kopf.Index,
+    access_keys_by_name: kopf.Index,
+    access_keys_for_rotation: kopf.Index,
+    buckets_for_drift: kopf.Index,
+    **_,
+):
+    if drift_interval <= 0:
+        return
+    start_background(
+        run_drift_detection(
+            users_by_name=users_by_name,
+            users_by_rgw_id=users_by_rgw_id,
+            access_keys_by_name=access_keys_by_name,
+            access_keys_for_rotation=access_keys_for_rotation,
+            buckets_for_drift=buckets_for_drift,
+        ),
+        name="drift-detection",
+    )
@@ -0,0 +1,119 @@
+from os import getenv
+from typing import Dict, Hashable, Iterable, NamedTuple, Optional
+
+from prometheus_client.core import REGISTRY, GaugeMetricFamily
+
+stats_exporter = getenv("STATS_EXPORTER", "false").lower() == "true"
+
+
+class Usage(NamedTuple):
+    namespace: str
+    name: str
+    uid: str
+    size_kb: int
+    objects: int
+    max_size_kb: int
+    max_objects: int
+
+
+def usage_from_quota(
+    namespace: str, name: str, uid: str, size_kb: int, objects: int, quota: Optional[dict]
+) -> Usage:
+    """
+    Quota limits are stored as -1 when the quota is disabled
+    """
+    if quota and quota.get("enabled"):
+        max_size_kb = quota.get("max_size_kb", -1)
+        max_objects = quota.get("max_objects", -1)
+    else:
+        max_size_kb = max_objects = -1
+    return Usage(namespace, name, uid, size_kb, objects, max_size_kb, max_objects)
+
+
+class StatsSnapshot:
+    """
+    Latest usage of every bucket or user, kept as one tuple per resource
+    so memory stays proportional to the number of resources. Nothing is
+    recorded while the exporter is disabled
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._usage: Dict[Hashable, Usage] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return stats_exporter
+
+    def update(self, key: Hashable, usage: Usage) -> None:
+        if self.enabled:
+            self._usage[key] = usage
+
+    def retain(self, keys: Iterable[Hashable]) -> None:
+        if not self.enabled:
+            return
+        keys = set(keys)
+        for key in self._usage.keys() - keys:
+            del self._usage[key]
+
+    def values(self) -> Iterable[Usage]:
+        return list(self._usage.values())
+
+
+bucket_snapshot = StatsSnapshot("bucket")
+user_snapshot = StatsSnapshot("user")
+
+
+class StatsCollector:
+    """
+    Builds the usage metrics from the snapshots at scrape time instead of
+    keeping a labelled gauge child per resource
+    """
+
+    def __init__(self, *snapshots: StatsSnapshot):
+        self.snapshots = snapshots
+
+    def collect(self):
+        labels = ["namespace", "name", "uid"]
+        for snapshot in self.snapshots:
+            prefix = f"rgwoperator_{snapshot.kind}"
+            size = GaugeMetricFamily(
+                f"{prefix}_size_bytes", f"Size of the {snapshot.kind}", labels=labels
+            )
+            objects = GaugeMetricFamily(
+                f"{prefix}_objects", f"Number of objects of the {snapshot.kind}", labels=labels
+            )
+            max_size = GaugeMetricFamily(
+                f"{prefix}_quota_size_bytes", f"Size quota of the {snapshot.kind}", labels=labels
+            )
+            max_objects = GaugeMetricFamily(
+                f"{prefix}_quota_objects", f"Object quota of the {snapshot.kind}", labels=labels
+            )
+            utilisation = GaugeMetricFamily(
+                f"{prefix}_quota_utilisation_ratio",
+                f"Highest utilisation of the size and object quota of the {snapshot.kind}",
+                labels=labels,
+            )
+            for usage in snapshot.values():
+                values = [usage.namespace, usage.name, usage.uid]
+                size.add_metric(values, usage.size_kb * 1024)
+                objects.add_metric(values, usage.objects)
+                ratios = []
+                if usage.max_size_kb > 0:
+                    max_size.add_metric(values, usage.max_size_kb * 1024)
+                    ratios.append(usage.size_kb / usage.max_size_kb)
+                if usage.max_objects > 0:
+                    max_objects.add_metric(values, usage.max_objects)
+                    ratios.append(usage.objects / usage.max_objects)
+                if ratios:
+                    utilisation.add_metric(values, max(ratios))
+            yield from (size, objects, max_size, max_objects, utilisation)
+
+    def describe(self):
+        # Avoids a collect() call on registration
+        return []
+
+
+def register_exporter() -> None:
+    if stats_exporter:
+        REGISTRY.register(StatsCollector(bucket_snapshot, user_snapshot))
@@ -0,0 +1,270 @@
+import functools
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, ContextManager, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from profiling import span, trace
+
+# Context managers entered around every instrumented handler run
+_handler_hooks: List[Callable[[Optional[str], Optional[str]], ContextManager]] = []
+
+HANDLER_DURATION = Histogram(
+    "rgwoperator_handler_seconds",
+    "Duration of kopf handlers and stats loops",
+    ["resource", "event"],
+)
+HANDLER_ERRORS = Counter(
+    "rgwoperator_handler_errors_total",
+    "Exceptions raised by kopf handlers and stats loops",
+    ["resource", "event", "exception"],
+)
+BACKEND_CALL_DURATION = Histogram(
+    "rgwoperator_backend_call_seconds",
+    "Latency of outbound calls to the RGW admin API, S3 and Kubernetes",
+    ["backend", "operation"],
+)
+BACKEND_IN_FLIGHT = Gauge(
+    "rgwoperator_backend_in_flight_calls",
+    "Outbound calls currently in flight",
+    ["backend"],
+)
+BACKEND_ERRORS = Counter(
+    "rgwoperator_backend_errors_total",
+    "Failed outbound calls by exception class",
+    ["backend", "operation", "exception"],
+)
+
+
+RGW_POOL_CONNECTIONS = Gauge(
+    "rgwoperator_rgw_pool_connections",
+    "Connections held by the shared RGW admin connection pool",
+    ["server", "state"],
+)
+RGW_POOL_WAIT = Histogram(
+    "rgwoperator_rgw_pool_wait_seconds",
+    "Time spent waiting for a free RGW admin request slot",
+    ["server"],
+)
+RGW_IN_FLIGHT = Gauge(
+    "rgwoperator_rgw_in_flight_requests",
+    "RGW admin requests currently in flight",
+    ["server"],
+)
+
+CIRCUIT_STATE = Gauge(
+    "rgwoperator_circuit_breaker_state",
+    "Current circuit breaker state per backend, 1 for the active state",
+    ["backend", "state"],
+)
+ADMISSION_LIMIT = Gauge(
+    "rgwoperator_admission_concurrency_limit",
+    "Current adaptive concurrency limit per backend",
+    ["backend"],
+)
+ADMISSION_QUEUED = Gauge(
+    "rgwoperator_admission_queued_calls",
+    "Calls waiting for a rate limit token or a concurrency slot",
+    ["backend"],
+)
+ADMISSION_REJECTED = Counter(
+    "rgwoperator_admission_rejected_total",
+    "Calls rejected because the circuit breaker was open",
+    ["backend"],
+)
+
+USER_STATS_SWEEP_DURATION = Histogram(
+    "rgwoperator_user_stats_sweep_seconds",
+    "Duration of a full user statistics sweep",
+    buckets=(1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 300),
+)
+USER_STATS_SKIPPED = Counter(
+    "rgwoperator_user_stats_skipped_total",
+    "Users skipped because the stats sweep deadline expired",
+)
+
+CACHE_LOOKUPS = Counter(
+    "rgwoperator_cache_lookups_total",
+    "Reference lookups served by the informer cache",
+    ["kind", "result"],
+)
+CACHE_LAST_EVENT = Gauge(
+    "rgwoperator_cache_last_event_timestamp_seconds",
+    "Time of the last watch event applied to the informer cache",
+    ["kind"],
+)
+
+STATUS_PATCHES = Counter(
+    "rgwoperator_stats_status_patches_total",
+    "Stats status patches emitted or suppressed as insignificant",
+    ["kind", "result"],
+)
+STATS_POLLS = Counter(
+    "rgwoperator_stats_polls_total",
+    "Resources polled for stats or deferred by the request budget",
+    ["kind", "result"],
+)
+
+TEMPLATE_CACHE = Counter(
+    "rgwoperator_template_cache_lookups_total",
+    "Lookups of compiled AccessKey secret templates",
+    ["result"],
+)
+VALIDATIONS = Counter(
+    "rgwoperator_webhook_reviews_total",
+    "Specs allowed or denied by the validating webhook",
+    ["kind", "result"],
+)
+VALIDATION_CACHE = Counter(
+    "rgwoperator_validation_cache_lookups_total",
+    "Lookups of memoized validation results",
+    ["result"],
+)
+S3_CLIENT_CACHE = Counter(
+    "rgwoperator_s3_client_cache_lookups_total",
+    "Lookups of cached S3 clients by result (hit, miss, invalidated)",
+    ["result"],
+)
+S3_CLIENTS = Counter(
+    "rgwoperator_s3_clients_created_total",
+    "S3 clients constructed",
+)
+
+ROTATIONS = Counter(
+    "rgwoperator_access_key_rotations_total",
+    "Access key rotations and old key removals by result",
+    ["action", "result"],
+)
+ROTATION_DURATION = Histogram(
+    "rgwoperator_access_key_rotation_seconds",
+    "Duration of a single access key rotation or old key removal",
+    ["action"],
+)
+ROTATIONS_PENDING = Gauge(
+    "rgwoperator_access_key_rotations_pending",
+    "Access key rotations and old key removals due in the last batch",
+)
+
+DRIFT = Gauge(
+    "rgwoperator_drift_findings",
+    "Differences between radosgw and the resources found by the last drift pass",
+    ["kind", "type"],
+)
+DRIFT_LAST_PASS = Gauge(
+    "rgwoperator_drift_last_pass_timestamp_seconds",
+    "Time of the last completed drift detection pass",
+)
+
+SHARDS_HELD = Gauge(
+    "rgwoperator_shards_held",
+    "Shard leases held by this replica",
+)
+SHARD_MEMBERS = Gauge(
+    "rgwoperator_shard_members",
+    "Live replicas sharing the shards, as seen by this replica",
+)
+SHARD_HANDOFFS = Counter(
+    "rgwoperator_shard_handoffs_total",
+    "Shard leases acquired or released by this replica",
+    ["action"],
+)
+
+STARTUP_SECONDS = Gauge(
+    "rgwoperator_startup_seconds",
+    "Seconds from operator start until the first stats polls were spread out",
+)
+STARTUP_RGW_CALLS = Counter(
+    "rgwoperator_startup_rgw_calls_total",
+    "RGW lookups issued during the startup phase because the startup snapshot missed",
+    ["kind"],
+)
+STARTUP_SNAPSHOT_HITS = Counter(
+    "rgwoperator_startup_snapshot_hits_total",
+    "RGW lookups answered from the startup snapshot",
+    ["kind"],
+)
+
+BUCKET_SETTINGS = Counter(
+    "rgwoperator_bucket_settings_total",
+    "Bucket sub-resources applied to or skipped for radosgw",
+    ["setting", "result"],
+)
+BUCKET_SETTING_DURATION = Histogram(
+    "rgwoperator_bucket_setting_seconds",
+    "Time spent applying a single bucket sub-resource",
+    ["setting"],
+)
+BUCKET_TIME_TO_READY = Histogram(
+    "rgwoperator_bucket_time_to_ready_seconds",
+    "Time from Bucket creation until it is reported ready",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+PURGE_OBJECTS = Counter(
+    "rgwoperator_bucket_purge_objects_total",
+    "Object versions deleted or failed to delete by bucket purges",
+    ["result"],
+)
+PURGE_BYTES = Counter(
+    "rgwoperator_bucket_purge_bytes_total",
+    "Bytes freed by bucket purges",
+)
+PURGES_RUNNING = Gauge(
+    "rgwoperator_bucket_purges_running",
+    "Bucket purges currently running in the background",
+)
+
+
+def add_handler_hook(hook: Callable[[Optional[str], Optional[str]], ContextManager]) -> None:
+    """
+    Enters hook(namespace, name) of the handled object around every
+    instrumented handler run
+    """
+    _handler_hooks.append(hook)
+
+
+def instrument_handler(resource: str, event: str):
+    """
+    Records duration and exceptions of an async handler and traces
+    slow runs
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                with ExitStack() as hooks:
+                    for hook in _handler_hooks:
+                        hooks.enter_context(hook(kwargs.get("namespace"), kwargs.get("name")))
+                    async with trace(resource, event, kwargs):
+                        return await fn(*args, **kwargs)
+            except Exception as e:
+                HANDLER_ERRORS.labels(resource, event, type(e).__name__).inc()
+                raise
+            finally:
+                HANDLER_DURATION.labels(resource, event).observe(time.monotonic() - started)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def track_call(backend: str, operation: str):
+    """
+    Records latency, in-flight count and errors of an outbound call
+    """
+    started = time.monotonic()
+    BACKEND_IN_FLIGHT.labels(backend).inc()
+    try:
+        with span(backend, operation):
+            yield
+    except Exception as e:
+        BACKEND_ERRORS.labels(backend, operation, type(e).__name__).inc()
+        raise
+    finally:
+        BACKEND_IN_FLIGHT.labels(backend).dec()
+        BACKEND_CALL_DURATION.labels(backend, operation).observe(time.monotonic() - started)
+
@@ -0,0 +1,172 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from os import getenv
+from typing import List, Optional, Tuple
+
+profile_handlers = {h.strip() for h in getenv("PROFILE_HANDLERS", "").split(",") if h.strip()}
+profile_sample_rate = float(getenv("PROFILE_SAMPLE_RATE", "1"))
+profile_dir = getenv("PROFILE_DIR", "/tmp/rgwoperator-profiles")
+slow_reconcile_seconds = float(getenv("SLOW_RECONCILE_SECONDS", "5"))
+slow_callback_seconds = float(getenv("SLOW_CALLBACK_SECONDS", "0"))
+
+PROFILE_ANNOTATION = "s3.hanse-merkur.de/profile"
+
+logger = logging.getLogger("rgwoperator.profiling")
+
+# (phase, operation, started, duration) of every call made by the current reconcile
+_spans: ContextVar[Optional[List[Tuple[str, str, float, float]]]] = ContextVar("spans", default=None)
+_profiling = False
+_watchdog: Optional["LoopWatchdog"] = None
+
+
+@contextmanager
+def span(phase: str, operation: str):
+    """
+    Records the duration of a phase of the current reconcile, if any
+    """
+    spans = _spans.get()
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if spans is not None:
+            spans.append((phase, operation, started, time.monotonic() - started))
+
+
+def should_profile(resource: str, event: str, annotations) -> bool:
+    if annotations.get(PROFILE_ANNOTATION) == "true":
+        return True
+    if not {"*", resource, f"{resource}.{event}"} & profile_handlers:
+        return False
+    return random.random() < profile_sample_rate
+
+
+@asynccontextmanager
+async def trace(resource: str, event: str, kwargs: dict):
+    """
+    Collects the spans of a handler run and reports runs slower than
+    SLOW_RECONCILE_SECONDS. Handlers selected by PROFILE_HANDLERS or the
+    profile annotation additionally run under cProfile. Only one handler
+    is profiled at a time, and the profile includes whatever else the
+    event loop runs while the handler awaits
+    """
+    global _profiling
+    spans = []
+    token = _spans.set(spans)
+    profiler = None
+    if not _profiling and should_profile(resource, event, kwargs.get("annotations") or {}):
+        _profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        if profiler is not None:
+            profiler.disable()
+            _profiling = False
+        _spans.reset(token)
+        if elapsed >= slow_reconcile_seconds:
+            name = "/".join(filter(None, (kwargs.get("namespace"), kwargs.get("name"))))
+            report_slow(resource, event, name, started, elapsed, spans, profiler)
+
+
+def report_slow(resource, event, name, started, elapsed, spans, profiler) -> None:
+    totals = defaultdict(lambda: [0, 0.0])
+    for phase, _, _, duration in spans:
+        totals[phase][0] += 1
+        totals[phase][1] += duration
+    # Concurrent calls overlap, so the phases may add up to more than the total
+    other = max(0.0, elapsed - sum(total for _, total in totals.values()))
+    breakdown = ", ".join(
+        f"{phase} {total:.3f}s ({calls} calls)"
+        for phase, (calls, total) in sorted(totals.items(), key=lambda item: -item[1][1])
+    )
+    lines = [
+        f"Slow reconcile of {resource}.{event} {name} took {elapsed:.3f}s: "
+        f"{breakdown or 'no calls'}, other {other:.3f}s"
+    ]
+    for phase, operation, span_started, duration in sorted(spans, key=lambda s: s[2])[:50]:
+        lines.append(f"  +{span_started - started:.3f}s {phase} {operation} {duration:.3f}s")
+    if len(spans) > 50:
+        lines.append(f"  ... {len(spans) - 50} more calls")
+
+    if profiler is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(
+            profile_dir, f"{resource}-{event}-{name.replace('/', '-')}-{int(time.time())}.prof"
+        )
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(15)
+        lines.append(f"  profile written to {path}")
+        lines.append(out.getvalue())
+    logger.warning("\n".join(lines))
+
+
+class LoopWatchdog(threading.Thread):
+    """
+    Logs the stack of the event loop thread whenever the loop has not
+    run a heartbeat for longer than SLOW_CALLBACK_SECONDS, which shows
+    the blocking call itself rather than the callback that made it
+    """
+
+    def __init__(self, threshold: float):
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.threshold = threshold
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopped = threading.Event()
+
+    async def heartbeat(self):
+        while True:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def run(self):
+        reported = False
+        while not self.stopped.wait(self.threshold / 4):
+            stalled = time.monotonic() - self.last_beat
+            if stalled < self.threshold:
+                reported = False
+            elif not reported:
+                reported = True
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else "unavailable"
+                logger.warning("Event loop blocked for %.3fs in:\n%s", stalled, stack)
+
+
+def enable_slow_callback_detection() -> Optional[LoopWatchdog]:
+    """
+    Enables asyncio debug mode and the loop watchdog when
+    SLOW_CALLBACK_SECONDS is set. Must be called from the event loop thread
+    """
+    global _watchdog
+    if slow_callback_seconds <= 0:
+        return None
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = slow_callback_seconds
+    _watchdog = LoopWatchdog(slow_callback_seconds)
+    _watchdog.start()
+    return _watchdog
+
+
+def disable_slow_callback_detection() -> None:
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stopped.set()
+        _watchdog = None
@@ -1,22 +1,93 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
 from os import getenv
+from typing import Dict, Optional, Tuple
 import logging
+import secrets
+import string
 
 import kopf
-from pykube import HTTPClient, KubeConfig
-from pykube.exceptions import PyKubeError, ObjectDoesNotExist
-from aiorgwadmin import RGWAdmin
-from aiorgwadmin.exceptions import NoSuchUser
-from jinja2 import Environment, BaseLoader
+from pykube.exceptions import PyKubeError
+from aiorgwadmin.exceptions import InvalidAccessKey, NoSuchKey, NoSuchUser
+from jinja2 import TemplateSyntaxError
 
-
-from s3struct import Secret, User
-from utils import is_annotation_set, get_environment_creds
+from admission import CircuitOpenError
+from cache import get_rgw_user_id, get_secret, get_user
+from metrics import ROTATION_DURATION, ROTATIONS, ROTATIONS_PENDING, instrument_handler
+from s3clients import discard_s3_client
+from s3struct import AccessKey, Secret
+from sharding import is_owned
+from stats import RequestBudget
+from templates import compile_templates, render_templates
+from utils import get_kube_api, get_rgw, run_blocking, start_background, utc_now
 
 tenant = getenv("TENANT", "dev")
+rotation_interval = int(getenv("ROTATION_INTERVAL", "30"))
+rotation_overlap = int(getenv("ROTATION_OVERLAP", "86400"))
+rotation_concurrency = int(getenv("ROTATION_CONCURRENCY", "4"))
+rotation_budget = RequestBudget(int(getenv("ROTATION_RATE", "60")))
+
+ROTATE_ANNOTATION = "s3.hanse-merkur.de/rotate"
+
+# Status written by the rotation engine but not yet seen in the index
+_written_rotations: Dict[Tuple[str, str], dict] = {}
+
+ACCESS_KEY_CHARS = string.ascii_uppercase + string.digits
+SECRET_KEY_CHARS = string.ascii_letters + string.digits
+
+
+def generate_credentials() -> Tuple[str, str]:
+    """
+    Generates an access key ID and secret in the format used by radosgw
+    """
+    access_key_id = "".join(secrets.choice(ACCESS_KEY_CHARS) for _ in range(20))
+    secret_access_key = "".join(secrets.choice(SECRET_KEY_CHARS) for _ in range(40))
+    return access_key_id, secret_access_key
+
+
+async def create_rgw_key(rgw_user_id: str, access_key_id: str, secret_access_key: str) -> bool:
+    """
+    Adds the given key to the radosgw user and tells whether it is
+    listed among the keys of the user afterwards
+    """
+    all_keys = await get_rgw().create_key(
+        uid=rgw_user_id,
+        access_key=access_key_id,
+        secret_key=secret_access_key,
+        generate_key=False,
+    )
+    return access_key_id in {key["access_key"] for key in all_keys or []}
+
+
+async def remove_rgw_key(rgw_user_id: str, access_key_id: str) -> None:
+    """
+    Removes the key from the radosgw user, keys that are gone already
+    are ignored
+    """
+    try:
+        await get_rgw().remove_key(access_key_id, uid=rgw_user_id)
+    except (InvalidAccessKey, NoSuchKey, NoSuchUser):
+        pass
+    discard_s3_client(access_key_id)
+
+
+def parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
 
 
-@kopf.on.create("s3.hanse-merkur.de", "v1alpha1", "accesskeys")
-async def add_access_key(meta, spec, logger, patch, **_):
+@kopf.on.create("s3.hanse-merkur.de", "v1alpha1", "accesskeys", when=is_owned)
+@instrument_handler("accesskeys", "create")
+async def add_access_key(
+    meta,
+    spec,
+    status,
+    logger,
+    patch,
+    users_by_name: kopf.Index,
+    secrets_by_name: kopf.Index,
+    **_,
+):
     namespace = meta["namespace"]
     name = spec["secretName"]
     user_id = spec["owner"]
@@ -28,18 +99,21 @@ async def add_access_key(meta, spec, logger, patch, **_):
         secret_labels = template.get("metadata", {}).get("labels", None)
         template_data = template.get("data", None)
 
+    # Broken templates fail before any key is created in radosgw
+    templates = {}
+    if template_data:
+        try:
+            templates = compile_templates(template_data)
+        except TemplateSyntaxError as e:
+            raise kopf.PermanentError(f"Invalid template at line {e.lineno}: {e.message}")
+
     try:
-        api = HTTPClient(KubeConfig.from_env())
+        api = get_kube_api()
         # Find the actual owner in the radosgw database
-        user = User.objects(api).get(name=user_id)
-        if not user.exists():
+        k8s_user = await get_user(users_by_name, user_id)
+        if k8s_user is None:
             raise kopf.TemporaryError("Owner %s is not managed by Cluster", user_id)
-        user_annotations = user.obj["metadata"]["annotations"]
-
-        if is_annotation_set(user_annotations, "skip-tenant"):
-            rgw_user_id = user.obj["spec"]["userId"]
-        else:
-            rgw_user_id = f"{tenant}-{user.obj['spec']['userId']}"
+        rgw_user_id = get_rgw_user_id(k8s_user, tenant)
 
         logger.debug(
             "Creating AccessKey %s in %s with Secret %s for %s",
@@ -49,106 +123,340 @@ async def add_access_key(meta, spec, logger, patch, **_):
             rgw_user_id,
         )
 
-        rgw = RGWAdmin(**get_environment_creds())
-        user = {}
-        try:
-            user = await rgw.get_user(uid=rgw_user_id)
-        except NoSuchUser:
-            raise kopf.TemporaryError("The owner %s does not exist", rgw_user_id)
-
-        try:
-            User.objects(api).get(name=user_id)
-        except ObjectDoesNotExist:
-            raise kopf.TemporaryError("The referenced Ceph user %s is not managed on this cluster", user_id)
-
-        try:
-            secret = Secret.objects(api, namespace=namespace).get_by_name(name=name)
+        rgw = get_rgw()
+        secret = await get_secret(secrets_by_name, namespace, name)
+        if secret is not None:
             logger.debug(
                 "Creating new access key in Ceph using existing secret for %s",
                 rgw_user_id,
             )
             access_key_id = secret.get_secret("aws_access_key_id")
             secret_access_key = secret.get_secret("aws_secret_access_key")
-            if not (access_key_id or secret_access_key):
+            if not (access_key_id and secret_access_key):
                 raise kopf.TemporaryError(
                     f"Secret {name} does not contain the keys 'aws_access_key_id' and 'aws_secret_access_key'"
                 )
-            response = await rgw.create_key(
-                uid=rgw_user_id, access_key=access_key_id, secret_key=secret_access_key
-            )
-        except ObjectDoesNotExist:
+        else:
             logger.debug("Creating new access key in Ceph for %s", rgw_user_id)
-            # RadosGW API does not return the actual key it just created
-            # So we check against existing keys for the new one instead
-            # Not a great solution as others might be creating keys aside from the operator
-            try:
-                all_keys = await rgw.create_key(uid=rgw_user_id)
-                new_keys = [x for x in all_keys if x not in user["keys"]]
-                if len(new_keys) < 1:
-                    raise kopf.PermanentError("Failed to create a new access key for the user %s", user_id)
-                # We select the first one from the list and hope for the best
-                access_key_id = new_keys[0]["access_key"]
-                secret_access_key = new_keys[0]["secret_key"]
-
-                secret = Secret.new(api, name, namespace)
-                secret.set_secret("aws_access_key_id", access_key_id)
-                secret.set_secret("aws_secret_access_key", secret_access_key)
-                kopf.adopt(secret.obj)
-                logger.debug("Creating Kubernetes secret with name %s", name)
-
-                if secret_annotations:
-                    secret["metadata"]["annotations"] = secret_annotations
-                if secret_labels:
-                    secret["metadata"]["labels"] = secret_labels
-
-                if template_data:
-                    for k, v in template_data.items():
-                        if k in ["aws_access_key_id", "aws_secret_access_key"]:
-                            continue
-                        rtemplate = Environment(loader=BaseLoader).from_string(v)
-                        data = rtemplate.render(
-                            aws_access_key_id=access_key_id,
-                            aws_secret_access_key=secret_access_key,
-                        )
-                        secret.set_secret(k, data)
-
-                secret.create()
-            except NoSuchUser:
-                kopf.PermanentError(
-                    "No such user exists. No access key can be generated"
-                )
+            # RadosGW does not tell which key it generated, so the
+            # operator generates the key and passes it explicitly
+            access_key_id, secret_access_key = generate_credentials()
+            # kopf also applies the patch of a failed attempt, so a retry
+            # knows the key even if the create call itself timed out
+            patch.status["pendingAccessKeyId"] = access_key_id
+
+        stale = status.get("pendingAccessKeyId")
+        if stale and stale != access_key_id:
+            # An earlier attempt created this key but failed to write the Secret
+            logger.info("Removing access key %s of an earlier attempt", stale)
+            await remove_rgw_key(rgw_user_id, stale)
 
         try:
-            # Reverse ownership referencing is not yet supported in kopf.
-            # This is based on append_owner_reference from hierachies.py
-            k8s_user = User.objects(api).get(name=user_id)
-            refs = patch.setdefault("metadata", {}).setdefault("ownerReferences", [])
-            refs.append(kopf.build_owner_reference(k8s_user.obj))
-            logger.debug("Patching AccessKey with owner reference: %s", patch)
-        except ObjectDoesNotExist:
-            kopf.PermanentError("Ceph User %s is not managed in Kubernetes", user_id)
+            created = await create_rgw_key(rgw_user_id, access_key_id, secret_access_key)
+        except NoSuchUser:
+            raise kopf.TemporaryError(f"The owner {rgw_user_id} does not exist")
+        if not created:
+            raise kopf.PermanentError(f"Failed to create a new access key for the user {user_id}")
+
+        if secret is not None:
+            rendered = render_templates(templates, access_key_id, secret_access_key)
+            changed = {k: v for k, v in rendered.items() if secret.get_secret(k) != v}
+            if changed:
+                logger.debug("Rendering templates into existing secret %s", name)
+                secret_patch = Secret.new(api, name, namespace)
+                for k, v in changed.items():
+                    secret_patch.set_secret(k, v)
+                await run_blocking("kube", secret_patch.patch, {"data": secret_patch.obj["data"]})
+        else:
+            secret = Secret.new(api, name, namespace)
+            secret.set_secret("aws_access_key_id", access_key_id)
+            secret.set_secret("aws_secret_access_key", secret_access_key)
+            kopf.adopt(secret.obj)
+            logger.debug("Creating Kubernetes secret with name %s", name)
+
+            if secret_annotations:
+                secret.obj["metadata"]["annotations"] = secret_annotations
+            if secret_labels:
+                secret.obj["metadata"]["labels"] = secret_labels
+
+            rendered = render_templates(templates, access_key_id, secret_access_key)
+            for k, v in rendered.items():
+                secret.set_secret(k, v)
+
+            await run_blocking("kube", secret.create)
+
+        # Reverse ownership referencing is not yet supported in kopf.
+        # This is based on append_owner_reference from hierachies.py
+        refs = patch.setdefault("metadata", {}).setdefault("ownerReferences", [])
+        refs.append(kopf.build_owner_reference(k8s_user))
+        logger.debug("Patching AccessKey with owner reference: %s", patch)
     except PyKubeError as e:
-        kopf.PermanentError("kube error: %s", e)
-    finally:
-        api.session.close()
+        # Retried, the key is removed again unless the Secret holds it
+        raise kopf.TemporaryError(f"kube error: {e}")
 
     patch.status["accessKeyId"] = access_key_id
+    patch.status["keyCreatedAt"] = utc_now()
+    patch.status["pendingAccessKeyId"] = None
     patch.status["ready"] = True
 
 
-@kopf.on.delete("s3.hanse-merkur.de", "v1alpha1", "accesskeys")
-async def delete_access_key(spec, status, **_):
-    if not status["ready"]:
+@kopf.on.delete("s3.hanse-merkur.de", "v1alpha1", "accesskeys", when=is_owned)
+@instrument_handler("accesskeys", "delete")
+async def delete_access_key(spec, status, users_by_name: kopf.Index, **_):
+    # The key of a failed create attempt that never made it into the Secret
+    access_key_ids = [status.get("pendingAccessKeyId")]
+    if status.get("ready"):
+        access_key_ids.append(status["accessKeyId"])
+        # The key replaced by a rotation still in its overlap window
+        access_key_ids.append((status.get("rotation") or {}).get("previousAccessKeyId"))
+    access_key_ids = [access_key_id for access_key_id in access_key_ids if access_key_id]
+    if not access_key_ids:
         return
 
-    access_key_id = status["accessKeyId"]
     user_id = spec["owner"]
-    rgw_user_id = f"{tenant}-{user_id}"
+    user = await get_user(users_by_name, user_id)
+    # Without the User the tenant prefix is assumed, a removed user took its keys along
+    rgw_user_id = get_rgw_user_id(user, tenant) if user is not None else f"{tenant}-{user_id}"
 
-    rgw = RGWAdmin(**get_environment_creds())
-    try:
-        await rgw.remove_key(access_key_id, uid=rgw_user_id)
-    except NoSuchUser:
-        pass
-    except Exception:
-        pass
+    for access_key_id in access_key_ids:
+        try:
+            await remove_rgw_key(rgw_user_id, access_key_id)
+        except CircuitOpenError:
+            # Keep the finalizer until radosgw can remove the key
+            raise
+        except Exception:
+            pass
+
+
+def is_access_key_ready(body, **_) -> bool:
+    return body.status.get("ready", False)
+
+
+@kopf.index("s3.hanse-merkur.de", "v1alpha1", "accesskeys", when=is_access_key_ready)
+def access_keys_for_rotation(namespace, name, meta, spec, annotations, status, **_):
+    return {
+        (namespace, name): {
+            "spec": dict(spec),
+            "requested": annotations.get(ROTATE_ANNOTATION),
+            "created": meta["creationTimestamp"],
+            "status": dict(status),
+        }
+    }
+
+
+def _merge_patch(target: dict, patch: dict) -> dict:
+    """
+    Applies a JSON merge patch to a copy of target
+    """
+    merged = dict(target)
+    for k, v in patch.items():
+        if v is None:
+            merged.pop(k, None)
+        elif isinstance(v, dict):
+            current = merged.get(k)
+            merged[k] = _merge_patch(current if isinstance(current, dict) else {}, v)
+        else:
+            merged[k] = v
+    return merged
+
+
+def rotation_state(key, entry) -> dict:
+    """
+    Overlays the status last written by the engine until the index
+    catches up, so a key is never rotated twice for one request
+    """
+    status = entry["status"]
+    written = _written_rotations.get(key)
+    if written is None:
+        return status
+    merged = _merge_patch(status, written)
+    if merged == status:
+        del _written_rotations[key]
+    return merged
+
+
+def rotation_action(entry, status, now: datetime) -> Optional[str]:
+    """
+    Returns "expire" when the key replaced by the last rotation is due
+    for removal and "rotate" when the key itself is due for rotation
+    """
+    rotation = status.get("rotation") or {}
+    if rotation.get("phase") == "Overlap":
+        return "expire" if now >= parse_time(rotation["removeAfter"]) else None
+    requested = entry["requested"]
+    if requested and requested != rotation.get("requested"):
+        return "rotate"
+    days = entry["spec"].get("rotateAfterDays")
+    if days:
+        created = parse_time(status.get("keyCreatedAt") or entry["created"])
+        if now - created >= timedelta(days=days):
+            return "rotate"
+    return None
+
+
+async def patch_rotation_status(key, status: dict) -> None:
+    namespace, name = key
+    resource = AccessKey(get_kube_api(), {"metadata": {"name": name, "namespace": namespace}})
+    await run_blocking("kube", resource.patch, {"status": status})
+    written = _written_rotations.get(key, {})
+    _written_rotations[key] = {
+        **written,
+        **{
+            k: {**written[k], **v} if isinstance(v, dict) and isinstance(written.get(k), dict) else v
+            for k, v in status.items()
+        },
+    }
+
+
+async def rotate_access_key(key, entry, status, users_by_name, secrets_by_name) -> None:
+    """
+    Creates a new radosgw key and writes it into the Secret with a single
+    patch. The replaced key stays valid for ROTATION_OVERLAP seconds
+    """
+    namespace, _ = key
+    spec = entry["spec"]
+    user = await get_user(users_by_name, spec["owner"])
+    if user is None:
+        raise LookupError(f"Owner {spec['owner']} is not managed by Cluster")
+    rgw_user_id = get_rgw_user_id(user, tenant)
+    secret = await get_secret(secrets_by_name, namespace, spec["secretName"])
+    if secret is None:
+        raise LookupError(f"Secret {spec['secretName']} does not exist")
+    templates = compile_templates((spec.get("template") or {}).get("data") or {})
+
+    previous = status.get("accessKeyId")
+    access_key_id = secret.get_secret("aws_access_key_id")
+    secret_access_key = secret.get_secret("aws_secret_access_key")
+    resumed = False
+    if access_key_id and access_key_id != previous:
+        # An earlier rotation got as far as the Secret, but not the status
+        try:
+            await get_rgw().get_user(access_key=access_key_id)
+            resumed = True
+        except (InvalidAccessKey, NoSuchKey, NoSuchUser):
+            pass
+
+    if not resumed:
+        access_key_id, secret_access_key = generate_credentials()
+        if not await create_rgw_key(rgw_user_id, access_key_id, secret_access_key):
+            raise RuntimeError(f"Failed to create a new access key for {rgw_user_id}")
+        secret_patch = Secret.new(get_kube_api(), spec["secretName"], namespace)
+        secret_patch.set_secret("aws_access_key_id", access_key_id)
+        secret_patch.set_secret("aws_secret_access_key", secret_access_key)
+        for k, v in render_templates(templates, access_key_id, secret_access_key).items():
+            secret_patch.set_secret(k, v)
+        await run_blocking("kube", secret_patch.patch, {"data": secret_patch.obj["data"]})
+
+    now = datetime.now(timezone.utc)
+    await patch_rotation_status(
+        key,
+        {
+            "accessKeyId": access_key_id,
+            "keyCreatedAt": utc_now(),
+            "rotation": {
+                "phase": "Overlap",
+                "requested": entry["requested"],
+                "previousAccessKeyId": previous,
+                "rotatedAt": utc_now(),
+                "removeAfter": (now + timedelta(seconds=rotation_overlap)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "completedAt": None,
+            },
+        },
+    )
+
+
+async def expire_previous_key(key, entry, status, users_by_name) -> None:
+    user = await get_user(users_by_name, entry["spec"]["owner"])
+    if user is None:
+        raise LookupError(f"Owner {entry['spec']['owner']} is not managed by Cluster")
+    previous = status["rotation"].get("previousAccessKeyId")
+    if previous:
+        await remove_rgw_key(get_rgw_user_id(user, tenant), previous)
+    await patch_rotation_status(
+        key,
+        {
+            "rotation": {
+                "phase": "Completed",
+                "previousAccessKeyId": None,
+                "removeAfter": None,
+                "completedAt": utc_now(),
+            }
+        },
+    )
+
+
+@instrument_handler("accesskeys", "rotation")
+async def rotate_due_access_keys(
+    access_keys_for_rotation: kopf.Index,
+    users_by_name: kopf.Index,
+    secrets_by_name: kopf.Index,
+):
+    """
+    Runs the due rotations and old key removals as one batch, bounded by
+    ROTATION_CONCURRENCY and the ROTATION_RATE per minute budget.
+    Removals of old keys go first
+    """
+    now = datetime.now(timezone.utc)
+    due = []
+    keys = set()
+    for key, entries in access_keys_for_rotation.items():
+        if not is_owned(*key):
+            continue
+        keys.add(key)
+        for entry in entries:
+            status = rotation_state(key, entry)
+            action = rotation_action(entry, status, now)
+            if action is not None:
+                due.append((action, key, entry, status))
+    for key in _written_rotations.keys() - keys:
+        del _written_rotations[key]
+
+    ROTATIONS_PENDING.set(len(due))
+    due.sort(key=lambda item: item[0] != "expire")
+    granted = rotation_budget.take(len(due))
+    if granted < len(due):
+        ROTATIONS.labels("any", "deferred").inc(len(due) - granted)
+    semaphore = asyncio.Semaphore(rotation_concurrency)
+
+    async def run(action, key, entry, status):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                if action == "rotate":
+                    await rotate_access_key(key, entry, status, users_by_name, secrets_by_name)
+                else:
+                    await expire_previous_key(key, entry, status, users_by_name)
+            except Exception as e:
+                ROTATIONS.labels(action, "failed").inc()
+                logging.error("Failed to %s AccessKey %s/%s: %s", action, *key, e)
+            else:
+                ROTATIONS.labels(action, "succeeded").inc()
+                ROTATION_DURATION.labels(action).observe(time.monotonic() - started)
+
+    await asyncio.gather(*(run(*item) for item in due[:granted]))
+
+
+async def run_rotation_engine(
+    access_keys_for_rotation: kopf.Index,
+    users_by_name: kopf.Index,
+    secrets_by_name: kopf.Index,
+):
+    while True:
+        await asyncio.sleep(rotation_interval)
+        try:
+            await rotate_due_access_keys(access_keys_for_rotation, users_by_name, secrets_by_name)
+        except Exception:
+            logging.exception("Failed to run access key rotations")
+
+
+@kopf.on.startup()
+async def start_rotation_engine(
+    access_keys_for_rotation: kopf.Index,
+    users_by_name: kopf.Index,
+    secrets_by_name: kopf.Index,
+    **_,
+):
+    start_background(
+        run_rotation_engine(access_keys_for_rotation, users_by_name, secrets_by_name),
+        name="access-key-rotation",
+    )
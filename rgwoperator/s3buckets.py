@@ -1,327 +1,354 @@
 import asyncio
+import hashlib
 import json
 import logging
+import time
+from datetime import datetime, timezone
 from os import getenv
+from typing import Dict
 
-import boto3
 import kopf
 from botocore.exceptions import ClientError
-from pykube import HTTPClient, KubeConfig
 from pykube.exceptions import PyKubeError
-from aiorgwadmin import RGWAdmin
 from aiorgwadmin.exceptions import BucketNotEmpty, NoSuchBucket, NoSuchKey
 
-from s3struct import AccessKey, Secret, User
-from utils import is_annotation_set, get_environment_creds
-
-PUBLIC_POLICY = {
-    "Statement": [
-        {
-            "Action": ["s3:GetObject"],
-            "Effect": "Allow",
-            "Principal": "*",
-            "Resource": [],
-            "Sid": "PublicRead",
-        }
-    ],
-    "Version": "2012-10-17",
-}
+from admission import CircuitOpenError, is_s3_overload
+from bucketspec import desired_bucket_settings, immutable_bucket_changes, is_bucket_ready
+from cache import get_access_key, get_rgw_user_id, get_secret, get_user
+from metrics import (
+    BUCKET_SETTING_DURATION,
+    BUCKET_SETTINGS,
+    BUCKET_TIME_TO_READY,
+    PURGE_BYTES,
+    PURGE_OBJECTS,
+    PURGES_RUNNING,
+    instrument_handler,
+)
+from s3clients import s3_client
+from s3struct import Bucket
+from sharding import is_owned
+from exporter import bucket_snapshot, usage_from_quota
+from stats import AdaptiveSchedule, StatusFilter, bucket_owners, is_near_quota, stats_budget
+from utils import (
+    is_annotation_set,
+    get_kube_api,
+    get_rgw,
+    run_blocking,
+    start_background,
+    utc_now,
+)
+from warmup import bucket_metadata, first_poll_delay, forget_bucket, load_startup_snapshot
 
 tenant = getenv("TENANT", "dev")
+bucket_stats_interval = int(getenv("BUCKET_STATS_INTERVAL", "60"))
+bucket_stats_listing_min = int(getenv("BUCKET_STATS_LISTING_MIN", "100"))
+bucket_settings_concurrency = int(getenv("BUCKET_SETTINGS_CONCURRENCY", "3"))
+purge_concurrency = int(getenv("PURGE_CONCURRENCY", "8"))
+purge_check_interval = int(getenv("PURGE_CHECK_INTERVAL", "30"))
+purge_checkpoint_interval = float(getenv("PURGE_CHECKPOINT_INTERVAL", "10"))
+
+bucket_stats_filter = StatusFilter("buckets")
+bucket_stats_schedule = AdaptiveSchedule("buckets", bucket_stats_interval)
+
+# Running purges by bucket name
+_purges: Dict[str, asyncio.Task] = {}
+
+# State of the sub-resources of a newly created bucket
+DEFAULT_SETTINGS = {"versioning": "Suspended"}
+
+
+def settings_digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def pending_bucket_settings(desired: dict, status) -> dict:
+    """
+    Returns the sub-resources whose desired state differs from the
+    state last applied, as recorded in status.applied
+    """
+    applied = status.get("applied", {})
+    pending = {}
+    for setting, value in desired.items():
+        if value is None:
+            continue
+        digest = settings_digest(value)
+        if setting not in applied and setting in DEFAULT_SETTINGS:
+            last_digest = settings_digest(DEFAULT_SETTINGS[setting])
+        else:
+            last_digest = applied.get(setting)
+        if digest == last_digest:
+            BUCKET_SETTINGS.labels(setting, "skipped").inc()
+            continue
+        pending[setting] = value
+    return pending
+
+
+async def apply_bucket_setting(s3, bucket_name: str, owner: str, setting: str, value):
+    if setting == "policy":
+        await run_blocking(
+            "s3", s3.put_bucket_policy, Bucket=bucket_name, Policy=json.dumps(value)
+        )
+    elif setting == "lifecycle":
+        response = await run_blocking(
+            "s3",
+            s3.put_bucket_lifecycle_configuration,
+            Bucket=bucket_name,
+            LifecycleConfiguration=value,
+        )
+        if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
+            raise kopf.PermanentError(f"Invalid LifeCyclePolicy: {response}")
+    elif setting == "objectLock":
+        await run_blocking(
+            "s3",
+            s3.put_object_lock_configuration,
+            Bucket=bucket_name,
+            ObjectLockConfiguration=value,
+        )
+    elif setting == "versioning":
+        await run_blocking(
+            "s3",
+            s3.put_bucket_versioning,
+            Bucket=bucket_name,
+            VersioningConfiguration={"Status": value},
+        )
+    elif setting == "quota":
+        await get_rgw().set_bucket_quota(
+            uid=owner,
+            bucket=bucket_name,
+            max_size_kb=value["maxSize"],
+            max_objects=value["maxObjects"],
+            enabled=True,
+        )
 
 
-@kopf.on.create("s3.hanse-merkur.de", "v1alpha1", "buckets")
-async def add_bucket(spec, meta, patch, annotations, logger, **_):
+def is_permanent_s3_error(e: BaseException) -> bool:
+    """
+    Rejected requests are not retried, throttling and server errors are
+    retried with backoff like any other temporary failure
+    """
+    if isinstance(e, ClientError):
+        return not is_s3_overload(e)
+    return isinstance(e, kopf.PermanentError)
+
+
+async def apply_bucket_settings(s3, bucket_name: str, owner: str, pending: dict, patch):
+    """
+    Pushes the pending sub-resources concurrently and records their digests,
+    so retries and later updates skip what was already applied.
+    Failures are collected so one failing setting does not hide the others
+    """
+    semaphore = asyncio.Semaphore(bucket_settings_concurrency)
+
+    async def apply(setting, value):
+        async with semaphore:
+            with BUCKET_SETTING_DURATION.labels(setting).time():
+                await apply_bucket_setting(s3, bucket_name, owner, setting, value)
+        patch.status.setdefault("applied", {})[setting] = settings_digest(value)
+        BUCKET_SETTINGS.labels(setting, "applied").inc()
+
+    results = await asyncio.gather(
+        *(apply(setting, value) for setting, value in pending.items()),
+        return_exceptions=True,
+    )
+    errors = {
+        setting: result
+        for setting, result in zip(pending, results)
+        if isinstance(result, Exception)
+    }
+    if not errors:
+        return
+
+    for error in errors.values():
+        if isinstance(error, CircuitOpenError):
+            raise error
+    message = "; ".join(f"{setting}: {error}" for setting, error in errors.items())
+    if all(is_permanent_s3_error(e) for e in errors.values()):
+        raise kopf.PermanentError(f"Failed to apply bucket settings: {message}")
+    raise kopf.TemporaryError(f"Failed to apply bucket settings: {message}")
+
+
+@kopf.on.create("s3.hanse-merkur.de", "v1alpha1", "buckets", when=is_owned)
+@instrument_handler("buckets", "create")
+async def add_bucket(
+    spec,
+    meta,
+    status,
+    patch,
+    annotations,
+    logger,
+    users_by_name: kopf.Index,
+    access_keys_by_name: kopf.Index,
+    secrets_by_name: kopf.Index,
+    **_,
+):
     bucket_name = spec["bucketName"]
     owner_access_key = spec["ownerAccessKey"]
-    bucket_policy = spec["bucketPolicy"]
-    life_cycle_policy = spec.get("lifeCyclePolicy", None)
     object_lock = spec.get("objectLock", False)
-    object_lock_config = spec.get("objectLockConfig", None)
     namespace = meta["namespace"]
-    versioning = spec["objectVersioning"]
-    quotas = spec.get("quotas", None)
-    if quotas and quotas["enabled"]:
-        max_objects = quotas["maxObjects"]
-        max_size = quotas["maxSize"]
-    else:
-        max_objects = -1
-        max_size = -1
-
-    if bucket_policy == "public":
-        # Standard public ACL from the AWS documentation.
-        # Allows read-only access to all objects
-        bucket_policy = PUBLIC_POLICY.copy()
-        bucket_policy["Statement"][0]["Resource"].append(
-            f"arn:aws:s3:::{bucket_name}/*"
-        )
-    elif bucket_policy == "custom" and "customBucketPolicy" in spec:
-        try:
-            bucket_policy = json.loads(spec["customBucketPolicy"])
-        except json.JSONDecodeError:
-            raise kopf.PermanentError("Failed to parse customBucketPolicy")
-
-    if life_cycle_policy is not None:
-        try:
-            life_cycle_policy = json.loads(life_cycle_policy)
-            # BUG https://github.com/ceph/ceph/pull/26518
-            for rule in life_cycle_policy["Rules"]:
-                if not hasattr(rule, "Prefix"):
-                    rule["Prefix"] = ""
-        except json.JSONDecodeError:
-            raise kopf.PermanentError("Failed to parse lifeCyclePolicy")
-
-    if object_lock and object_lock_config is not None:
-        try:
-            object_lock_config = json.loads(object_lock_config)
-            # Ensure the key is present in the object
-            if "ObjectLockEnabled" not in object_lock_config:
-                object_lock_config["ObjectLockEnabled"] = "Enabled"
-        except json.JSONDecodeError:
-            raise kopf.PermanentError("Failed to parse objectLockConfig")
 
+    desired = desired_bucket_settings(spec)
     allow_import = is_annotation_set(annotations, "allow-import")
 
     try:
-        api = HTTPClient(KubeConfig.from_env())
-        access_key = AccessKey.objects(api, namespace=namespace).get(
-            namespace=namespace, name=owner_access_key
-        )
-        if not access_key.exists():
+        access_key = await get_access_key(access_keys_by_name, namespace, owner_access_key)
+        if access_key is None:
             raise kopf.PermanentError("No such AccessKey exists")
-        access_key_secret = Secret.objects(api, namespace=namespace).get(
-            namespace=namespace, name=access_key.obj["spec"]["secretName"]
+        access_key_secret = await get_secret(
+            secrets_by_name, namespace, access_key["spec"]["secretName"]
         )
-        if not access_key_secret.exists():
+        if access_key_secret is None:
             raise kopf.PermanentError("No such Secret Access Key exists")
-        access_key_id = access_key_secret.get_secret("aws_access_key_id")
-        secret_access_key = access_key_secret.get_secret("aws_secret_access_key")
 
         # Find the actual owner in the radosgw database
-        user = User.objects(api).get(name=access_key.obj["spec"]["owner"])
-        if not user.exists():
+        user = await get_user(users_by_name, access_key["spec"]["owner"])
+        if user is None:
             raise kopf.PermanentError("Owner is not managed by Cluster")
-        user_annotations = user.obj["metadata"]["annotations"]
-        if is_annotation_set(user_annotations, "skip-tenant"):
-            owner = user.obj["spec"]["userId"]
-        else:
-            owner = f"{tenant}-{user.obj['spec']['userId']}"
+        owner = get_rgw_user_id(user, tenant)
     except PyKubeError as e:
         raise kopf.TemporaryError(f"Failed to get kubernetes secrets due to error: {e}")
-    finally:
-        api.session.close()
 
     try:
-        endpoint = getenv("OBJ_SERVER", "s3.hanse-merkur.de")
-        s3 = boto3.client(
-            "s3",
-            endpoint_url=f"https://{endpoint}",
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key,
-        )
-        rgw = RGWAdmin(**get_environment_creds())
+        s3 = await s3_client(access_key_secret)
+        rgw = get_rgw()
 
-        all_buckets = [b["Name"] for b in s3.list_buckets()["Buckets"]]
-        if bucket_name not in all_buckets:
-            s3.create_bucket(Bucket=bucket_name, ObjectLockEnabledForBucket=object_lock)
-        elif bucket_name in all_buckets and not allow_import:
+        # A single metadata lookup resolves existence and ownership of the bucket
+        try:
+            bucket_meta = bucket_metadata(bucket_name) or await rgw.get_metadata(
+                metadata_type="bucket", key=bucket_name
+            )
+        except NoSuchKey:
+            bucket_meta = None
+
+        if bucket_meta is None:
+            # kopf also applies the patch of a failed attempt. Recorded before
+            # the call, so a retry after any failure or timeout from here on
+            # resumes with the settings instead of rejecting the bucket
+            patch.status["created"] = True
+            await run_blocking(
+                "s3",
+                s3.create_bucket,
+                Bucket=bucket_name,
+                ObjectLockEnabledForBucket=object_lock,
+            )
+        elif bucket_meta["data"]["owner"] != owner:
+            # Creating a bucket owned by another user fails in radosgw
+            raise kopf.PermanentError("Failed to create bucket")
+        elif status.get("created"):
+            # Created by an earlier attempt of this handler
+            logger.info("Resuming creation of bucket %s", bucket_name)
+        elif not allow_import:
             raise kopf.PermanentError(
                 "Bucket exists and current import settings don't allow import"
             )
-        elif bucket_name in all_buckets and allow_import:
-            bucket_meta = await rgw.get_metadata(metadata_type="bucket", key=bucket_name)
+        else:
             bucket_id = bucket_meta["data"]["bucket"]["bucket_id"]
 
             await rgw.link_bucket(bucket=bucket_name, bucket_id=bucket_id, uid=owner)
 
-        if bucket_policy in ["public", "custom"]:
-            s3.put_bucket_policy(Bucket=bucket_name, Policy=bucket_policy)
-
-        if life_cycle_policy is not None:
-            response = s3.put_bucket_lifecycle_configuration(
-                Bucket=bucket_name, LifecycleConfiguration=life_cycle_policy
-            )
-            if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-                kopf.PermanentError("Invalid LifeCyclePolicy: %s", response)
-
-        if object_lock_config is not None:
-            response = s3.put_object_lock_configuration(
-                Bucket=bucket_name, ObjectLockConfiguration=object_lock_config
-            )
-
-        if versioning:
-            s3.put_bucket_versioning(
-                Bucket=bucket_name, VersioningConfiguration={"Status": "Enabled"}
-            )
-
-        rgw_bucket = await rgw.get_bucket(bucket=bucket_name)
-
-        if rgw_bucket["owner"] != access_key.obj["spec"]["owner"]:
-            raise kopf.PermanentError("Bucket is not owned by the same user")
-
-        if quotas and quotas["enabled"]:
-            await rgw.set_bucket_quota(
-                uid=rgw_bucket["owner"],
-                bucket=bucket_name,
-                max_size_kb=max_size,
-                max_objects=max_objects,
-                enabled=True,
-            )
-    except ClientError:
-        raise kopf.PermanentError("Failed to create bucket")
+        pending = pending_bucket_settings(desired, status)
+        await apply_bucket_settings(s3, bucket_name, owner, pending, patch)
+    except ClientError as e:
+        if is_permanent_s3_error(e):
+            raise kopf.PermanentError(f"Failed to create bucket: {e}")
+        raise kopf.TemporaryError(f"Failed to create bucket: {e}")
 
     patch.status["ready"] = True
-    patch.status["owner"] = access_key.obj["spec"]["owner"]
-
-@kopf.on.update("s3.hanse-merkur.de", "v1alpha1", "buckets")
-async def update_bucket(spec, old, new, meta, patch, logger, **_):
+    patch.status["owner"] = access_key["spec"]["owner"]
+    created = datetime.fromisoformat(meta["creationTimestamp"].replace("Z", "+00:00"))
+    BUCKET_TIME_TO_READY.observe((datetime.now(timezone.utc) - created).total_seconds())
+
+
+@kopf.on.update("s3.hanse-merkur.de", "v1alpha1", "buckets", when=is_owned)
+@instrument_handler("buckets", "update")
+async def update_bucket(
+    spec,
+    old,
+    new,
+    meta,
+    status,
+    patch,
+    logger,
+    users_by_name: kopf.Index,
+    access_keys_by_name: kopf.Index,
+    secrets_by_name: kopf.Index,
+    **_,
+):
     logger.debug("Updating bucket information")
 
-    if old["spec"]["bucketName"] != new["spec"]["bucketName"]:
-        raise kopf.PermanentError("Cannot change bucket name")
-    if old["spec"]["ownerAccessKey"] != new["spec"]["ownerAccessKey"]:
-        raise kopf.PermanentError("Cannot change owner")
-    if old["spec"]["objectLock"] != new["spec"]["objectLock"]:
-        raise kopf.PermanentError("Cannot change object locking post-creation")
+    error = immutable_bucket_changes(old["spec"], new["spec"])
+    if error:
+        raise kopf.PermanentError(error)
 
     bucket_name = spec["bucketName"]
-    bucket_policy = spec["bucketPolicy"]
     owner_access_key = spec["ownerAccessKey"]
-    life_cycle_policy = spec.get("lifeCyclePolicy", None)
-    object_lock = spec.get("objectLock", False)
-    object_lock_config_spec = spec.get("objectLockConfig", None)
-    quotas = spec.get("quotas", None)
     namespace = meta["namespace"]
-    if quotas and quotas["enabled"]:
-        max_objects = quotas["maxObjects"]
-        max_size = quotas["maxSize"]
-    else:
-        max_objects = -1
-        max_size = -1
-
-    if bucket_policy == "public":
-        # Standard public ACL from the AWS documentation.
-        # Allows read-only access to all objects
-        bucket_policy = PUBLIC_POLICY.copy()
-        bucket_policy["Statement"][0]["Resource"].append(
-            f"arn:aws:s3:::{bucket_name}/*"
-        )
-    elif bucket_policy == "custom" and "customBucketPolicy" in spec:
-        try:
-            bucket_policy = json.loads(spec["customBucketPolicy"])
-        except json.JSONDecodeError:
-            raise kopf.PermanentError("Failed to parse customBucketPolicy")
 
-    if life_cycle_policy is not None:
-        try:
-            life_cycle_policy = json.loads(life_cycle_policy)
-            # BUG https://github.com/ceph/ceph/pull/26518
-            for rule in life_cycle_policy["Rules"]:
-                if not hasattr(rule, "Prefix"):
-                    rule["Prefix"] = ""
-        except json.JSONDecodeError:
-            raise kopf.PermanentError("Failed to parse lifeCyclePolicy")
-
-    if object_lock and object_lock_config_spec is not None and old["objectLockConfig"] != new["objectLockConfig"]:
-        try:
-            object_lock_config = json.loads(object_lock_config_spec)
-        except json.JSONDecodeError:
-            raise kopf.PermanentError("Failed to parse objectLockConfig")
+    pending = pending_bucket_settings(desired_bucket_settings(spec), status)
+    if not pending:
+        logger.debug("Bucket %s is up to date", bucket_name)
+        patch.status["ready"] = True
+        return
 
-    api = HTTPClient(KubeConfig.from_env())
-    access_key = AccessKey.objects(api, namespace=namespace).get(
-        namespace=namespace, name=owner_access_key
-    )
-    if not access_key.exists():
+    access_key = await get_access_key(access_keys_by_name, namespace, owner_access_key)
+    if access_key is None:
         raise kopf.PermanentError("No such AccessKey exists")
-    access_key_secret = Secret.objects(api, namespace=namespace).get(
-        namespace=namespace, name=access_key.obj["spec"]["secretName"]
+    access_key_secret = await get_secret(
+        secrets_by_name, namespace, access_key["spec"]["secretName"]
     )
-    if not access_key_secret.exists():
+    if access_key_secret is None:
         raise kopf.PermanentError("No such Secret Access Key exists")
-    access_key_id = access_key_secret.get_secret("aws_access_key_id")
-    secret_access_key = access_key_secret.get_secret("aws_secret_access_key")
-
-    endpoint = getenv("OBJ_SERVER", "s3.hanse-merkur.de")
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=f"https://{endpoint}",
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=secret_access_key,
-    )
-
-    if bucket_policy in ["public", "custom"]:
-        s3.put_bucket_policy(Bucket=bucket_name, Policy=bucket_policy)
+    user = await get_user(users_by_name, access_key["spec"]["owner"])
+    if user is None:
+        raise kopf.PermanentError("Owner is not managed by Cluster")
 
-    if life_cycle_policy is not None:
-        response = s3.put_bucket_lifecycle_configuration(
-            Bucket=bucket_name, LifecycleConfiguration=life_cycle_policy
-        )
-        if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-            kopf.PermanentError("Invalid LifeCyclePolicy: %s", response)
-
-    if object_lock_config is not None:
-        response = s3.put_object_lock_configuration(
-            Bucket=bucket_name, ObjectLockConfiguration=object_lock_config
-        )
-
-    if old["objectVersioning"] != new["objectVersioning"]:
-        s3.put_bucket_versioning(
-            Bucket=bucket_name, VersioningConfiguration={"Status": "Enabled" if new["objectVersioning"] else "Disabled"}
-        )
-
-    rgw = RGWAdmin(**get_environment_creds())
-    rgw_bucket = await rgw.get_bucket(bucket=bucket_name)
-
-    if quotas and quotas["enabled"]:
-        await rgw.set_bucket_quota(
-            uid=rgw_bucket["owner"],
-            bucket=bucket_name,
-            max_size_kb=max_size,
-            max_objects=max_objects,
-            enabled=True,
-            )
+    s3 = await s3_client(access_key_secret)
+    await apply_bucket_settings(s3, bucket_name, get_rgw_user_id(user, tenant), pending, patch)
     patch.status["ready"] = True
 
 
-@kopf.on.delete("s3.hanse-merkur.de", "v1alpha1", "buckets")
-async def delete_bucket(spec, meta, annotations, logger, **_):
+@kopf.on.delete("s3.hanse-merkur.de", "v1alpha1", "buckets", when=is_owned)
+@instrument_handler("buckets", "delete")
+async def delete_bucket(
+    spec,
+    meta,
+    status,
+    annotations,
+    logger,
+    users_by_name: kopf.Index,
+    access_keys_by_name: kopf.Index,
+    secrets_by_name: kopf.Index,
+    **_,
+):
     bucket_name = spec["bucketName"]
     owner_access_key = spec["ownerAccessKey"]
     namespace = meta["namespace"]
 
     try:
-        api = HTTPClient(KubeConfig.from_env())
-        access_key = AccessKey.objects(api, namespace=namespace).get(
-            namespace=namespace, name=owner_access_key
-        )
-        if not access_key.exists():
+        access_key = await get_access_key(access_keys_by_name, namespace, owner_access_key)
+        if access_key is None:
             raise kopf.PermanentError("No such AccessKey exists")
 
         # Find the actual owner in the radosgw database
-        user = User.objects(api).get(name=access_key.obj["spec"]["owner"])
-        if not user.exists():
+        user = await get_user(users_by_name, access_key["spec"]["owner"])
+        if user is None:
             raise kopf.PermanentError("Owner is not managed by Cluster")
-        user_annotations = user.obj["metadata"]["annotations"]
-        if is_annotation_set(user_annotations, "skip-tenant"):
-            owner = user.obj["spec"]["userId"]
-        else:
-            owner = f"{tenant}-{user.obj['spec']['userId']}"
-
+        owner = get_rgw_user_id(user, tenant)
     except PyKubeError as e:
         raise kopf.TemporaryError(f"Failed to get kubernetes secrets due to error: {e}")
-    finally:
-        api.session.close()
 
+    forget_bucket(bucket_name)
     try:
-        rgw = RGWAdmin(**get_environment_creds())
+        rgw = get_rgw()
         if not is_annotation_set(annotations, "allow-deletion"):
             logger.info("Unlinking bucket %s from owner %s", bucket_name, owner)
             await rgw.unlink_bucket(bucket=bucket_name, uid=owner)
         else:
             logger.info("Permanently deleting bucket %s", bucket_name)
-            force_deletion = is_annotation_set(annotations, "force-deletion")
-            await rgw.remove_bucket(bucket=bucket_name, purge_objects=force_deletion)
+            if is_annotation_set(annotations, "force-deletion"):
+                await wait_for_purge(
+                    namespace, meta["name"], bucket_name, status, access_key, secrets_by_name
+                )
+            await rgw.remove_bucket(bucket=bucket_name, purge_objects=False)
     except BucketNotEmpty:
         raise kopf.PermanentError(
             "Cannot delete a non-empty bucket without force-deletion"
@@ -332,33 +359,329 @@ async def delete_bucket(spec, meta, annotations, logger, **_):
         pass
 
 
-def is_bucket_ready(body, **_) -> bool:
-    return body.status.get("ready", False)
+async def wait_for_purge(namespace, name, bucket_name, status, access_key, secrets_by_name):
+    """
+    Starts or follows the background purge of the bucket. Raises a
+    TemporaryError while the purge runs, which keeps the finalizer but
+    frees the handler until the next check
+    """
+    task = _purges.get(bucket_name)
+    if task is None:
+        secret = await get_secret(secrets_by_name, namespace, access_key["spec"]["secretName"])
+        if secret is None:
+            raise kopf.PermanentError("No such Secret Access Key exists")
+        s3 = await s3_client(secret)
+        task = start_background(
+            purge_bucket(namespace, name, bucket_name, s3, dict(status.get("purge") or {})),
+            name=f"purge-{bucket_name}",
+        )
+        _purges[bucket_name] = task
+    if not task.done():
+        raise kopf.TemporaryError(f"Purging bucket {bucket_name}", delay=purge_check_interval)
+    del _purges[bucket_name]
+    if task.cancelled() or task.exception() is not None:
+        reason = "cancelled" if task.cancelled() else task.exception()
+        raise kopf.TemporaryError(
+            f"Purge of bucket {bucket_name} failed: {reason}", delay=purge_check_interval
+        )
 
 
-@kopf.timer(
-    "s3.hanse-merkur.de",
-    "v1alpha1",
-    "buckets",
-    interval=60,
-    idle=120,
-    when=is_bucket_ready,
-)
-async def update_bucket_stats(spec, patch, **_):
+class PurgeProgress:
+    """
+    Counters of a bucket purge, continued from the last checkpoint
+    """
+
+    def __init__(self, checkpoint: dict, objects: int):
+        self.deleted = checkpoint.get("deleted", 0)
+        self.bytes_freed = checkpoint.get("bytesFreed", 0)
+        self.started_at = checkpoint.get("startedAt") or utc_now()
+        self.failed = 0
+        self.objects = objects
+        self._deleted_before = self.deleted
+        self._started = time.monotonic()
+
+    def record(self, deleted: int, freed: int, failed: int) -> None:
+        self.deleted += deleted
+        self.bytes_freed += freed
+        self.failed += failed
+        PURGE_OBJECTS.labels("deleted").inc(deleted)
+        PURGE_OBJECTS.labels("failed").inc(failed)
+        PURGE_BYTES.inc(freed)
+
+    def status(self, phase: str) -> dict:
+        deleted = self.deleted - self._deleted_before
+        return {
+            "phase": phase,
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "bytesFreed": self.bytes_freed,
+            "remaining": max(self.objects - deleted, 0),
+            "rate": round(deleted / max(time.monotonic() - self._started, 1e-3), 1),
+            "startedAt": self.started_at,
+            "updatedAt": utc_now(),
+        }
+
+
+async def purge_objects(s3, bucket_name: str, progress: PurgeProgress) -> None:
+    """
+    Lists all object versions and delete markers page by page and
+    deletes the pages with up to PURGE_CONCURRENCY multi-object deletes
+    in parallel
+    """
+    queue = asyncio.Queue(maxsize=purge_concurrency * 2)
+
+    async def list_versions():
+        markers = {}
+        while True:
+            page = await run_blocking(
+                "s3", s3.list_object_versions, Bucket=bucket_name, MaxKeys=1000, **markers
+            )
+            batch = [
+                ({"Key": v["Key"], "VersionId": v["VersionId"]}, v.get("Size", 0))
+                for v in page.get("Versions", []) + page.get("DeleteMarkers", [])
+            ]
+            if batch:
+                await queue.put(batch)
+            if not page.get("IsTruncated"):
+                break
+            markers = {
+                "KeyMarker": page["NextKeyMarker"],
+                "VersionIdMarker": page["NextVersionIdMarker"],
+            }
+        for _ in range(purge_concurrency):
+            await queue.put(None)
+
+    async def delete_versions():
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return
+            response = await run_blocking(
+                "s3",
+                s3.delete_objects,
+                Bucket=bucket_name,
+                Delete={"Objects": [obj for obj, _ in batch], "Quiet": True},
+            )
+            errors = {(e["Key"], e.get("VersionId")) for e in response.get("Errors", [])}
+            freed = sum(size for obj, size in batch if (obj["Key"], obj["VersionId"]) not in errors)
+            progress.record(len(batch) - len(errors), freed, len(errors))
+
+    tasks = [asyncio.create_task(list_versions())]
+    tasks.extend(asyncio.create_task(delete_versions()) for _ in range(purge_concurrency))
     try:
-        rgw = RGWAdmin(**get_environment_creds())
-        bucket = await rgw.get_bucket(bucket=spec["bucketName"], stats=True)
-        if not bucket:
-            logging.error(
-                "Bucket %s was deleted outside operator scope", spec["bucketName"]
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def abort_multipart_uploads(s3, bucket_name: str) -> None:
+    while True:
+        page = await run_blocking("s3", s3.list_multipart_uploads, Bucket=bucket_name)
+        for upload in page.get("Uploads", []):
+            await run_blocking(
+                "s3",
+                s3.abort_multipart_upload,
+                Bucket=bucket_name,
+                Key=upload["Key"],
+                UploadId=upload["UploadId"],
             )
+        if not page.get("IsTruncated"):
             return
-        if "stats" in bucket:
-            patch.status["size"] = bucket["rgw.main"]["size_kb"]
-            patch.status["objects"] = bucket["rgw.main"]["num_objects"]
 
-        if "bucket_quota" in bucket:
-            patch.status["maxSize"] = bucket["bucket_quota"]["max_size_kb"]
-            patch.status["maxObjects"] = bucket["bucket_quota"]["max_objects"]
+
+async def publish_purge_status(namespace: str, name: str, status: dict) -> None:
+    resource = Bucket(get_kube_api(), {"metadata": {"name": name, "namespace": namespace}})
+    try:
+        await run_blocking("kube", resource.patch, {"status": {"purge": status}})
+    except (PyKubeError, asyncio.TimeoutError) as e:
+        logging.warning("Failed to checkpoint purge of Bucket %s/%s: %s", namespace, name, e)
+
+
+async def purge_bucket(namespace: str, name: str, bucket_name: str, s3, checkpoint: dict) -> None:
+    """
+    Deletes all objects of the bucket and checkpoints the progress into
+    the Bucket status every PURGE_CHECKPOINT_INTERVAL seconds. A purge
+    interrupted by a restart continues with the counters of its last
+    checkpoint, and the listing starts at the first object not deleted yet
+    """
+    try:
+        stats = await get_rgw().get_bucket(bucket=bucket_name, stats=True)
+    except NoSuchBucket:
+        return
+    progress = PurgeProgress(
+        checkpoint, stats.get("usage", {}).get("rgw.main", {}).get("num_objects", 0)
+    )
+
+    async def checkpoint_progress():
+        while True:
+            await asyncio.sleep(purge_checkpoint_interval)
+            await publish_purge_status(namespace, name, progress.status("Purging"))
+
+    PURGES_RUNNING.inc()
+    checkpoints = asyncio.create_task(checkpoint_progress())
+    phase = "Failed"
+    try:
+        await purge_objects(s3, bucket_name, progress)
+        await abort_multipart_uploads(s3, bucket_name)
+        if not progress.failed:
+            phase = "Completed"
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchBucket":
+            raise
+        phase = "Completed"
     except asyncio.CancelledError:
-        pass
+        phase = "Interrupted"
+        raise
+    finally:
+        PURGES_RUNNING.dec()
+        checkpoints.cancel()
+        await publish_purge_status(namespace, name, progress.status(phase))
+    if progress.failed:
+        raise RuntimeError(f"{progress.failed} objects could not be deleted")
+
+
+@kopf.index("s3.hanse-merkur.de", "v1alpha1", "buckets", when=is_bucket_ready)
+def buckets_by_name(namespace, name, spec, **_):
+    return {spec["bucketName"]: (namespace, name)}
+
+
+def bucket_stats_status(bucket) -> dict:
+    """
+    Maps the radosgw bucket stats onto the Bucket status fields
+    """
+    status = {}
+    usage = bucket.get("usage", {}).get("rgw.main")
+    if usage:
+        status["size"] = usage["size_kb"]
+        status["objects"] = usage["num_objects"]
+    if "bucket_quota" in bucket:
+        status["maxSize"] = bucket["bucket_quota"]["max_size_kb"]
+        status["maxObjects"] = bucket["bucket_quota"]["max_objects"]
+    return status
+
+
+async def fetch_bucket_stats(rgw, due) -> Dict[str, dict]:
+    """
+    Fetches the stats of the due buckets one by one. Buckets that no
+    longer exist are left out
+    """
+
+    async def fetch(bucket_name):
+        try:
+            return await rgw.get_bucket(bucket=bucket_name, stats=True)
+        except NoSuchBucket:
+            return None
+
+    results = await asyncio.gather(*(fetch(bucket_name) for bucket_name in due))
+    return {bucket_name: bucket for bucket_name, bucket in zip(due, results) if bucket}
+
+
+@instrument_handler("buckets", "timer")
+async def collect_bucket_stats(buckets_by_name: kopf.Index):
+    """
+    Fetches the stats of the ready Bucket resources due for polling and
+    patches them into their status. From BUCKET_STATS_LISTING_MIN due
+    buckets on, a single listing of all buckets replaces the per-bucket calls
+    """
+    refs_by_name = {
+        bucket_name: [ref for ref in refs if is_owned(*ref)]
+        for bucket_name, refs in buckets_by_name.items()
+    }
+    refs_by_name = {bucket_name: refs for bucket_name, refs in refs_by_name.items() if refs}
+    bucket_stats_filter.retain(ref for refs in refs_by_name.values() for ref in refs)
+    bucket_stats_schedule.retain(refs_by_name)
+    bucket_snapshot.retain(ref for refs in refs_by_name.values() for ref in refs)
+
+    # A listing costs a single request however many buckets are due, so it
+    # is used whenever enough are due. Below the listing threshold every due
+    # bucket costs one request and the budget caps how many are polled
+    listing = bucket_stats_schedule.count_due(refs_by_name) >= bucket_stats_listing_min
+    available = stats_budget.available()
+    limit = (None if available else 0) if listing else available
+    due = bucket_stats_schedule.due(refs_by_name, limit=limit)
+    if not due:
+        return
+    rgw = get_rgw()
+    if listing:
+        stats_budget.take(1)
+        listing = await rgw.get_bucket(stats=True) or []
+        bucket_owners.update(listing)
+        all_stats = {b["bucket"]: b for b in listing}
+        # The listing covers every bucket, so the snapshot is refreshed for all
+        if bucket_snapshot.enabled:
+            for bucket_name, refs in refs_by_name.items():
+                bucket = all_stats.get(bucket_name)
+                if bucket:
+                    update_bucket_snapshot(refs, bucket)
+    else:
+        stats_budget.take(len(due))
+        all_stats = await fetch_bucket_stats(rgw, due)
+        for bucket_name, bucket in all_stats.items():
+            update_bucket_snapshot(refs_by_name[bucket_name], bucket)
+
+    updates = []
+    for bucket_name in due:
+        bucket = all_stats.get(bucket_name)
+        if not bucket:
+            logging.error("Bucket %s was deleted outside operator scope", bucket_name)
+            bucket_stats_schedule.observe(bucket_name, {})
+            continue
+        status = bucket_stats_status(bucket)
+        near_quota = is_near_quota(
+            status.get("size", 0), status.get("objects", 0), bucket.get("bucket_quota")
+        )
+        bucket_stats_schedule.observe(bucket_name, status, near_quota)
+        updates.extend(
+            publish_bucket_stats(namespace, name, status)
+            for namespace, name in refs_by_name[bucket_name]
+        )
+    await asyncio.gather(*updates)
+
+
+def update_bucket_snapshot(refs, bucket) -> None:
+    if not bucket_snapshot.enabled:
+        return
+    usage = bucket.get("usage", {}).get("rgw.main", {})
+    for namespace, name in refs:
+        bucket_snapshot.update(
+            (namespace, name),
+            usage_from_quota(
+                namespace,
+                name,
+                bucket.get("owner", ""),
+                usage.get("size_kb", 0),
+                usage.get("num_objects", 0),
+                bucket.get("bucket_quota"),
+            ),
+        )
+
+
+async def publish_bucket_stats(namespace: str, name: str, status: dict):
+    if not bucket_stats_filter.should_publish((namespace, name), status):
+        return
+    resource = Bucket(get_kube_api(), {"metadata": {"name": name, "namespace": namespace}})
+    try:
+        await run_blocking("kube", resource.patch, {"status": status})
+    except (PyKubeError, asyncio.TimeoutError) as e:
+        logging.warning("Failed to update stats of Bucket %s/%s: %s", namespace, name, e)
+    else:
+        bucket_stats_filter.published((namespace, name), status)
+
+
+async def run_bucket_stats_collector(buckets_by_name: kopf.Index):
+    while True:
+        await asyncio.sleep(bucket_stats_interval)
+        try:
+            await collect_bucket_stats(buckets_by_name)
+        except Exception:
+            logging.exception("Failed to collect bucket stats")
+
+
+@kopf.on.startup()
+async def start_bucket_stats_collector(buckets_by_name: kopf.Index, **_):
+    snapshot = await load_startup_snapshot()
+    if snapshot is not None:
+        for bucket_name, bucket in snapshot.buckets.items():
+            bucket_stats_schedule.seed(bucket_name, bucket_stats_status(bucket), first_poll_delay())
+    start_background(run_bucket_stats_collector(buckets_by_name), name="bucket-stats")
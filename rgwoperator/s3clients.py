@@ -0,0 +1,85 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from os import getenv
+from typing import Tuple
+
+import boto3
+from botocore.config import Config
+
+from metrics import S3_CLIENTS, S3_CLIENT_CACHE
+from utils import run_blocking
+
+s3_client_cache_size = int(getenv("S3_CLIENT_CACHE_SIZE", "128"))
+s3_pool_size = int(getenv("S3_POOL_SIZE", "10"))
+s3_max_attempts = int(getenv("S3_MAX_ATTEMPTS", "3"))
+s3_timeout = float(getenv("S3_TIMEOUT", "30"))
+
+# Clients share the service models loaded once by this session. Creating
+# clients from a session is not thread safe, hence the lock
+_session = boto3.session.Session()
+_session_lock = threading.Lock()
+_config = Config(
+    max_pool_connections=s3_pool_size,
+    retries={"mode": "standard", "max_attempts": s3_max_attempts},
+    connect_timeout=s3_timeout,
+    read_timeout=s3_timeout,
+)
+# (endpoint, access key id) -> (secret fingerprint, client)
+_clients: "OrderedDict[Tuple[str, str], Tuple[str, object]]" = OrderedDict()
+
+
+def s3_endpoint() -> str:
+    return getenv("S3_ENDPOINT_URL", f"https://{getenv('OBJ_SERVER', 's3.hanse-merkur.de')}")
+
+
+def _fingerprint(secret_access_key: str) -> str:
+    return hashlib.sha256(secret_access_key.encode()).hexdigest()
+
+
+def _create_client(endpoint: str, access_key_id: str, secret_access_key: str):
+    with _session_lock:
+        return _session.client(
+            "s3",
+            endpoint_url=endpoint,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            config=_config,
+        )
+
+
+async def s3_client(access_key_secret):
+    """
+    Returns the S3 client of the credentials in the Secret from a bounded
+    LRU keyed by endpoint and access key id. A client built from an older
+    version of the Secret is replaced
+    """
+    endpoint = s3_endpoint()
+    access_key_id = access_key_secret.get_secret("aws_access_key_id")
+    secret_access_key = access_key_secret.get_secret("aws_secret_access_key")
+    key = (endpoint, access_key_id)
+    fingerprint = _fingerprint(secret_access_key or "")
+    entry = _clients.get(key)
+    if entry is not None and entry[0] == fingerprint:
+        _clients.move_to_end(key)
+        S3_CLIENT_CACHE.labels("hit").inc()
+        return entry[1]
+    S3_CLIENT_CACHE.labels("miss" if entry is None else "invalidated").inc()
+    client = await run_blocking(
+        "s3", _create_client, endpoint, access_key_id, secret_access_key
+    )
+    S3_CLIENTS.inc()
+    _clients[key] = (fingerprint, client)
+    _clients.move_to_end(key)
+    # Evicted clients may still be in use, their pools close once released
+    while len(_clients) > s3_client_cache_size:
+        _clients.popitem(last=False)
+    return client
+
+
+def discard_s3_client(access_key_id: str) -> None:
+    """
+    Drops the clients of an access key that was removed from radosgw
+    """
+    for key in [key for key in _clients if key[1] == access_key_id]:
+        del _clients[key]
@@ -24,6 +24,12 @@ class Bucket(NamespacedAPIObject):
     kind = "Bucket"
 
 
+class Lease(NamespacedAPIObject):
+    version = "coordination.k8s.io/v1"
+    endpoint = "leases"
+    kind = "Lease"
+
+
 class Secret(BaseSecret):
     def get_secret(self, key: str) -> Optional[str]:
         """
@@ -3,15 +3,43 @@ import kopf
 import asyncio
 import logging
 
-from aiorgwadmin import RGWAdmin
 from aiorgwadmin.exceptions import NoSuchUser
-
-from utils import is_annotation_set, get_environment_creds
+from pykube.exceptions import PyKubeError
+
+from prometheus_client import start_http_server
+
+from exporter import register_exporter, usage_from_quota, user_snapshot
+from metrics import USER_STATS_SKIPPED, USER_STATS_SWEEP_DURATION, instrument_handler
+from profiling import disable_slow_callback_detection, enable_slow_callback_detection
+from s3struct import User
+from sharding import is_owned
+from stats import AdaptiveSchedule, StatusFilter, bucket_owners, is_near_quota, stats_budget
+from utils import (
+    is_annotation_set,
+    close_kube_api,
+    close_rgw,
+    connect_rgw,
+    get_kube_api,
+    get_rgw,
+    run_blocking,
+    shutdown_executors,
+    start_background,
+    stop_background,
+)
+from warmup import first_poll_delay, forget_user, load_startup_snapshot, user_exists
 
 tenant = getenv("TENANT", "dev")
+user_stats_interval = int(getenv("USER_STATS_INTERVAL", "60"))
+user_stats_concurrency = int(getenv("USER_STATS_CONCURRENCY", "16"))
+user_stats_deadline = float(getenv("USER_STATS_DEADLINE", "50"))
+metrics_port = int(getenv("METRICS_PORT", "9090"))
+
+user_stats_filter = StatusFilter("users")
+user_stats_schedule = AdaptiveSchedule("users", user_stats_interval)
 
 
-@kopf.on.create("s3.hanse-merkur.de", "v1alpha1", "user")
+@kopf.on.create("s3.hanse-merkur.de", "v1alpha1", "user", when=is_owned)
+@instrument_handler("users", "create")
 async def create_user_on_demand(spec, patch, annotations, **_):
     user_id = spec["userId"]
     contact_name = spec["contactName"]
@@ -34,9 +62,10 @@ async def create_user_on_demand(spec, patch, annotations, **_):
     else:
         rgw_user_id = f"{tenant}-{user_id}"
 
-    rgw = RGWAdmin(**get_environment_creds())
+    rgw = get_rgw()
     try:
-        await rgw.get_user(uid=rgw_user_id)
+        if not user_exists(rgw_user_id):
+            await rgw.get_user(uid=rgw_user_id)
         if not allow_import:
             patch.status["ready"] = False
             raise kopf.PermanentError(
@@ -63,7 +92,8 @@ async def create_user_on_demand(spec, patch, annotations, **_):
     patch.status["ready"] = True
 
 
-@kopf.on.update("s3.hanse-merkur.de", "v1alpha1", "user")
+@kopf.on.update("s3.hanse-merkur.de", "v1alpha1", "user", when=is_owned)
+@instrument_handler("users", "update")
 async def update_user(spec, old, new, annotations, logger, **_):
     if old["spec"]["userId"] != new["spec"]["userId"]:
         raise kopf.PermanentError("UserId cannot be changed inflight")
@@ -85,7 +115,7 @@ async def update_user(spec, old, new, annotations, logger, **_):
     else:
         max_buckets, max_size, max_objects = (None, None, None)
 
-    rgw = RGWAdmin(**get_environment_creds())
+    rgw = get_rgw()
     if max_buckets:
         await rgw.modify_user(uid=rgw_user_id, display_name=contact_name, suspended=suspended, max_buckets=max_buckets)
     else:
@@ -105,7 +135,8 @@ async def update_user(spec, old, new, annotations, logger, **_):
         await rgw.set_user_quota(uid=rgw_user_id, quota_type="user", enabled=False)
 
 
-@kopf.on.delete("s3.hanse-merkur.de", "v1alpha1", "user")
+@kopf.on.delete("s3.hanse-merkur.de", "v1alpha1", "user", when=is_owned)
+@instrument_handler("users", "delete")
 async def delete_user(spec, annotations, status, **_):
     user_id = spec["userId"]
     allow_deletion = is_annotation_set(annotations, "allow-deletion")
@@ -122,7 +153,8 @@ async def delete_user(spec, annotations, status, **_):
     if not status["ready"]:
         return
 
-    rgw = RGWAdmin(**get_environment_creds())
+    forget_user(rgw_user_id)
+    rgw = get_rgw()
     try:
         await rgw.remove_user(uid=rgw_user_id, purge_data=True)
         # No response. At all. Thanks
@@ -134,32 +166,142 @@ def is_user_ready(body, **_) -> bool:
     return body.status.get("ready", False)
 
 
-@kopf.timer(
-    "s3.hanse-merkur.de", "v1alpha1", "user", interval=60, idle=120, when=is_user_ready
-)
-async def update_user_stats(spec, patch, annotations, **_):
+@kopf.index("s3.hanse-merkur.de", "v1alpha1", "user", when=is_user_ready)
+def users_by_rgw_id(name, spec, annotations, **_):
+    if is_annotation_set(annotations, "skip-tenant"):
+        return {spec["userId"]: name}
+    return {f"{tenant}-{spec['userId']}": name}
+
+
+@instrument_handler("users", "timer")
+async def collect_user_stats(users_by_rgw_id: kopf.Index):
+    """
+    Sweeps the stats of all operator managed users due for polling
+    concurrently and patches them into the User resources. Users not
+    finished within the sweep deadline are retried on the next sweep
+    """
+    rgw = get_rgw()
+    managed = {
+        uid: [name for name in names if is_owned(name=name)]
+        for uid, names in users_by_rgw_id.items()
+    }
+    managed = {uid: names for uid, names in managed.items() if names}
+    user_stats_filter.retain(name for names in managed.values() for name in names)
+    user_stats_schedule.retain(managed)
+    user_snapshot.retain(name for names in managed.values() for name in names)
+
+    # Bucket counts come from the latest bucket stats listing. Without a
+    # recent one, the buckets of each due user are listed without stats
+    bucket_counts = bucket_owners.counts()
+    calls_per_user = 1 if bucket_counts is not None else 2
+    # One user listing is needed besides the per-user calls
+    limit = max(stats_budget.available() - 1, 0) // calls_per_user
+    due = user_stats_schedule.due(managed, limit=limit)
+    if not due:
+        return
+    stats_budget.take(len(due) * calls_per_user + 1)
+
+    rgw_user_ids = {
+        uid for uid in await rgw.get_users() or []
+        if uid.startswith(f"{tenant}-") or uid in managed
+    }
+
+    for uid in managed.keys() - rgw_user_ids:
+        logging.error("Observing non-existant user %s", uid)
+        user_stats_schedule.observe(uid, {})
+
+    semaphore = asyncio.Semaphore(user_stats_concurrency)
+
+    async def fetch(uid):
+        async with semaphore:
+            user = await rgw.get_user(uid=uid, stats=True)
+            if bucket_counts is not None:
+                return uid, user, bucket_counts[uid]
+            return uid, user, len(await rgw.get_bucket(uid=uid) or [])
+
+    tasks = [asyncio.create_task(fetch(uid)) for uid in due if uid in rgw_user_ids]
+    if not tasks:
+        return
     try:
-        rgw = RGWAdmin(**get_environment_creds())
-        user_id = spec["userId"]
-
-        if is_annotation_set(annotations, "skip-tenant"):
-            rgw_user_id = user_id
-        else:
-            rgw_user_id = f"{tenant}-{user_id}"
-
-        try:
-            user = await rgw.get_user(rgw_user_id, stats=True)
-            patch.status["buckets"] = len(rgw.get_bucket(uid=rgw_user_id))
-            patch.status["objects"] = user["stats"]["num_objects"]
-            patch.status["sizeInKb"] = user["stats"]["size_kb"]
-        except NoSuchUser:
-            logging.error("Observing non-existant user %s", rgw_user_id)
-    except asyncio.CancelledError:
-        # Timer was cancelled during runtime. Just give up
-        pass
+        done, pending = await asyncio.wait(tasks, timeout=user_stats_deadline)
+    finally:
+        # Also reached when the sweep itself is cancelled on shutdown
+        for task in tasks:
+            task.cancel()
+    if pending:
+        USER_STATS_SKIPPED.inc(len(pending))
+        logging.warning("User stats sweep skipped %d users after deadline", len(pending))
+
+    updates = []
+    for task in done:
+        if task.exception():
+            logging.error("Failed to fetch user stats: %s", task.exception())
+            continue
+        uid, user, buckets = task.result()
+        status = {
+            "buckets": buckets,
+            "objects": user["stats"]["num_objects"],
+            "sizeInKb": user["stats"]["size_kb"],
+        }
+        near_quota = is_near_quota(
+            status["sizeInKb"], status["objects"], user.get("user_quota")
+        )
+        user_stats_schedule.observe(uid, status, near_quota)
+        if user_snapshot.enabled:
+            quota = user.get("user_quota")
+            for name in managed[uid]:
+                user_snapshot.update(
+                    name,
+                    usage_from_quota("", name, uid, status["sizeInKb"], status["objects"], quota),
+                )
+        updates.extend(publish_user_stats(name, status) for name in managed[uid])
+    await asyncio.gather(*updates)
+
+
+async def publish_user_stats(name: str, status: dict):
+    if not user_stats_filter.should_publish(name, status):
+        return
+    resource = User(get_kube_api(), {"metadata": {"name": name}})
+    try:
+        await run_blocking("kube", resource.patch, {"status": status})
+    except (PyKubeError, asyncio.TimeoutError) as e:
+        logging.warning("Failed to update stats of User %s: %s", name, e)
+    else:
+        user_stats_filter.published(name, status)
+
+
+async def run_user_stats_sweep(users_by_rgw_id: kopf.Index):
+    while True:
+        await asyncio.sleep(user_stats_interval)
+        with USER_STATS_SWEEP_DURATION.time():
+            try:
+                await collect_user_stats(users_by_rgw_id)
+            except Exception:
+                logging.exception("Failed to sweep user stats")
 
 
 @kopf.on.startup()
-def configure(settings: kopf.OperatorSettings, **_):
+async def configure(settings: kopf.OperatorSettings, users_by_rgw_id: kopf.Index, **_):
     logging.getLogger("rgwadmin.rgw").setLevel(logging.INFO)
     logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    register_exporter()
+    watchdog = enable_slow_callback_detection()
+    if watchdog is not None:
+        start_background(watchdog.heartbeat(), name="loop-watchdog")
+    start_http_server(metrics_port)
+    connect_rgw()
+    snapshot = await load_startup_snapshot()
+    if snapshot is not None:
+        # First polls are spread instead of all falling due at once
+        for uid, status in snapshot.user_stats().items():
+            user_stats_schedule.seed(uid, status, first_poll_delay())
+    start_background(run_user_stats_sweep(users_by_rgw_id), name="user-stats")
+
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+    await stop_background()
+    disable_slow_callback_detection()
+    await close_rgw()
+    close_kube_api()
+    shutdown_executors()
@@ -0,0 +1,380 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import socket
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from os import getenv
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import kopf
+from pykube.exceptions import PyKubeError
+
+from metrics import SHARD_HANDOFFS, SHARD_MEMBERS, SHARDS_HELD, add_handler_hook
+from s3struct import AccessKey, Bucket, Lease, User
+from utils import get_kube_api, run_blocking, start_background
+
+sharding_enabled = getenv("SHARDING", "false").lower() == "true"
+shard_count = int(getenv("SHARD_COUNT", "32"))
+shard_namespace = getenv("SHARD_NAMESPACE") or getenv("POD_NAMESPACE", "default")
+shard_identity = getenv("POD_NAME") or socket.gethostname()
+shard_lease_seconds = int(getenv("SHARD_LEASE_SECONDS", "30"))
+shard_renew_interval = float(getenv("SHARD_RENEW_INTERVAL", "10"))
+# Outcomes of finished handlers are still being patched for a moment
+shard_release_grace = float(getenv("SHARD_RELEASE_GRACE", "5"))
+
+LEASE_LABEL = "s3.hanse-merkur.de/lease"
+SHARD_PREFIX = "rgwoperator-shard-"
+RING_POINTS = 64
+
+# Shard leases held by this replica and the subset accepting new reconciles
+_held: Set[int] = set()
+_accepting: Set[int] = set()
+_renewed = 0.0
+# Handler runs in progress and the time the last run finished, by (namespace, name)
+_running: Counter = Counter()
+_finished: Dict[Tuple[Optional[str], Optional[str]], float] = {}
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+def shard_of(namespace: Optional[str], name: str) -> int:
+    return _hash(f"{namespace or ''}/{name}") % shard_count
+
+
+class ShardRing:
+    """
+    Consistent hash ring of the live replicas. A joining or leaving
+    replica only moves the shards next to its points on the ring
+    """
+
+    def __init__(self, members: Iterable[str]):
+        self._points = sorted(
+            (_hash(f"{member}#{i}"), member) for member in set(members) for i in range(RING_POINTS)
+        )
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, shard: int) -> Optional[str]:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, _hash(f"shard-{shard}")) % len(self._points)
+        return self._points[index][1]
+
+
+def _is_fresh() -> bool:
+    # Stop before the leases can expire for the other replicas
+    return time.monotonic() - _renewed < shard_lease_seconds - shard_renew_interval
+
+
+def is_owned(namespace: Optional[str] = None, name: Optional[str] = None, **_) -> bool:
+    """
+    Filter of all resource handlers: whether this replica reconciles the
+    object. Always true without sharding
+    """
+    if not sharding_enabled:
+        return True
+    return shard_of(namespace, name) in _accepting and _is_fresh()
+
+
+def owns_shard(shard: int) -> bool:
+    """
+    Whether this replica runs the cluster-wide work assigned to a shard
+    """
+    return not sharding_enabled or (shard in _accepting and _is_fresh())
+
+
+@contextmanager
+def handling(namespace: Optional[str], name: Optional[str]):
+    """
+    Records a handler run of the object, so its shard is not handed off
+    while kopf may still be persisting the outcome
+    """
+    key = (namespace, name)
+    _running[key] += 1
+    try:
+        yield
+    finally:
+        _running[key] -= 1
+        if not _running[key]:
+            del _running[key]
+        _finished[key] = time.monotonic()
+
+
+def reconciling(grace: float) -> Set[Tuple[Optional[str], Optional[str]]]:
+    """
+    Returns the objects with a handler running or finished within the
+    last `grace` seconds
+    """
+    cutoff = time.monotonic() - grace
+    for key in [key for key, finished in _finished.items() if finished < cutoff]:
+        del _finished[key]
+    return set(_running) | set(_finished)
+
+
+def may_persist(body) -> bool:
+    """
+    Handler state is only written for owned objects and for objects whose
+    handlers are still finishing while their shard is handed off
+    """
+    metadata = body.get("metadata", {})
+    key = (metadata.get("namespace"), metadata.get("name"))
+    if is_owned(*key):
+        return True
+    return shard_of(*key) in _held and key in reconciling(shard_release_grace)
+
+
+class ShardProgressStorage(kopf.SmartProgressStorage):
+    def store(self, *, key, record, body, patch) -> None:
+        if may_persist(body):
+            super().store(key=key, record=record, body=body, patch=patch)
+
+    def purge(self, *, key, body, patch) -> None:
+        if may_persist(body):
+            super().purge(key=key, body=body, patch=patch)
+
+    def touch(self, *, body, patch, value) -> None:
+        if may_persist(body):
+            super().touch(body=body, patch=patch, value=value)
+
+
+class ShardDiffBaseStorage(kopf.AnnotationsDiffBaseStorage):
+    """
+    Objects skipped by other replicas keep their last handled state, so
+    the owner still sees the change
+    """
+
+    def store(self, *, body, patch, essence) -> None:
+        if may_persist(body):
+            super().store(body=body, patch=patch, essence=essence)
+
+
+def hold_finalizer(namespace=None, name=None, **_):
+    """
+    Unfiltered deletion handler. Without it the other replicas would
+    remove the finalizer of objects they do not own
+    """
+    if not is_owned(namespace, name):
+        raise kopf.TemporaryError("Deleted by the owning replica", delay=shard_lease_seconds)
+
+
+if sharding_enabled:
+    # Without sharding nothing reads the handler runs, so they are not recorded
+    add_handler_hook(handling)
+    for _plural in ("user", "accesskeys", "buckets"):
+        kopf.on.delete("s3.hanse-merkur.de", "v1alpha1", _plural, id="shard-guard")(hold_finalizer)
+
+
+def _micro_time(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _is_expired(lease: dict, now: datetime) -> bool:
+    spec = lease.get("spec", {})
+    if not spec.get("holderIdentity") or not spec.get("renewTime"):
+        return True
+    renewed = datetime.fromisoformat(spec["renewTime"].replace("Z", "+00:00"))
+    duration = spec.get("leaseDurationSeconds", shard_lease_seconds)
+    return renewed + timedelta(seconds=duration) < now
+
+
+def _lease_spec(holder: Optional[str], now: datetime) -> dict:
+    return {
+        "holderIdentity": holder,
+        "leaseDurationSeconds": shard_lease_seconds,
+        "renewTime": _micro_time(now),
+    }
+
+
+def _write_lease(name: str, role: str, current: Optional[dict], spec: dict) -> None:
+    """
+    Creates the lease or updates it guarded by its resourceVersion, so
+    two replicas racing for a shard cannot both win
+    """
+    api = get_kube_api()
+    if current is None:
+        Lease(
+            api,
+            {
+                "metadata": {"name": name, "namespace": shard_namespace, "labels": {LEASE_LABEL: role}},
+                "spec": spec,
+            },
+        ).create()
+        return
+    lease = Lease(api, current)
+    lease.patch(
+        {"metadata": {"resourceVersion": current["metadata"]["resourceVersion"]}, "spec": spec}
+    )
+
+
+def _list_leases(role: str) -> List[dict]:
+    query = Lease.objects(get_kube_api(), namespace=shard_namespace).filter(
+        selector={LEASE_LABEL: role}
+    )
+    return [lease.obj for lease in query]
+
+
+async def balance_shards() -> Set[int]:
+    """
+    Renews the membership of this replica, then acquires, renews or
+    releases the shard leases so every shard ends up with its owner on
+    the ring. Shards are released only once no handler of their objects
+    is running. Returns the shards gained
+    """
+    global _renewed
+    now = datetime.now(timezone.utc)
+    leases = await run_blocking("kube", _list_leases, "member")
+    members = {lease["metadata"]["name"]: lease for lease in leases}
+    member_name = f"rgwoperator-member-{shard_identity}"
+    await run_blocking(
+        "kube",
+        _write_lease,
+        member_name,
+        "member",
+        members.get(member_name),
+        _lease_spec(shard_identity, now),
+    )
+    alive = {
+        lease["spec"]["holderIdentity"]
+        for name, lease in members.items()
+        if name != member_name and not _is_expired(lease, now)
+    }
+    ring = ShardRing(alive | {shard_identity})
+    SHARD_MEMBERS.set(len(alive) + 1)
+
+    leases = {
+        int(lease["metadata"]["name"][len(SHARD_PREFIX):]): lease
+        for lease in await run_blocking("kube", _list_leases, "shard")
+        if lease["metadata"]["name"][len(SHARD_PREFIX):].isdigit()
+    }
+    busy = {shard_of(*key) for key in reconciling(shard_release_grace) if key[1] is not None}
+    gained = set()
+    for shard in range(shard_count):
+        name, lease = f"{SHARD_PREFIX}{shard}", leases.get(shard)
+        holder = (lease or {}).get("spec", {}).get("holderIdentity")
+        wanted = ring.owner(shard) == shard_identity
+        try:
+            if holder == shard_identity and not _is_expired(lease, now):
+                if wanted:
+                    _accepting.add(shard)
+                else:
+                    # Drain first: stop accepting, release once idle
+                    _accepting.discard(shard)
+                    if shard not in busy:
+                        _held.discard(shard)
+                        await run_blocking(
+                            "kube", _write_lease, name, "shard", lease, _lease_spec(None, now)
+                        )
+                        SHARD_HANDOFFS.labels("released").inc()
+                        continue
+                await run_blocking(
+                    "kube", _write_lease, name, "shard", lease, _lease_spec(shard_identity, now)
+                )
+                _held.add(shard)
+            elif wanted and (lease is None or _is_expired(lease, now)):
+                await run_blocking(
+                    "kube", _write_lease, name, "shard", lease, _lease_spec(shard_identity, now)
+                )
+                _held.add(shard)
+                _accepting.add(shard)
+                gained.add(shard)
+                SHARD_HANDOFFS.labels("acquired").inc()
+            else:
+                _held.discard(shard)
+                _accepting.discard(shard)
+        except PyKubeError as e:
+            # Lost a race for the lease, or the API server is unavailable
+            logging.warning("Failed to update lease of shard %d: %s", shard, e)
+            _accepting.discard(shard)
+    _renewed = time.monotonic()
+    SHARDS_HELD.set(len(_held))
+    return gained
+
+
+def objects_in_shards(shards: Set[int], **indexes: kopf.Index) -> List[Tuple[type, Optional[str], str]]:
+    """
+    Resolves the Users, AccessKeys and Buckets of the shards from the caches
+    """
+    objects = [
+        (User, None, name) for name in indexes["users_by_name"] if shard_of(None, name) in shards
+    ]
+    objects.extend(
+        (AccessKey, namespace, name)
+        for namespace, name in indexes["access_keys_by_name"]
+        if shard_of(namespace, name) in shards
+    )
+    objects.extend(
+        (Bucket, namespace, name)
+        for (namespace, _), names in indexes["buckets_by_access_key"].items()
+        for name in names
+        if shard_of(namespace, name) in shards
+    )
+    return objects
+
+
+async def touch_objects(settings: kopf.OperatorSettings, objects) -> None:
+    """
+    Touches the objects of gained shards, so kopf re-checks them against
+    their last handled state and resumes changes the previous owner
+    skipped or did not finish
+    """
+    value = datetime.now(timezone.utc).isoformat()
+    semaphore = asyncio.Semaphore(8)
+
+    async def touch(kind, namespace, name):
+        body = {"metadata": {"name": name, "namespace": namespace, "annotations": {}}}
+        patch = kopf.Patch()
+        settings.persistence.progress_storage.touch(body=kopf.Body(body), patch=patch, value=value)
+        if not patch:
+            return
+        async with semaphore:
+            try:
+                await run_blocking("kube", kind(get_kube_api(), body).patch, dict(patch))
+            except PyKubeError as e:
+                logging.warning("Failed to touch %s %s: %s", kind.kind, name, e)
+
+    await asyncio.gather(*(touch(*obj) for obj in objects))
+
+
+async def run_shard_balancer(settings: kopf.OperatorSettings, **indexes: kopf.Index):
+    while True:
+        await asyncio.sleep(shard_renew_interval)
+        try:
+            gained = await balance_shards()
+            if gained:
+                logging.info("Acquired shards %s", sorted(gained))
+                await touch_objects(settings, objects_in_shards(gained, **indexes))
+        except Exception:
+            logging.exception("Failed to balance shards")
+
+
+@kopf.on.startup()
+async def start_sharding(
+    settings: kopf.OperatorSettings,
+    users_by_name: kopf.Index,
+    access_keys_by_name: kopf.Index,
+    buckets_by_access_key: kopf.Index,
+    **_,
+):
+    if not sharding_enabled:
+        return
+    # Replicas split the objects instead of pausing each other
+    settings.peering.standalone = True
+    settings.persistence.progress_storage = ShardProgressStorage()
+    settings.persistence.diffbase_storage = ShardDiffBaseStorage()
+    # The initial listing after startup covers the shards acquired now
+    await balance_shards()
+    logging.info("Replica %s holds shards %s", shard_identity, sorted(_held))
+    start_background(
+        run_shard_balancer(
+            settings,
+            users_by_name=users_by_name,
+            access_keys_by_name=access_keys_by_name,
+            buckets_by_access_key=buckets_by_access_key,
+        ),
+        name="shard-balancer",
+    )
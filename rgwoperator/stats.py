@@ -0,0 +1,192 @@
+import time
+from collections import Counter
+from os import getenv
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from metrics import STATS_POLLS, STATUS_PATCHES
+
+stats_absolute_threshold = float(getenv("STATS_ABSOLUTE_THRESHOLD", "0"))
+stats_relative_threshold = float(getenv("STATS_RELATIVE_THRESHOLD", "0"))
+stats_max_staleness = float(getenv("STATS_MAX_STALENESS", "900"))
+stats_max_interval = float(getenv("STATS_MAX_INTERVAL", "1800"))
+stats_near_quota = float(getenv("STATS_NEAR_QUOTA", "0.9"))
+rgw_stats_budget = int(getenv("RGW_STATS_BUDGET", "1200"))
+stats_status_mirror = getenv("STATS_STATUS_MIRROR", "true").lower() == "true"
+stats_status_min_interval = float(getenv("STATS_STATUS_MIN_INTERVAL", "0"))
+
+
+def is_significant(old, new) -> bool:
+    """
+    A change is significant if it exceeds either the absolute or the
+    relative threshold. Non-numeric values are significant on any change
+    """
+    if old == new:
+        return False
+    if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+        return True
+    delta = abs(new - old)
+    if delta > stats_absolute_threshold:
+        return True
+    return stats_relative_threshold > 0 and delta > stats_relative_threshold * abs(old)
+
+
+class StatusFilter:
+    """
+    Remembers the stats last published into the status of each resource
+    and suppresses patches that carry no significant change, unless the
+    published values are older than STATS_MAX_STALENESS. Patches within
+    STATS_STATUS_MIN_INTERVAL of the previous one are always suppressed
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._published: Dict[Hashable, Tuple[float, dict]] = {}
+
+    def should_publish(self, key: Hashable, status: dict) -> bool:
+        if not stats_status_mirror:
+            return False
+        last = self._published.get(key)
+        if last is None:
+            return True
+        age = time.monotonic() - last[0]
+        if age < stats_status_min_interval:
+            STATUS_PATCHES.labels(self.kind, "suppressed").inc()
+            return False
+        if age >= stats_max_staleness:
+            return True
+        if any(is_significant(last[1].get(k), v) for k, v in status.items()):
+            return True
+        STATUS_PATCHES.labels(self.kind, "suppressed").inc()
+        return False
+
+    def published(self, key: Hashable, status: dict) -> None:
+        self._published[key] = (time.monotonic(), dict(status))
+        STATUS_PATCHES.labels(self.kind, "emitted").inc()
+
+    def retain(self, keys: Iterable[Hashable]) -> None:
+        """
+        Drops the memory of resources that no longer exist
+        """
+        keys = set(keys)
+        for key in self._published.keys() - keys:
+            del self._published[key]
+
+
+def is_near_quota(size_kb: int, objects: int, quota: Optional[dict]) -> bool:
+    if not quota or not quota.get("enabled"):
+        return False
+    for used, limit in ((size_kb, quota.get("max_size_kb")), (objects, quota.get("max_objects"))):
+        if limit and limit > 0 and used >= stats_near_quota * limit:
+            return True
+    return False
+
+
+class AdaptiveSchedule:
+    """
+    Tracks a polling interval per resource. The interval doubles while
+    the stats stay unchanged, up to STATS_MAX_INTERVAL, and drops back to
+    the minimum as soon as they change or approach the quota
+    """
+
+    def __init__(self, kind: str, min_interval: float):
+        self.kind = kind
+        self.min_interval = min_interval
+        self._entries: Dict[Hashable, Tuple[float, float, dict]] = {}
+
+    def due(self, keys: Iterable[Hashable], limit: Optional[int] = None) -> List[Hashable]:
+        """
+        Returns the resources due for polling, most overdue first
+        """
+        now = time.monotonic()
+        due = []
+        for key in keys:
+            entry = self._entries.get(key)
+            due_at = entry[1] if entry else 0.0
+            if due_at <= now:
+                due.append((due_at, key))
+        due.sort(key=lambda item: item[0])
+        if limit is not None and len(due) > limit:
+            STATS_POLLS.labels(self.kind, "deferred").inc(len(due) - limit)
+            due = due[:limit]
+        STATS_POLLS.labels(self.kind, "polled").inc(len(due))
+        return [key for _, key in due]
+
+    def count_due(self, keys: Iterable[Hashable]) -> int:
+        """
+        Returns how many resources are due for polling, without polling them
+        """
+        now = time.monotonic()
+        return sum(1 for key in keys if key not in self._entries or self._entries[key][1] <= now)
+
+    def seed(self, key: Hashable, sample: dict, delay: float) -> None:
+        """
+        Schedules the first poll of a resource whose stats are already known
+        """
+        self._entries[key] = (self.min_interval, time.monotonic() + delay, dict(sample))
+
+    def observe(self, key: Hashable, sample: dict, near_quota: bool = False) -> None:
+        entry = self._entries.get(key)
+        if entry is None or near_quota or entry[2] != sample:
+            interval = self.min_interval
+        else:
+            interval = min(entry[0] * 2, max(stats_max_interval, self.min_interval))
+        self._entries[key] = (interval, time.monotonic() + interval, dict(sample))
+
+    def retain(self, keys: Iterable[Hashable]) -> None:
+        keys = set(keys)
+        for key in self._entries.keys() - keys:
+            del self._entries[key]
+
+
+class RequestBudget:
+    """
+    Caps the number of requests of one kind sent to radosgw per minute
+    """
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._window = time.monotonic()
+        self._used = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if now - self._window >= 60:
+            self._window = now
+            self._used = 0
+
+    def available(self) -> int:
+        self._refill()
+        return self.per_minute - self._used
+
+    def take(self, wanted: int) -> int:
+        self._refill()
+        granted = max(0, min(wanted, self.per_minute - self._used))
+        self._used += granted
+        return granted
+
+
+class BucketOwners:
+    """
+    Bucket counts per owner from the latest full bucket listing, so the
+    user stats do not need a listing of their own
+    """
+
+    def __init__(self):
+        self._counts: Optional[Counter] = None
+        self._listed = 0.0
+
+    def update(self, buckets: Iterable[dict]) -> None:
+        self._counts = Counter(b.get("owner", "") for b in buckets)
+        self._listed = time.monotonic()
+
+    def counts(self) -> Optional[Counter]:
+        """
+        Returns the counts unless the listing is older than STATS_MAX_STALENESS
+        """
+        if self._counts is None or time.monotonic() - self._listed >= stats_max_staleness:
+            return None
+        return self._counts
+
+
+stats_budget = RequestBudget(rgw_stats_budget)
+bucket_owners = BucketOwners()
@@ -0,0 +1,63 @@
+import hashlib
+from collections import OrderedDict
+from os import getenv
+from typing import Dict
+
+from jinja2 import BaseLoader, Template
+from jinja2.sandbox import SandboxedEnvironment
+
+from metrics import TEMPLATE_CACHE
+from profiling import span
+
+template_cache_size = int(getenv("TEMPLATE_CACHE_SIZE", "256"))
+
+# Keys written by the operator itself, never rendered from the template
+CREDENTIAL_KEYS = ("aws_access_key_id", "aws_secret_access_key")
+
+_environment = SandboxedEnvironment(loader=BaseLoader())
+_compiled: "OrderedDict[str, Template]" = OrderedDict()
+
+
+def compile_template(source: str) -> Template:
+    """
+    Returns the compiled template from a bounded LRU keyed by the source
+    hash. Raises jinja2.TemplateSyntaxError for invalid templates
+    """
+    key = hashlib.sha256(source.encode()).hexdigest()
+    template = _compiled.get(key)
+    if template is not None:
+        _compiled.move_to_end(key)
+        TEMPLATE_CACHE.labels("hit").inc()
+        return template
+    TEMPLATE_CACHE.labels("miss").inc()
+    template = _environment.from_string(source)
+    _compiled[key] = template
+    if len(_compiled) > template_cache_size:
+        _compiled.popitem(last=False)
+    return template
+
+
+def compile_templates(template_data: Dict[str, str]) -> Dict[str, Template]:
+    return {
+        key: compile_template(source)
+        for key, source in template_data.items()
+        if key not in CREDENTIAL_KEYS
+    }
+
+
+def render_templates(
+    templates: Dict[str, Template], access_key_id: str, secret_access_key: str
+) -> Dict[str, str]:
+    """
+    Renders the secret data entries. The credentials are available both
+    directly and below `data`, as in the Secret itself
+    """
+    credentials = {
+        "aws_access_key_id": access_key_id,
+        "aws_secret_access_key": secret_access_key,
+    }
+    rendered = {}
+    for key, template in templates.items():
+        with span("jinja", key):
+            rendered[key] = template.render(data=credentials, **credentials)
+    return rendered
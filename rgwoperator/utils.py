@@ -1,4 +1,37 @@
+import asyncio
+import functools
+import inspect
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import aiohttp
+from aiorgwadmin import RGWAdmin
+from pykube import HTTPClient, KubeConfig
+from pykube.http import KubernetesHTTPAdapter
+
+from admission import admit, configure_admission
+from metrics import RGW_IN_FLIGHT, RGW_POOL_CONNECTIONS, RGW_POOL_WAIT, track_call
+
+rgw_pool_size = int(os.getenv("RGW_POOL_SIZE", "32"))
+rgw_max_in_flight = int(os.getenv("RGW_MAX_IN_FLIGHT", "64"))
+rgw_keepalive_timeout = float(os.getenv("RGW_KEEPALIVE_TIMEOUT", "30"))
+rgw_timeout = float(os.getenv("RGW_TIMEOUT", "30"))
+blocking_io_workers = int(os.getenv("BLOCKING_IO_WORKERS", "16"))
+blocking_io_timeout = float(os.getenv("BLOCKING_IO_TIMEOUT", "30"))
+
+_rgw_clients: Dict[str, "PooledRGWAdmin"] = {}
+_background_tasks: Set[asyncio.Task] = set()
+_kube_api: Optional[HTTPClient] = None
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_rgw_operation: ContextVar[Optional[str]] = ContextVar("rgw_operation", default=None)
+
+configure_admission("rgw", rgw_max_in_flight)
+configure_admission("s3", blocking_io_workers)
+
 
 def is_annotation_set(annotations, key: str) -> bool:
     return (
@@ -12,4 +45,170 @@ def get_environment_creds():
             'secret_key': os.environ['OBJ_SECRET_ACCESS_KEY'],
             'server': os.environ['OBJ_SERVER'],
             'secure': 'OBJ_SECURE' in os.environ,
-            'verify': 'OBJ_VERIFY' in os.environ}
\ No newline at end of file
+            'verify': 'OBJ_VERIFY' in os.environ}
+
+
+class PooledRGWAdmin(RGWAdmin):
+    """
+    RGWAdmin client sharing one bounded keep-alive connection pool.
+    Requests above max_in_flight wait for a free slot instead of
+    opening additional connections to radosgw.
+    """
+
+    def __init__(self, pool_size: int, max_in_flight: int, keepalive_timeout: float, **kwargs):
+        super().__init__(**kwargs)
+        self._connector = aiohttp.TCPConnector(
+            limit=pool_size, keepalive_timeout=keepalive_timeout
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector, skip_auto_headers=self._skip_auto_headers
+        )
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def request(self, method, request, headers=None, data=None):
+        async with admit("rgw"):
+            return await self._pooled_request(method, request, headers, data)
+
+    async def _pooled_request(self, method, request, headers, data):
+        started = time.monotonic()
+        async with self._in_flight:
+            RGW_POOL_WAIT.labels(self._server).observe(time.monotonic() - started)
+            RGW_IN_FLIGHT.labels(self._server).inc()
+            try:
+                with track_call("rgw", _rgw_operation.get() or method):
+                    return await super().request(method, request, headers=headers, data=data)
+            finally:
+                RGW_IN_FLIGHT.labels(self._server).dec()
+                self._update_pool_metrics()
+
+    def _update_pool_metrics(self) -> None:
+        # aiohttp does not expose the pool occupancy publicly
+        active = len(self._connector._acquired)
+        idle = sum(len(conns) for conns in self._connector._conns.values())
+        RGW_POOL_CONNECTIONS.labels(self._server, "active").set(active)
+        RGW_POOL_CONNECTIONS.labels(self._server, "idle").set(idle)
+
+
+def _named_operation(name: str, method: Callable) -> Callable:
+    """
+    Labels the admin requests issued by an RGWAdmin method with its name.
+    Nested calls keep the name of the outermost method
+    """
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if _rgw_operation.get() is not None:
+            return await method(self, *args, **kwargs)
+        token = _rgw_operation.set(name)
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            _rgw_operation.reset(token)
+
+    return wrapper
+
+
+for _name, _method in inspect.getmembers(RGWAdmin, inspect.iscoroutinefunction):
+    if not _name.startswith("_") and _name not in ("request", "close"):
+        setattr(PooledRGWAdmin, _name, _named_operation(_name, _method))
+
+
+def connect_rgw() -> PooledRGWAdmin:
+    """
+    Create the shared RGW admin client for the configured endpoint.
+    Must be called from within the operator event loop
+    """
+    creds = get_environment_creds()
+    client = _rgw_clients.get(creds["server"])
+    if client is None:
+        client = PooledRGWAdmin(
+            pool_size=rgw_pool_size,
+            max_in_flight=rgw_max_in_flight,
+            keepalive_timeout=rgw_keepalive_timeout,
+            timeout=aiohttp.ClientTimeout(total=rgw_timeout),
+            **creds,
+        )
+        _rgw_clients[creds["server"]] = client
+    return client
+
+
+def get_rgw() -> PooledRGWAdmin:
+    """
+    Returns the shared RGW admin client
+    """
+    return _rgw_clients.get(os.environ["OBJ_SERVER"]) or connect_rgw()
+
+
+async def close_rgw() -> None:
+    while _rgw_clients:
+        _, client = _rgw_clients.popitem()
+        await client.close()
+
+
+def get_kube_api() -> HTTPClient:
+    """
+    Returns the shared Kubernetes API client
+    """
+    global _kube_api
+    if _kube_api is None:
+        config = KubeConfig.from_env()
+        _kube_api = HTTPClient(config)
+        # One pooled connection per executor thread instead of the default 10
+        adapter = KubernetesHTTPAdapter(config, pool_maxsize=blocking_io_workers)
+        _kube_api.session.mount("https://", adapter)
+        _kube_api.session.mount("http://", adapter)
+    return _kube_api
+
+
+def close_kube_api() -> None:
+    global _kube_api
+    if _kube_api is not None:
+        _kube_api.session.close()
+        _kube_api = None
+
+
+async def run_blocking(backend: str, fn: Callable, *args, **kwargs):
+    """
+    Runs a blocking pykube or boto3 call on a bounded executor dedicated
+    to the backend, so slow calls never stall the event loop or calls
+    to other backends. Raises asyncio.TimeoutError after BLOCKING_IO_TIMEOUT.
+    S3 calls pass the admission layer first
+    """
+    executor = _executors.get(backend)
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=blocking_io_workers, thread_name_prefix=f"{backend}-io"
+        )
+        _executors[backend] = executor
+    loop = asyncio.get_running_loop()
+    async with admit(backend):
+        future = loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+        with track_call(backend, getattr(fn, "__name__", "call")):
+            return await asyncio.wait_for(future, blocking_io_timeout)
+
+
+def shutdown_executors() -> None:
+    while _executors:
+        _, executor = _executors.popitem()
+        executor.shutdown(wait=False)
+
+
+def start_background(coro: Awaitable, name: str) -> asyncio.Task:
+    """
+    Run an operator-wide background loop until cleanup
+    """
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def stop_background() -> None:
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from os import getenv
+from typing import Callable, Dict, Optional
+
+import kopf
+from jinja2 import TemplateSyntaxError
+
+from bucketspec import immutable_bucket_changes
+from metrics import VALIDATION_CACHE, VALIDATIONS
+from templates import compile_templates
+
+webhook_enabled = getenv("WEBHOOK", "false").lower() == "true"
+webhook_port = int(getenv("WEBHOOK_PORT", "9443"))
+# Service name under which the API server reaches the operator
+webhook_host = getenv("WEBHOOK_HOST")
+webhook_cert_dir = getenv("WEBHOOK_CERT_DIR", "/etc/rgwoperator/webhook")
+validation_cache_size = int(getenv("VALIDATION_CACHE_SIZE", "1024"))
+
+# Content hash -> rejection message, None for valid content
+_results: "OrderedDict[str, Optional[str]]" = OrderedDict()
+
+
+def _is_strings(value) -> bool:
+    if isinstance(value, str):
+        return True
+    return isinstance(value, list) and bool(value) and all(isinstance(v, str) for v in value)
+
+
+def check_bucket_policy(policy) -> Optional[str]:
+    if not isinstance(policy, dict):
+        return "must be a JSON object"
+    statements = policy.get("Statement")
+    if isinstance(statements, dict):
+        statements = [statements]
+    if not isinstance(statements, list) or not statements:
+        return "Statement must be a non-empty list"
+    for i, statement in enumerate(statements):
+        if not isinstance(statement, dict):
+            return f"Statement {i} must be an object"
+        if statement.get("Effect") not in ("Allow", "Deny"):
+            return f"Effect of statement {i} must be Allow or Deny"
+        for field in ("Action", "Resource"):
+            value = statement.get(field, statement.get(f"Not{field}"))
+            if not _is_strings(value):
+                return f"{field} of statement {i} must be a string or a list of strings"
+    return None
+
+
+LIFECYCLE_ACTIONS = (
+    "Expiration",
+    "Transition",
+    "Transitions",
+    "NoncurrentVersionExpiration",
+    "NoncurrentVersionTransition",
+    "NoncurrentVersionTransitions",
+    "AbortIncompleteMultipartUpload",
+)
+
+
+def check_lifecycle(lifecycle) -> Optional[str]:
+    if not isinstance(lifecycle, dict):
+        return "must be a JSON object"
+    rules = lifecycle.get("Rules")
+    if not isinstance(rules, list) or not rules:
+        return "Rules must be a non-empty list"
+    for i, rule in enumerate(rules):
+        if not isinstance(rule, dict):
+            return f"Rule {i} must be an object"
+        if rule.get("Status") not in ("Enabled", "Disabled"):
+            return f"Status of rule {i} must be Enabled or Disabled"
+        if not any(action in rule for action in LIFECYCLE_ACTIONS):
+            return f"Rule {i} has no action"
+    return None
+
+
+def check_object_lock(config) -> Optional[str]:
+    if not isinstance(config, dict):
+        return "must be a JSON object"
+    if config.get("ObjectLockEnabled", "Enabled") != "Enabled":
+        return "ObjectLockEnabled must be Enabled"
+    if "Rule" not in config:
+        return None
+    retention = config["Rule"].get("DefaultRetention") if isinstance(config["Rule"], dict) else None
+    if not isinstance(retention, dict):
+        return "Rule must contain a DefaultRetention object"
+    if retention.get("Mode") not in ("GOVERNANCE", "COMPLIANCE"):
+        return "Mode of the DefaultRetention must be GOVERNANCE or COMPLIANCE"
+    periods = [retention[field] for field in ("Days", "Years") if field in retention]
+    if len(periods) != 1 or not isinstance(periods[0], int) or periods[0] <= 0:
+        return "DefaultRetention must set either Days or Years to a positive number"
+    return None
+
+
+# The JSON string fields of a Bucket spec and the check of their content
+BUCKET_JSON_FIELDS: Dict[str, Callable[[object], Optional[str]]] = {
+    "customBucketPolicy": check_bucket_policy,
+    "lifeCyclePolicy": check_lifecycle,
+    "objectLockConfig": check_object_lock,
+}
+
+
+def validate_bucket_spec(spec, old_spec) -> Optional[str]:
+    """
+    Checks the fields the bucket handlers would otherwise only reject
+    while reconciling, in the same order as they are applied
+    """
+    if old_spec is not None:
+        error = immutable_bucket_changes(old_spec, spec)
+        if error:
+            return error
+    for field, check in BUCKET_JSON_FIELDS.items():
+        if field not in spec:
+            continue
+        if field == "customBucketPolicy" and spec.get("bucketPolicy") != "custom":
+            continue
+        if field == "objectLockConfig" and not spec.get("objectLock", False):
+            continue
+        try:
+            value = json.loads(spec[field])
+        except (TypeError, json.JSONDecodeError) as e:
+            return f"Failed to parse {field}: {e}"
+        error = check(value)
+        if error:
+            return f"Invalid {field}: {error}"
+    return None
+
+
+def validate_access_key_spec(spec, old_spec) -> Optional[str]:
+    template_data = (spec.get("template") or {}).get("data")
+    if template_data:
+        try:
+            compile_templates(template_data)
+        except TemplateSyntaxError as e:
+            return f"Invalid template at line {e.lineno}: {e.message}"
+    return None
+
+
+def memoized(kind: str, validate, spec, old_spec) -> Optional[str]:
+    """
+    Returns the validation result from a bounded LRU keyed by the hash of
+    the validated content, so repeated applies of a manifest are free
+    """
+    content = json.dumps([kind, spec, old_spec], sort_keys=True, default=str)
+    key = hashlib.sha256(content.encode()).hexdigest()
+    if key in _results:
+        _results.move_to_end(key)
+        VALIDATION_CACHE.labels("hit").inc()
+        return _results[key]
+    VALIDATION_CACHE.labels("miss").inc()
+    result = validate(spec, old_spec)
+    _results[key] = result
+    if len(_results) > validation_cache_size:
+        _results.popitem(last=False)
+    return result
+
+
+def admit(kind: str, validate, spec, old, operation) -> None:
+    if operation not in ("CREATE", "UPDATE"):
+        return
+    old_spec = dict((old or {}).get("spec") or {}) if operation == "UPDATE" else None
+    spec = dict(spec or {})
+    # Status and metadata patches leave the spec untouched
+    if old_spec == spec:
+        return
+    error = memoized(kind, validate, spec, old_spec)
+    VALIDATIONS.labels(kind, "denied" if error else "allowed").inc()
+    if error:
+        raise kopf.AdmissionError(error, code=422)
+
+
+def validate_bucket(spec, old, operation, **_):
+    admit("buckets", validate_bucket_spec, spec, old, operation)
+
+
+def validate_access_key(spec, old, operation, **_):
+    admit("accesskeys", validate_access_key_spec, spec, old, operation)
+
+
+# kopf refuses to start with admission handlers but no webhook server.
+# Failures are ignored, the handlers still reject invalid specs
+if webhook_enabled:
+    kopf.on.validate("s3.hanse-merkur.de", "v1alpha1", "buckets", ignore_failures=True)(
+        validate_bucket
+    )
+    kopf.on.validate("s3.hanse-merkur.de", "v1alpha1", "accesskeys", ignore_failures=True)(
+        validate_access_key
+    )
+
+
+@kopf.on.startup()
+def configure_webhook(settings: kopf.OperatorSettings, **_):
+    """
+    Serves the validating webhook and keeps its configuration in the
+    cluster up to date
+    """
+    if not webhook_enabled:
+        return
+    settings.admission.server = kopf.WebhookServer(
+        port=webhook_port,
+        host=webhook_host,
+        certfile=os.path.join(webhook_cert_dir, "tls.crt"),
+        pkeyfile=os.path.join(webhook_cert_dir, "tls.key"),
+        cafile=os.path.join(webhook_cert_dir, "ca.crt"),
+    )
+    settings.admission.managed = "rgwoperator.s3.hanse-merkur.de"
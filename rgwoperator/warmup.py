@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+from os import getenv
+from typing import Dict, List, Optional, Set
+
+from metrics import STARTUP_RGW_CALLS, STARTUP_SECONDS, STARTUP_SNAPSHOT_HITS
+from stats import bucket_owners
+from utils import get_rgw, start_background
+
+startup_page_size = int(getenv("STARTUP_PAGE_SIZE", "1000"))
+startup_poll_spread = float(getenv("STARTUP_POLL_SPREAD", "300"))
+
+# Roughly the start of the operator process
+_started = time.monotonic()
+_loading: Optional[asyncio.Task] = None
+_snapshot: Optional["StartupSnapshot"] = None
+# Lookups that missed the snapshot until the end of the startup phase
+_in_startup = True
+_misses = 0
+
+
+class StartupSnapshot:
+    """
+    RadosGW users and bucket stats as listed at startup. Only positive
+    lookups are answered from it: a user or bucket missing here may have
+    been created since and is still looked up in radosgw
+    """
+
+    def __init__(self, users: Set[str], buckets: Dict[str, dict]):
+        self.users = users
+        self.buckets = buckets
+
+    def user_stats(self) -> Dict[str, dict]:
+        """
+        Derives the User status of each bucket owner from the bucket usage
+        """
+        stats = defaultdict(lambda: {"buckets": 0, "objects": 0, "sizeInKb": 0})
+        for bucket in self.buckets.values():
+            usage = bucket.get("usage", {}).get("rgw.main", {})
+            entry = stats[bucket.get("owner", "")]
+            entry["buckets"] += 1
+            entry["objects"] += usage.get("num_objects", 0)
+            entry["sizeInKb"] += usage.get("size_kb", 0)
+        return {uid: stats[uid] for uid in self.users}
+
+
+async def list_rgw_metadata(rgw, section: str, page_size: int) -> List[str]:
+    """
+    Pages through the metadata listing of the users or buckets
+    """
+    keys, marker = [], None
+    while True:
+        page = await rgw.get_metadata(section, max_entries=page_size, marker=marker)
+        keys.extend(page["keys"])
+        if not page.get("truncated"):
+            return keys
+        marker = page["marker"]
+
+
+async def _load() -> Optional[StartupSnapshot]:
+    global _snapshot
+    rgw = get_rgw()
+    try:
+        users, buckets = await asyncio.gather(
+            list_rgw_metadata(rgw, "user", startup_page_size), rgw.get_bucket(stats=True)
+        )
+    except Exception as e:
+        # Startup goes on without, every lookup then goes to radosgw
+        logging.warning("Failed to load the startup snapshot of radosgw: %s", e)
+        users, buckets = None, None
+    if users is not None:
+        bucket_owners.update(buckets or [])
+        _snapshot = StartupSnapshot(set(users), {b["bucket"]: b for b in buckets or []})
+        logging.info(
+            "Loaded startup snapshot of %d users and %d buckets",
+            len(_snapshot.users),
+            len(_snapshot.buckets),
+        )
+    start_background(end_startup(), name="startup")
+    return _snapshot
+
+
+async def load_startup_snapshot() -> Optional[StartupSnapshot]:
+    """
+    Lists all users and buckets with a few paginated admin calls. Called
+    by every startup handler that needs the snapshot, loaded only once
+    """
+    global _loading
+    if _loading is None:
+        _loading = asyncio.ensure_future(_load())
+    return await asyncio.shield(_loading)
+
+
+async def end_startup() -> None:
+    """
+    Drops the snapshot once the first stats polls spread over
+    STARTUP_POLL_SPREAD are done, and reports the startup phase
+    """
+    global _snapshot, _in_startup
+    await asyncio.sleep(startup_poll_spread)
+    _snapshot = None
+    _in_startup = False
+    STARTUP_SECONDS.set(time.monotonic() - _started)
+    logging.info(
+        "Startup finished after %.0fs, %d lookups missed the snapshot",
+        time.monotonic() - _started,
+        _misses,
+    )
+
+
+def first_poll_delay() -> float:
+    return random.uniform(0, startup_poll_spread)
+
+
+def _missed(kind: str) -> None:
+    """
+    Counts a lookup that goes to radosgw during the startup phase
+    """
+    global _misses
+    if _in_startup:
+        _misses += 1
+        STARTUP_RGW_CALLS.labels(kind).inc()
+
+
+def user_exists(uid: str) -> bool:
+    if _snapshot is None or uid not in _snapshot.users:
+        _missed("user")
+        return False
+    STARTUP_SNAPSHOT_HITS.labels("user").inc()
+    return True
+
+
+def bucket_metadata(bucket_name: str) -> Optional[dict]:
+    """
+    Returns the bucket in the shape of its metadata entry, if listed at
+    startup
+    """
+    if _snapshot is None or bucket_name not in _snapshot.buckets:
+        _missed("bucket")
+        return None
+    STARTUP_SNAPSHOT_HITS.labels("bucket").inc()
+    bucket = _snapshot.buckets[bucket_name]
+    return {
+        "key": f"bucket:{bucket_name}",
+        "data": {
+            "owner": bucket.get("owner", ""),
+            "bucket": {"name": bucket_name, "bucket_id": bucket["id"]},
+        },
+    }
+
+
+def forget_user(uid: str) -> None:
+    if _snapshot is not None:
+        _snapshot.users.discard(uid)
+
+
+def forget_bucket(bucket_name: str) -> None:
+    if _snapshot is not None:
+        _snapshot.buckets.pop(bucket_name, None)
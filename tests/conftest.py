@@ -0,0 +1,58 @@
+import copy
+import os
+import sys
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CRD_DIR = os.path.join(ROOT, "deployment", "helm", "crds")
+
+# The operator modules import each other by their plain names, as under kopf run
+sys.path.insert(0, os.path.join(ROOT, "rgwoperator"))
+
+os.environ.setdefault("OBJ_SERVER", "rgw.test")
+os.environ.setdefault("OBJ_ACCESS_KEY_ID", "admin")
+os.environ.setdefault("OBJ_SECRET_ACCESS_KEY", "admin")
+# No rate limits, the tests measure the event loop and not the admission layer
+os.environ.setdefault("RGW_RATE_LIMIT", "0")
+os.environ.setdefault("S3_RATE_LIMIT", "0")
+
+
+def _merge(target: dict, patch: dict) -> dict:
+    # JSON merge patch, None removes the field
+    result = copy.deepcopy(target)
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge(result[key], value)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+
+def _prune(value, schema: dict):
+    # Drops the fields a structural schema does not declare, like the API server
+    if not isinstance(value, dict) or schema.get("x-kubernetes-preserve-unknown-fields"):
+        return value
+    if isinstance(schema.get("additionalProperties"), dict):
+        return {key: _prune(item, schema["additionalProperties"]) for key, item in value.items()}
+    properties = schema.get("properties", {})
+    return {key: _prune(item, properties[key]) for key, item in value.items() if key in properties}
+
+
+@pytest.fixture
+def store_status():
+    """
+    Returns the status the API server stores for a status patch of a
+    resource of the CRD file, so tests see which fields survive pruning
+    """
+
+    def store(crd_file: str, status: dict, patch: dict) -> dict:
+        with open(os.path.join(CRD_DIR, crd_file)) as f:
+            crd = yaml.safe_load(f)
+        schema = crd["spec"]["versions"][0]["schema"]["openAPIV3Schema"]
+        return _prune(_merge(status, patch), schema["properties"]["status"])
+
+    return store
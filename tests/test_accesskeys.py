@@ -0,0 +1,245 @@
+"""
+Create retries, rotation decisions and resumed rotations of AccessKeys
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import kopf
+import pytest
+from aiorgwadmin.exceptions import InvalidAccessKey
+from pykube.exceptions import HTTPError
+
+import s3accesskeys
+import utils
+
+NOW = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+EARLIER = (NOW - timedelta(hours=1)).isoformat()
+LATER = (NOW + timedelta(hours=1)).isoformat()
+
+USER = {
+    "apiVersion": "s3.hanse-merkur.de/v1alpha1",
+    "kind": "User",
+    "metadata": {"name": "alice", "uid": "alice-uid", "annotations": {}},
+    "spec": {"userId": "alice"},
+}
+
+
+class FakeRGW:
+    def __init__(self):
+        # Access key id -> radosgw user id
+        self.keys = {}
+
+    async def create_key(self, uid, access_key, secret_key, generate_key):
+        self.keys[access_key] = uid
+        return [{"access_key": key} for key, owner in self.keys.items() if owner == uid]
+
+    async def remove_key(self, access_key, uid):
+        if self.keys.get(access_key) != uid:
+            raise InvalidAccessKey("InvalidAccessKey")
+        del self.keys[access_key]
+
+    async def get_user(self, access_key):
+        if access_key not in self.keys:
+            raise InvalidAccessKey("InvalidAccessKey")
+        return {"user_id": self.keys[access_key]}
+
+
+class FakeSecrets:
+    """
+    Secrets by name, failing the first `failures` writes
+    """
+
+    def __init__(self, failures=0):
+        self.secrets = {}
+        self.failures = failures
+
+    def write(self, secret):
+        if self.failures:
+            self.failures -= 1
+            raise HTTPError(500, "etcdserver: request timed out")
+        new = s3accesskeys.Secret.new(None, secret.name, "test")
+        stored = self.secrets.setdefault(secret.name, new)
+        stored.obj["data"].update(secret.obj["data"])
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    rgw = FakeRGW()
+    secrets = FakeSecrets()
+
+    async def get_user(index, name):
+        return USER
+
+    async def get_secret(index, namespace, name):
+        return secrets.secrets.get(name)
+
+    monkeypatch.setattr(s3accesskeys, "get_rgw", lambda: rgw)
+    monkeypatch.setattr(s3accesskeys, "get_kube_api", lambda: None)
+    monkeypatch.setattr(s3accesskeys, "get_user", get_user)
+    monkeypatch.setattr(s3accesskeys, "get_secret", get_secret)
+    secret = s3accesskeys.Secret
+    monkeypatch.setattr(secret, "create", lambda self: secrets.write(self), raising=False)
+    monkeypatch.setattr(secret, "patch", lambda self, _: secrets.write(self), raising=False)
+    # Only available inside a kopf handler
+    monkeypatch.setattr(kopf, "adopt", lambda obj: None)
+    yield rgw, secrets
+    utils.shutdown_executors()
+
+
+def add_access_key(status):
+    """
+    Runs one attempt of the handler and returns its patch and the
+    TemporaryError it was retried for, if any
+    """
+    patch = kopf.Patch()
+    try:
+        asyncio.run(
+            s3accesskeys.add_access_key(
+                meta={"name": "alice", "namespace": "test"},
+                spec={"owner": "alice", "secretName": "alice"},
+                status=status,
+                logger=logging.getLogger("test"),
+                patch=patch,
+                users_by_name={},
+                secrets_by_name={},
+            )
+        )
+    except kopf.TemporaryError as e:
+        return patch, e
+    return patch, None
+
+
+def test_retry_removes_key_of_failed_secret_write(backends, store_status):
+    rgw, secrets = backends
+    secrets.failures = 1
+
+    first, error = add_access_key({})
+    assert error is not None
+    status = store_status("s3accesskeys.yml", {}, first["status"])
+    orphan = status["pendingAccessKeyId"]
+    assert orphan in rgw.keys
+
+    second, error = add_access_key(status)
+    assert error is None
+    status = store_status("s3accesskeys.yml", status, second["status"])
+    assert "pendingAccessKeyId" not in status
+    assert list(rgw.keys) == [status["accessKeyId"]]
+    assert secrets.secrets["alice"].get_secret("aws_access_key_id") == status["accessKeyId"]
+
+
+def test_delete_removes_pending_key(backends, store_status):
+    rgw, secrets = backends
+    secrets.failures = 1
+    first, _ = add_access_key({})
+    status = store_status("s3accesskeys.yml", {}, first["status"])
+
+    asyncio.run(
+        s3accesskeys.delete_access_key(spec={"owner": "alice"}, status=status, users_by_name={})
+    )
+    assert rgw.keys == {}
+
+
+def entry(requested=None, rotate_after_days=None, created=NOW - timedelta(days=10)):
+    spec = {"owner": "alice", "secretName": "alice"}
+    if rotate_after_days is not None:
+        spec["rotateAfterDays"] = rotate_after_days
+    return {"spec": spec, "requested": requested, "created": created.isoformat(), "status": {}}
+
+
+@pytest.mark.parametrize(
+    "entry, status, action",
+    [
+        (entry(), {}, None),
+        (entry(requested="1"), {}, "rotate"),
+        (entry(requested="1"), {"rotation": {"phase": "Completed", "requested": "1"}}, None),
+        (entry(requested="2"), {"rotation": {"phase": "Completed", "requested": "1"}}, "rotate"),
+        (entry(rotate_after_days=7), {}, "rotate"),
+        (entry(rotate_after_days=30), {}, None),
+        (entry(rotate_after_days=7), {"keyCreatedAt": (NOW - timedelta(days=1)).isoformat()}, None),
+        (
+            entry(requested="2"),
+            {"rotation": {"phase": "Overlap", "removeAfter": LATER}},
+            None,
+        ),
+        (
+            entry(),
+            {"rotation": {"phase": "Overlap", "removeAfter": EARLIER}},
+            "expire",
+        ),
+    ],
+)
+def test_rotation_action(entry, status, action):
+    assert s3accesskeys.rotation_action(entry, status, NOW) == action
+
+
+def test_rotation_state_overlays_written_status_until_indexed(monkeypatch):
+    monkeypatch.setattr(s3accesskeys, "_written_rotations", {})
+    key = ("test", "alice")
+    stale = entry(requested="1")
+    stale["status"] = {"accessKeyId": "OLD"}
+    written = {
+        "accessKeyId": "NEW",
+        "rotation": {
+            "phase": "Overlap",
+            "requested": "1",
+            "removeAfter": (NOW + timedelta(hours=1)).isoformat(),
+        },
+    }
+    s3accesskeys._written_rotations[key] = written
+
+    # The index has not seen the rotation yet, so it must not rotate again
+    status = s3accesskeys.rotation_state(key, stale)
+    assert status == written
+    assert s3accesskeys.rotation_action(stale, status, NOW) is None
+
+    indexed = entry(requested="1")
+    indexed["status"] = written
+    assert s3accesskeys.rotation_state(key, indexed) == written
+    assert key not in s3accesskeys._written_rotations
+
+
+def rotate(monkeypatch):
+    patched = []
+
+    async def patch_rotation_status(key, status):
+        patched.append(status)
+
+    monkeypatch.setattr(s3accesskeys, "patch_rotation_status", patch_rotation_status)
+    asyncio.run(
+        s3accesskeys.rotate_access_key(
+            ("test", "alice"), entry(requested="1"), {"accessKeyId": "OLD"}, {}, {}
+        )
+    )
+    return patched[0]
+
+
+def test_rotation_creates_new_key(backends, monkeypatch):
+    rgw, secrets = backends
+    rgw.keys["OLD"] = "dev-alice"
+    secret = s3accesskeys.Secret.new(None, "alice", "test")
+    secret.set_secret("aws_access_key_id", "OLD")
+    secret.set_secret("aws_secret_access_key", "old-secret")
+    secrets.secrets["alice"] = secret
+
+    status = rotate(monkeypatch)
+    new = status["accessKeyId"]
+    assert new != "OLD"
+    assert set(rgw.keys) == {"OLD", new}
+    assert secret.get_secret("aws_access_key_id") == new
+    assert status["rotation"]["previousAccessKeyId"] == "OLD"
+
+
+def test_rotation_resumes_key_already_in_secret(backends, monkeypatch):
+    rgw, secrets = backends
+    # An earlier rotation wrote NEW into the Secret but not into the status
+    rgw.keys.update({"OLD": "dev-alice", "NEW": "dev-alice"})
+    secret = s3accesskeys.Secret.new(None, "alice", "test")
+    secret.set_secret("aws_access_key_id", "NEW")
+    secret.set_secret("aws_secret_access_key", "new-secret")
+    secrets.secrets["alice"] = secret
+
+    status = rotate(monkeypatch)
+    assert status["accessKeyId"] == "NEW"
+    assert status["rotation"]["previousAccessKeyId"] == "OLD"
+    assert set(rgw.keys) == {"OLD", "NEW"}
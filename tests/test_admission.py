@@ -0,0 +1,234 @@
+"""
+Token bucket, adaptive concurrency limit and circuit breaker of the
+admission layer, on a fake clock
+"""
+import asyncio
+import types
+
+import pytest
+from aiorgwadmin.exceptions import NoSuchBucket, ServerDown
+from botocore.exceptions import ClientError
+
+import admission
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(admission.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def client_error(code, status):
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "PutObject"
+    )
+
+
+def test_token_bucket_allows_burst_then_paces_calls(clock):
+    bucket = admission.TokenBucket(rate=10, burst=2)
+
+    async def acquire(n):
+        for _ in range(n):
+            await bucket.acquire()
+
+    asyncio.run(acquire(2))
+    assert clock.sleeps == []
+    asyncio.run(acquire(2))
+    assert clock.sleeps == [0.1, 0.1]
+
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = admission.TokenBucket(rate=10, burst=2)
+
+    async def acquire(n):
+        for _ in range(n):
+            await bucket.acquire()
+
+    asyncio.run(acquire(2))
+    clock.now += 60
+    asyncio.run(acquire(3))
+    # The idle minute refilled the burst only
+    assert clock.sleeps == [0.1]
+
+
+def test_token_bucket_without_rate_never_waits(clock):
+    bucket = admission.TokenBucket(rate=0, burst=0)
+
+    async def acquire():
+        for _ in range(100):
+            await bucket.acquire()
+
+    asyncio.run(acquire())
+    assert clock.sleeps == []
+
+
+def test_adaptive_limit_decreases_at_most_once_per_latency_target(clock):
+    limit = admission.AdaptiveLimit(minimum=2, maximum=10, latency_target=1)
+    limit.observe(0.1, overloaded=True)
+    assert limit.limit == pytest.approx(7)
+    # Calls failing together count as one congestion signal
+    limit.observe(5, overloaded=False)
+    assert limit.limit == pytest.approx(7)
+
+    for expected in (4.9, 3.43, 2.401, 2, 2):
+        clock.now += 1
+        limit.observe(5, overloaded=False)
+        assert limit.limit == pytest.approx(expected)
+
+
+def test_adaptive_limit_increases_by_about_one_per_round_trip(clock):
+    limit = admission.AdaptiveLimit(minimum=1, maximum=10, latency_target=1)
+    limit.limit = 4.0
+    for _ in range(4):
+        limit.observe(0.1, overloaded=False)
+    assert 4.9 < limit.limit < 5
+    for _ in range(1000):
+        limit.observe(0.1, overloaded=False)
+    assert limit.limit == 10
+
+
+def test_adaptive_limit_hands_released_slots_to_waiters_in_order():
+    limit = admission.AdaptiveLimit(minimum=1, maximum=1, latency_target=1)
+    order = []
+
+    async def call(i):
+        await limit.acquire()
+        order.append(i)
+        await asyncio.sleep(0)
+        limit.release()
+
+    async def run():
+        await asyncio.gather(*(call(i) for i in range(5)))
+
+    asyncio.run(run())
+    assert order == [0, 1, 2, 3, 4]
+    assert limit.in_flight == 0
+    assert limit.waiting == 0
+
+
+def test_circuit_breaker_opens_after_consecutive_failures(clock):
+    breaker = admission.CircuitBreaker(threshold=3, reset_timeout=30)
+    breaker.record(True)
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == "closed"
+    breaker.record(True)
+    assert breaker.state == "open"
+    assert not breaker.enter()
+    assert 30 <= breaker.retry_delay() <= 60
+
+
+def test_circuit_breaker_probes_once_when_half_open(clock):
+    breaker = admission.CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.record(True)
+    clock.now += 30
+    assert breaker.state == "half_open"
+    assert breaker.enter()
+    # Only the probe is let through
+    assert breaker.state == "open"
+    assert not breaker.enter()
+
+    breaker.record(False)
+    assert breaker.state == "closed"
+    assert breaker.enter()
+
+
+def test_circuit_breaker_reopens_after_failed_probe(clock):
+    breaker = admission.CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.record(True)
+    clock.now += 30
+    assert breaker.enter()
+    breaker.record(True)
+    assert breaker.state == "open"
+    clock.now += 29
+    assert breaker.state == "open"
+    clock.now += 1
+    assert breaker.state == "half_open"
+
+
+def test_circuit_breaker_releases_probe_without_answer(clock):
+    breaker = admission.CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.record(True)
+    clock.now += 30
+    assert breaker.enter()
+    breaker.record(None)
+    assert breaker.state == "half_open"
+
+
+@pytest.mark.parametrize(
+    "error, overloaded",
+    [
+        (client_error("SlowDown", 503), True),
+        (client_error("InternalError", 500), True),
+        (client_error("BadGateway", 502), True),
+        (client_error("NoSuchBucket", 404), False),
+        (client_error("AccessDenied", 403), False),
+        (asyncio.TimeoutError(), True),
+        (ValueError(), False),
+    ],
+)
+def test_is_s3_overload(error, overloaded):
+    assert admission.is_s3_overload(error) is overloaded
+
+
+@pytest.mark.parametrize(
+    "error, overloaded",
+    [
+        (ServerDown("ServerDown"), True),
+        (admission.RGWAdminException("SlowDown"), True),
+        (admission.RGWAdminException("AccessDenied"), False),
+        (NoSuchBucket("NoSuchBucket"), False),
+    ],
+)
+def test_is_rgw_overload(error, overloaded):
+    assert admission.is_rgw_overload(error) is overloaded
+
+
+def test_admission_rejects_calls_while_circuit_is_open(clock):
+    backend = admission.Admission(
+        "test",
+        admission.TokenBucket(0, 0),
+        admission.AdaptiveLimit(1, 4, 1),
+        admission.CircuitBreaker(2, 30),
+        admission.is_s3_overload,
+    )
+
+    async def call(error=None):
+        async with backend.slot():
+            if error is not None:
+                raise error
+
+    async def run():
+        # Rejected requests are the caller's fault and keep the circuit closed
+        for _ in range(5):
+            with pytest.raises(ClientError):
+                await call(client_error("NoSuchBucket", 404))
+        assert backend.breaker.state == "closed"
+        for _ in range(2):
+            with pytest.raises(ClientError):
+                await call(client_error("SlowDown", 503))
+        with pytest.raises(admission.CircuitOpenError):
+            await call()
+        clock.now += 30
+        await call()
+        assert backend.breaker.state == "closed"
+        assert backend.limit.in_flight == 0
+
+    asyncio.run(run())
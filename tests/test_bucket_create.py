@@ -0,0 +1,156 @@
+"""
+Retries of the Bucket create handler, with the status stored the way
+the API server stores it for the Bucket CRD
+"""
+import asyncio
+import logging
+
+import kopf
+import pytest
+from aiorgwadmin.exceptions import NoSuchKey
+from botocore.exceptions import ClientError
+
+import s3buckets
+import utils
+
+OWNER = "dev-alice"
+
+
+class FakeRGW:
+    def __init__(self):
+        # Bucket name -> owner
+        self.buckets = {}
+
+    async def get_metadata(self, metadata_type, key):
+        if key not in self.buckets:
+            raise NoSuchKey("NoSuchKey")
+        return {"data": {"owner": self.buckets[key], "bucket": {"bucket_id": f"{key}-id"}}}
+
+    async def link_bucket(self, **_):
+        pass
+
+
+class FlakyS3:
+    """
+    Creates buckets in the fake radosgw and fails the first `failures`
+    versioning calls with `error`
+    """
+
+    def __init__(self, rgw, failures):
+        self.rgw = rgw
+        self.failures = failures
+        self.error = ConnectionError("Connection reset by peer")
+        self.created = 0
+
+    def create_bucket(self, Bucket, **_):
+        self.created += 1
+        self.rgw.buckets[Bucket] = OWNER
+
+    def put_bucket_versioning(self, **_):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    rgw = FakeRGW()
+    s3 = FlakyS3(rgw, failures=1)
+
+    async def get_access_key(index, namespace, name):
+        return {"metadata": {"name": name}, "spec": {"owner": "alice", "secretName": "alice"}}
+
+    async def get_secret(index, namespace, name):
+        return object()
+
+    async def get_user(index, name):
+        return {"metadata": {"name": name, "annotations": {}}, "spec": {"userId": name}}
+
+    async def s3_client(secret):
+        return s3
+
+    monkeypatch.setattr(s3buckets, "get_rgw", lambda: rgw)
+    monkeypatch.setattr(s3buckets, "get_access_key", get_access_key)
+    monkeypatch.setattr(s3buckets, "get_secret", get_secret)
+    monkeypatch.setattr(s3buckets, "get_user", get_user)
+    monkeypatch.setattr(s3buckets, "s3_client", s3_client)
+    yield rgw, s3
+    utils.shutdown_executors()
+
+
+def add_bucket(status, annotations=None):
+    """
+    Runs one attempt of the handler and returns its patch and the
+    TemporaryError it was retried for, if any
+    """
+    patch = kopf.Patch()
+    spec = {
+        "bucketName": "data",
+        "ownerAccessKey": "alice",
+        "bucketPolicy": "private",
+        "objectVersioning": True,
+    }
+    meta = {"name": "data", "namespace": "test", "creationTimestamp": utils.utc_now()}
+    try:
+        asyncio.run(
+            s3buckets.add_bucket(
+                spec=spec,
+                meta=meta,
+                status=status,
+                patch=patch,
+                annotations=annotations or {},
+                logger=logging.getLogger("test"),
+                users_by_name={},
+                access_keys_by_name={},
+                secrets_by_name={},
+            )
+        )
+    except kopf.TemporaryError as e:
+        return patch, e
+    return patch, None
+
+
+def test_retry_resumes_bucket_created_by_failed_attempt(backends, store_status):
+    rgw, s3 = backends
+    first, error = add_bucket({})
+    assert error is not None
+    assert rgw.buckets == {"data": OWNER}
+
+    # kopf persists the patch of the failed attempt
+    status = store_status("s3bucket.yml", {}, first["status"])
+    assert status.get("created") is True
+
+    second, error = add_bucket(status)
+    assert error is None
+    assert second["status"]["ready"] is True
+    assert s3.created == 1
+
+
+def test_existing_bucket_is_not_imported_without_annotation(backends):
+    rgw, s3 = backends
+    rgw.buckets["data"] = OWNER
+    with pytest.raises(kopf.PermanentError, match="don't allow import"):
+        add_bucket({})
+    assert s3.created == 0
+
+
+def client_error(code, status):
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "PutBucketVersioning",
+    )
+
+
+def test_throttled_settings_are_retried(backends):
+    rgw, s3 = backends
+    s3.error = client_error("SlowDown", 503)
+    _, error = add_bucket({})
+    assert error is not None
+    assert not isinstance(error, kopf.PermanentError)
+
+
+def test_rejected_settings_fail_permanently(backends):
+    rgw, s3 = backends
+    s3.error = client_error("InvalidArgument", 400)
+    with pytest.raises(kopf.PermanentError, match="InvalidArgument"):
+        add_bucket({})
@@ -0,0 +1,98 @@
+"""
+Paging and checkpoints of the bucket import
+"""
+import argparse
+import asyncio
+
+import pytest
+from aiorgwadmin.exceptions import NoSuchBucket
+
+import bulkimport
+import utils
+
+OWNERS = {
+    "alpha": "dev-alice",
+    "beta": "dev-bob",
+    "gamma": "dev-alice",
+    "Invalid_Name": "dev-alice",
+    "delta": "other",
+    "gone": "dev-alice",
+}
+
+
+class PagedRGW:
+    def __init__(self):
+        self.calls = []
+
+    async def get_metadata(self, section, max_entries, marker=None):
+        assert section == "bucket"
+        keys = sorted(k for k in OWNERS if k > (marker or ""))
+        page = keys[:max_entries]
+        self.calls.append(("page", marker))
+        truncated = len(page) < len(keys)
+        return {"keys": page, "truncated": truncated, "marker": page[-1] if page else ""}
+
+    async def get_bucket(self, bucket=None, stats=False):
+        assert bucket is not None, "buckets must not be listed as a whole"
+        self.calls.append(("bucket", bucket))
+        if bucket == "gone":
+            raise NoSuchBucket("NoSuchBucket")
+        return {"bucket": bucket, "owner": OWNERS[bucket], "bucket_quota": None}
+
+
+@pytest.fixture
+def rgw(monkeypatch):
+    rgw = PagedRGW()
+    monkeypatch.setattr(bulkimport, "get_rgw", lambda: rgw)
+    monkeypatch.setattr(bulkimport, "list_access_keys", lambda: {"alice": ("test", "alice")})
+    yield rgw
+    utils.shutdown_executors()
+
+
+def import_buckets(checkpoint, batch_size=2):
+    args = argparse.Namespace(
+        batch_size=batch_size, concurrency=4, include_unprefixed=False, dry_run=True
+    )
+    importer = bulkimport.Importer(args, checkpoint)
+    asyncio.run(bulkimport.import_buckets(importer))
+
+
+def test_buckets_are_paged_and_counted(rgw):
+    checkpoint = bulkimport.Checkpoint(None)
+    checkpoint.save(phase="buckets")
+    import_buckets(checkpoint)
+    assert [c for c in rgw.calls if c[0] == "page"] == [
+        ("page", None),
+        ("page", "alpha"),
+        ("page", "delta"),
+    ]
+    assert ("bucket", "Invalid_Name") not in rgw.calls
+    assert checkpoint.state["phase"] == "done"
+    assert checkpoint.state["marker"] is None
+    assert checkpoint.state["counts"] == {"buckets": {"planned": 2, "ignored": 3}}
+
+
+def test_import_resumes_after_checkpointed_marker(rgw, tmp_path):
+    path = str(tmp_path / "import.json")
+
+    class Interrupted(Exception):
+        pass
+
+    def save(checkpoint, **changes):
+        bulkimport.Checkpoint.save(checkpoint, **changes)
+        if changes.get("marker") == "delta":
+            raise Interrupted
+
+    checkpoint = bulkimport.Checkpoint(path)
+    checkpoint.save(phase="buckets")
+    checkpoint.save = lambda **changes: save(checkpoint, **changes)
+    with pytest.raises(Interrupted):
+        import_buckets(checkpoint)
+
+    rgw.calls.clear()
+    resumed = bulkimport.Checkpoint(path)
+    assert resumed.state["marker"] == "delta"
+    import_buckets(resumed)
+    assert rgw.calls[0] == ("page", "delta")
+    assert {name for kind, name in rgw.calls if kind == "bucket"} == {"gamma", "gone"}
+    assert resumed.state["phase"] == "done"
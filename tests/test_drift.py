@@ -0,0 +1,182 @@
+"""
+Drift detection between radosgw and the cached resources
+"""
+import asyncio
+
+import pytest
+
+import drift
+
+QUOTAS = {"enabled": True, "maxSize": 1024, "maxObjects": 100}
+QUOTA = {"enabled": True, "max_size_kb": 1024, "max_objects": 100}
+
+
+def user(name, quotas=None):
+    spec = {"userId": name}
+    if quotas:
+        spec["quotas"] = quotas
+    return {"metadata": {"name": name, "annotations": {}}, "spec": spec}
+
+
+def access_key(owner, access_key_id, previous=None):
+    status = {"accessKeyId": access_key_id}
+    if previous:
+        status["rotation"] = {"phase": "Overlap", "previousAccessKeyId": previous}
+    return {"spec": {"owner": owner}, "status": status}
+
+
+def bucket(access_key_name, quotas=None):
+    return {
+        "ref": {"metadata": {"name": access_key_name}},
+        "accessKey": ("test", access_key_name),
+        "quotas": quotas or {},
+    }
+
+
+def findings(**changes):
+    arguments = {
+        "rgw_users": {"dev-alice"},
+        "rgw_user_info": {"dev-alice": {"keys": [{"access_key": "AK1"}], "max_buckets": 1000}},
+        "rgw_buckets": {"data"},
+        "rgw_bucket_info": {"data": {"owner": "dev-alice", "bucket_quota": QUOTA}},
+        "users": {"alice": user("alice")},
+        "access_keys": {("test", "alice"): access_key("alice", "AK1")},
+        "access_key_refs": {("test", "alice"): access_key("alice", "AK1")},
+        "buckets": {"data": bucket("alice", QUOTAS)},
+    }
+    arguments.update(changes)
+    return {(f.kind, f.type, f.name) for f in drift.detect_drift(**arguments)}
+
+
+def test_no_drift():
+    assert findings() == set()
+
+
+def test_missing_and_orphaned_users():
+    assert findings(
+        rgw_users={"dev-alice", "dev-ghost", "other"},
+        users={"alice": user("alice"), "bob": user("bob")},
+    ) == {("user", "missing", "dev-bob"), ("user", "orphaned", "dev-ghost")}
+
+
+def test_user_quota_mismatch():
+    info = {"keys": [{"access_key": "AK1"}], "user_quota": {"enabled": False}}
+    assert findings(
+        rgw_user_info={"dev-alice": info}, users={"alice": user("alice", QUOTAS)}
+    ) == {("user", "quota_mismatch", "dev-alice")}
+    info = {"keys": [{"access_key": "AK1"}], "user_quota": QUOTA, "max_buckets": 10}
+    assert findings(
+        rgw_user_info={"dev-alice": info},
+        users={"alice": user("alice", {**QUOTAS, "maxBuckets": 20})},
+    ) == {("user", "quota_mismatch", "dev-alice")}
+
+
+def test_missing_and_orphaned_keys():
+    info = {"keys": [{"access_key": "AK1"}, {"access_key": "OLD"}, {"access_key": "STRAY"}]}
+    keys = {
+        ("test", "alice"): access_key("alice", "AK1", previous="OLD"),
+        ("test", "gone"): access_key("alice", "GONE"),
+    }
+    assert findings(rgw_user_info={"dev-alice": info}, access_keys=keys) == {
+        ("key", "missing", "GONE"),
+        ("key", "orphaned", "STRAY"),
+    }
+
+
+def test_keys_of_users_without_info_are_not_compared():
+    keys = {("test", "gone"): access_key("alice", "GONE")}
+    assert findings(rgw_user_info={}, access_keys=keys) == set()
+
+
+def test_bucket_drift():
+    assert findings(
+        rgw_buckets={"data", "stray", "foreign", "unfetched"},
+        rgw_bucket_info={
+            "data": {"owner": "dev-bob", "bucket_quota": {"enabled": True, "max_size_kb": 1}},
+            "stray": {"owner": "dev-carol", "bucket_quota": None},
+            "foreign": {"owner": "other", "bucket_quota": None},
+        },
+        buckets={"data": bucket("alice", QUOTAS), "lost": bucket("alice")},
+    ) == {
+        ("bucket", "owner_mismatch", "data"),
+        ("bucket", "quota_mismatch", "data"),
+        ("bucket", "orphaned", "stray"),
+        ("bucket", "missing", "lost"),
+    }
+
+
+@pytest.mark.parametrize(
+    "cursor, size, batch",
+    [
+        ("", 2, ["a", "b"]),
+        ("b", 2, ["c", "d"]),
+        ("c", 2, ["d", "a"]),
+        ("d", 10, ["a", "b", "c", "d"]),
+    ],
+)
+def test_next_batch_wraps_around(cursor, size, batch):
+    assert drift.next_batch({"d", "b", "a", "c"}, cursor, size) == batch
+
+
+class PagedRGW:
+    """
+    Only answers paged metadata listings and single lookups
+    """
+
+    def __init__(self, users, buckets):
+        self.users = users
+        self.buckets = buckets
+        self.calls = []
+
+    async def get_metadata(self, section, max_entries, marker=None):
+        listed = self.users if section == "user" else self.buckets
+        keys = sorted(k for k in listed if k > (marker or ""))
+        page = keys[:max_entries]
+        self.calls.append(section)
+        truncated = len(page) < len(keys)
+        return {"keys": page, "truncated": truncated, "marker": page[-1] if page else ""}
+
+    async def get_user(self, uid):
+        self.calls.append(uid)
+        return {"keys": [], "user_quota": None, "max_buckets": 1000}
+
+    async def get_bucket(self, bucket):
+        self.calls.append(bucket)
+        return {"owner": self.buckets[bucket], "bucket_quota": None, "usage": {}}
+
+
+def test_pass_pages_buckets_and_refreshes_them_in_batches(monkeypatch):
+    rgw = PagedRGW({"dev-alice"}, {f"bucket-{i}": "dev-alice" for i in range(5)})
+    monkeypatch.setattr(drift, "get_rgw", lambda: rgw)
+    monkeypatch.setattr(drift, "publish_drift", lambda findings: None)
+    monkeypatch.setattr(drift, "drift_page_size", 2)
+    monkeypatch.setattr(drift, "drift_bucket_batch", 3)
+    monkeypatch.setattr(drift, "_bucket_info", {})
+    monkeypatch.setattr(drift, "_bucket_cursor", "")
+    monkeypatch.setattr(drift, "_user_info", {})
+    monkeypatch.setattr(drift, "_user_cursor", "")
+
+    def run_pass():
+        rgw.calls.clear()
+        return asyncio.run(
+            drift.detect_drift_pass(
+                users_by_name={},
+                users_by_rgw_id={},
+                access_keys_by_name={},
+                access_keys_for_rotation={},
+                buckets_for_drift={},
+            )
+        )
+
+    def refreshed():
+        return sorted(call for call in rgw.calls if call.startswith("bucket-"))
+
+    found = run_pass()
+    # Three pages of two buckets
+    assert rgw.calls.count("bucket") == 3
+    assert refreshed() == ["bucket-0", "bucket-1", "bucket-2"]
+    assert {f.name for f in found} == {"dev-alice", "bucket-0", "bucket-1", "bucket-2"}
+
+    found = run_pass()
+    assert refreshed() == ["bucket-0", "bucket-3", "bucket-4"]
+    assert {f.name for f in found} == {"dev-alice"} | set(rgw.buckets)
@@ -0,0 +1,162 @@
+"""
+Regression test for blocking pykube and boto3 calls on the event loop.
+
+200 bucket reconciles run concurrently against a slow radosgw stub, with
+Kubernetes and S3 stubs that block their calling thread like the real
+clients do. As long as these calls go through run_blocking, the event
+loop stays responsive.
+"""
+import asyncio
+import time
+import types
+
+import pytest
+from aiorgwadmin.exceptions import NoSuchKey
+
+import cache
+import s3buckets
+import s3clients
+import utils
+
+RECONCILES = 200
+RGW_LATENCY = 0.05
+BLOCKING_LATENCY = 0.01
+MAX_LOOP_LAG = 0.25
+
+
+class SlowRGW:
+    """
+    Stands in for the shared RGWAdmin client, every call awaits the latency
+    """
+
+    async def get_metadata(self, metadata_type, key):
+        await asyncio.sleep(RGW_LATENCY)
+        raise NoSuchKey("NoSuchKey")
+
+    async def set_bucket_quota(self, **_):
+        await asyncio.sleep(RGW_LATENCY)
+
+
+class BlockingS3:
+    def create_bucket(self, **_):
+        time.sleep(BLOCKING_LATENCY)
+
+    def put_bucket_versioning(self, **_):
+        time.sleep(BLOCKING_LATENCY)
+
+
+def create_client(endpoint, access_key_id, secret_access_key):
+    time.sleep(BLOCKING_LATENCY)
+    return BlockingS3()
+
+
+class BlockingSecrets:
+    """
+    Stands in for the pykube query of Secrets
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def get_by_name(self, name):
+        time.sleep(BLOCKING_LATENCY)
+        secret = cache.Secret.new(None, name, self.namespace)
+        secret.set_secret("aws_access_key_id", f"key-{name}")
+        secret.set_secret("aws_secret_access_key", "secret")
+        secret.obj["metadata"]["resourceVersion"] = "1"
+        return secret
+
+
+@pytest.fixture
+def stubs(monkeypatch):
+    monkeypatch.setattr(s3buckets, "get_rgw", SlowRGW)
+    monkeypatch.setattr(s3clients, "_create_client", create_client)
+    monkeypatch.setattr(cache, "get_kube_api", lambda: None)
+    monkeypatch.setattr(
+        cache.Secret, "objects", classmethod(lambda cls, api, namespace: BlockingSecrets(namespace))
+    )
+    monkeypatch.setattr(s3clients, "_clients", s3clients.OrderedDict())
+    monkeypatch.setattr(cache, "_secrets", cache.OrderedDict())
+    yield
+    utils.shutdown_executors()
+
+
+def indexes():
+    users, access_keys, secrets = {}, {}, {}
+    for i in range(RECONCILES):
+        users[f"user-{i}"] = [
+            {"metadata": {"name": f"user-{i}", "annotations": {}}, "spec": {"userId": f"user-{i}"}}
+        ]
+        access_keys[("test", f"key-{i}")] = [
+            {"metadata": {"name": f"key-{i}"}, "spec": {"owner": f"user-{i}", "secretName": f"secret-{i}"}}
+        ]
+        secrets[("test", f"secret-{i}")] = ["1"]
+    return users, access_keys, secrets
+
+
+def bucket(i):
+    return {
+        "spec": {
+            "bucketName": f"bucket-{i}",
+            "ownerAccessKey": f"key-{i}",
+            "bucketPolicy": "private",
+            "objectVersioning": True,
+        },
+        "meta": {"name": f"bucket-{i}", "namespace": "test", "creationTimestamp": utils.utc_now()},
+    }
+
+
+async def reconcile_all() -> float:
+    """
+    Reconciles all buckets concurrently and returns the maximum lag of a
+    timer on the event loop meanwhile
+    """
+    users, access_keys, secrets = indexes()
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def monitor():
+        nonlocal lag
+        while not done.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(0.005)
+            lag = max(lag, time.monotonic() - started - 0.005)
+
+    async def reconcile(i):
+        resource = bucket(i)
+        patch = types.SimpleNamespace(status={})
+        await s3buckets.add_bucket(
+            spec=resource["spec"],
+            meta=resource["meta"],
+            status={},
+            patch=patch,
+            annotations={},
+            logger=None,
+            users_by_name=users,
+            access_keys_by_name=access_keys,
+            secrets_by_name=secrets,
+            name=resource["meta"]["name"],
+            namespace="test",
+        )
+        assert patch.status["ready"]
+
+    watcher = asyncio.create_task(monitor())
+    try:
+        await asyncio.gather(*(reconcile(i) for i in range(RECONCILES)))
+    finally:
+        done.set()
+        await watcher
+    return lag
+
+
+def test_blocking_calls_keep_loop_responsive(stubs):
+    assert asyncio.run(reconcile_all()) < MAX_LOOP_LAG
+
+
+def test_blocking_calls_on_loop_are_detected(stubs, monkeypatch):
+    async def run_inline(backend, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    for module in (cache, s3buckets, s3clients):
+        monkeypatch.setattr(module, "run_blocking", run_inline)
+    assert asyncio.run(reconcile_all()) >= MAX_LOOP_LAG
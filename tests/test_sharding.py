@@ -0,0 +1,181 @@
+"""
+Consistent hash ring of the replicas and the handoff of shard leases
+"""
+import asyncio
+import types
+
+import pytest
+
+import sharding
+import utils
+
+
+def test_ring_is_stable_for_existing_shards_when_shards_are_added(monkeypatch):
+    ring = sharding.ShardRing(["a", "b", "c"])
+    owners = [ring.owner(shard) for shard in range(32)]
+    monkeypatch.setattr(sharding, "shard_count", 64)
+    assert [ring.owner(shard) for shard in range(32)] == owners
+
+
+def test_ring_spreads_shards_over_members():
+    ring = sharding.ShardRing(["a", "b", "c", "d"])
+    assert {ring.owner(shard) for shard in range(256)} == {"a", "b", "c", "d"}
+    assert sharding.ShardRing([]).owner(0) is None
+
+
+def test_joining_member_only_takes_shards_for_itself():
+    before = sharding.ShardRing(["a", "b", "c", "d"])
+    after = sharding.ShardRing(["a", "b", "c", "d", "e"])
+    moved = [shard for shard in range(256) if before.owner(shard) != after.owner(shard)]
+    assert moved
+    assert {after.owner(shard) for shard in moved} == {"e"}
+    # Roughly its fair share of the shards
+    assert len(moved) < 256 / 5 * 2
+
+
+def test_leaving_member_only_gives_up_its_shards():
+    before = sharding.ShardRing(["a", "b", "c", "d"])
+    after = sharding.ShardRing(["a", "b", "d"])
+    moved = {shard for shard in range(256) if before.owner(shard) != after.owner(shard)}
+    assert moved == {shard for shard in range(256) if before.owner(shard) == "c"}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class Leases:
+    """
+    Lease objects by name, standing in for the Kubernetes API
+    """
+
+    def __init__(self):
+        self.leases = {}
+        self.version = 0
+
+    def list(self, role):
+        return [
+            lease
+            for lease in self.leases.values()
+            if lease["metadata"]["labels"][sharding.LEASE_LABEL] == role
+        ]
+
+    def write(self, name, role, current, spec):
+        self.version += 1
+        self.leases[name] = {
+            "metadata": {
+                "name": name,
+                "labels": {sharding.LEASE_LABEL: role},
+                "resourceVersion": str(self.version),
+            },
+            "spec": spec,
+        }
+
+    def holder(self, shard):
+        return self.leases[f"{sharding.SHARD_PREFIX}{shard}"]["spec"]["holderIdentity"]
+
+
+@pytest.fixture
+def leases(monkeypatch):
+    clock = Clock()
+    leases = Leases()
+    monkeypatch.setattr(sharding, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(sharding, "sharding_enabled", True)
+    monkeypatch.setattr(sharding, "shard_count", 8)
+    monkeypatch.setattr(sharding, "shard_identity", "me")
+    monkeypatch.setattr(sharding, "_held", set())
+    monkeypatch.setattr(sharding, "_accepting", set())
+    monkeypatch.setattr(sharding, "_renewed", 0.0)
+    monkeypatch.setattr(sharding, "_running", sharding.Counter())
+    monkeypatch.setattr(sharding, "_finished", {})
+    monkeypatch.setattr(sharding, "_list_leases", leases.list)
+    monkeypatch.setattr(sharding, "_write_lease", leases.write)
+    leases.clock = clock
+    yield leases
+    utils.shutdown_executors()
+
+
+def balance():
+    return asyncio.run(sharding.balance_shards())
+
+
+def name_in(shard, exclude=()):
+    return next(
+        name
+        for name in (f"bucket-{i}" for i in range(10000))
+        if sharding.shard_of("test", name) == shard and name not in exclude
+    )
+
+
+def join(leases, member):
+    sharding._write_lease(
+        f"rgwoperator-member-{member}",
+        "member",
+        None,
+        sharding._lease_spec(member, sharding.datetime.now(sharding.timezone.utc)),
+    )
+
+
+def test_single_replica_acquires_all_shards(leases):
+    assert balance() == set(range(8))
+    assert all(leases.holder(shard) == "me" for shard in range(8))
+    assert all(sharding.owns_shard(shard) for shard in range(8))
+    assert sharding.is_owned("test", "anything")
+
+
+def test_ownership_lapses_without_renewal(leases):
+    balance()
+    leases.clock.now += sharding.shard_lease_seconds - sharding.shard_renew_interval
+    assert not sharding.owns_shard(0)
+    assert not sharding.is_owned("test", "anything")
+
+
+def test_handoff_drains_busy_shard_before_release(leases):
+    balance()
+    join(leases, "other")
+    ring = sharding.ShardRing(["me", "other"])
+    moved = [shard for shard in range(8) if ring.owner(shard) == "other"]
+    busy, idle = moved[0], moved[1:]
+    assert idle
+    running = name_in(busy)
+    waiting = name_in(busy, exclude={running})
+
+    with sharding.handling("test", running):
+        assert balance() == set()
+        # The busy shard stops accepting but stays held
+        assert leases.holder(busy) == "me"
+        assert not sharding.owns_shard(busy)
+        assert not sharding.is_owned("test", running)
+        # Only the outcome of the running handler may still be written
+        assert sharding.may_persist({"metadata": {"namespace": "test", "name": running}})
+        assert not sharding.may_persist({"metadata": {"namespace": "test", "name": waiting}})
+        assert all(leases.holder(shard) is None for shard in idle)
+        assert all(not sharding.owns_shard(shard) for shard in idle)
+        assert all(sharding.owns_shard(shard) for shard in range(8) if shard not in moved)
+
+    # Finished handlers are still being patched for the grace period
+    leases.clock.now += sharding.shard_release_grace / 2
+    balance()
+    assert leases.holder(busy) == "me"
+    assert sharding.may_persist({"metadata": {"namespace": "test", "name": running}})
+
+    leases.clock.now += sharding.shard_release_grace
+    balance()
+    assert leases.holder(busy) is None
+    assert busy not in sharding._held
+    assert not sharding.may_persist({"metadata": {"namespace": "test", "name": running}})
+
+
+def test_released_shard_is_not_reacquired_while_other_is_alive(leases):
+    balance()
+    join(leases, "other")
+    balance()
+    ring = sharding.ShardRing(["me", "other"])
+    released = [shard for shard in range(8) if ring.owner(shard) == "other"]
+    # The other replica did not take them yet, this replica leaves them alone
+    assert balance() == set()
+    assert all(leases.holder(shard) is None for shard in released)
@@ -0,0 +1,216 @@
+"""
+Adaptive polling intervals, the request budget, the choice between one
+bucket listing and per-bucket calls, and the suppression of insignificant
+status patches, on a fake clock
+"""
+import asyncio
+import types
+
+import pytest
+
+import exporter
+import s3buckets
+import stats
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(stats, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(stats, "stats_max_interval", 480)
+    return clock
+
+
+def test_interval_doubles_while_unchanged_up_to_max(clock):
+    schedule = stats.AdaptiveSchedule("test", 60)
+    intervals = []
+    for _ in range(7):
+        assert schedule.due(["a"]) == ["a"]
+        schedule.observe("a", {"size": 1})
+        due_at = clock.now
+        while schedule.due(["a"]) == []:
+            clock.now += 60
+        intervals.append(clock.now - due_at)
+    assert intervals == [60, 120, 240, 480, 480, 480, 480]
+
+
+@pytest.mark.parametrize(
+    "sample, near_quota",
+    [({"size": 2}, False), ({"size": 1}, True)],
+)
+def test_interval_drops_to_minimum_on_change_or_near_quota(clock, sample, near_quota):
+    schedule = stats.AdaptiveSchedule("test", 60)
+    for _ in range(4):
+        schedule.observe("a", {"size": 1})
+    clock.now += 240
+    assert schedule.due(["a"]) == []
+
+    schedule.observe("a", sample, near_quota)
+    clock.now += 59
+    assert schedule.due(["a"]) == []
+    clock.now += 1
+    assert schedule.due(["a"]) == ["a"]
+
+
+def test_due_returns_most_overdue_first_up_to_limit(clock):
+    schedule = stats.AdaptiveSchedule("test", 60)
+    schedule.seed("late", {}, 10)
+    schedule.seed("later", {}, 20)
+    schedule.observe("polled", {})
+    clock.now += 30
+    assert schedule.count_due(["new", "late", "later", "polled"]) == 3
+    assert schedule.due(["later", "late", "new", "polled"], limit=2) == ["new", "late"]
+
+
+def test_budget_grants_up_to_the_rate_per_minute(clock):
+    budget = stats.RequestBudget(10)
+    assert budget.take(4) == 4
+    assert budget.available() == 6
+    assert budget.take(8) == 6
+    assert budget.take(1) == 0
+    clock.now += 59
+    assert budget.available() == 0
+    clock.now += 1
+    assert budget.available() == 10
+
+
+class StatsRGW:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.calls = []
+
+    async def get_bucket(self, bucket=None, stats=False):
+        self.calls.append(bucket)
+        usage = {"rgw.main": {"size_kb": 1, "num_objects": 1}}
+        listing = [{"bucket": name, "owner": "dev-alice", "usage": usage} for name in self.buckets]
+        if bucket is None:
+            return listing
+        return next(b for b in listing if b["bucket"] == bucket)
+
+
+@pytest.fixture
+def bucket_stats(monkeypatch, clock):
+    async def publish_bucket_stats(namespace, name, status):
+        pass
+
+    monkeypatch.setattr(s3buckets, "bucket_stats_listing_min", 10)
+    monkeypatch.setattr(s3buckets, "bucket_stats_schedule", stats.AdaptiveSchedule("buckets", 60))
+    monkeypatch.setattr(s3buckets, "stats_budget", stats.RequestBudget(5))
+    monkeypatch.setattr(s3buckets, "publish_bucket_stats", publish_bucket_stats)
+
+    def collect(count):
+        rgw = StatsRGW([f"bucket-{i}" for i in range(count)])
+        monkeypatch.setattr(s3buckets, "get_rgw", lambda: rgw)
+        index = {name: [("test", name)] for name in rgw.buckets}
+        asyncio.run(s3buckets.collect_bucket_stats(index))
+        return rgw.calls
+
+    return collect
+
+
+def test_few_due_buckets_are_fetched_within_budget(bucket_stats):
+    calls = bucket_stats(8)
+    assert len(calls) == 5
+    assert None not in calls
+    assert s3buckets.stats_budget.available() == 0
+
+
+def test_many_due_buckets_are_listed_once_despite_low_budget(bucket_stats):
+    assert bucket_stats(50) == [None]
+    assert s3buckets.stats_budget.available() == 4
+
+
+def test_no_listing_without_budget(bucket_stats):
+    s3buckets.stats_budget.take(5)
+    assert bucket_stats(50) == []
+
+
+@pytest.mark.parametrize("count", [8, 50])
+@pytest.mark.parametrize("enabled", [False, True])
+def test_snapshot_is_only_recorded_for_the_exporter(bucket_stats, monkeypatch, count, enabled):
+    monkeypatch.setattr(exporter, "stats_exporter", enabled)
+    snapshot = exporter.StatsSnapshot("bucket")
+    monkeypatch.setattr(s3buckets, "bucket_snapshot", snapshot)
+    calls = bucket_stats(count)
+    recorded = len(calls) if None not in calls else count
+    assert len(snapshot.values()) == (recorded if enabled else 0)
+
+
+@pytest.mark.parametrize(
+    "old, new, absolute, relative, significant",
+    [
+        (None, 0, 0, 0, True),
+        (None, 5, 100, 0.5, True),
+        (5, None, 100, 0.5, True),
+        ("Enabled", "Suspended", 100, 0.5, True),
+        (5, 5, 0, 0, False),
+        # Absolute threshold only
+        (1000, 1001, 0, 0, True),
+        (1000, 1050, 100, 0, False),
+        (1000, 1100, 100, 0, False),
+        (1000, 1101, 100, 0, True),
+        (1000, 899, 100, 0, True),
+        # Relative threshold, above the absolute one
+        (1000, 1050, 1000, 0.1, False),
+        (1000, 1101, 1000, 0.1, True),
+        (1000, 899, 1000, 0.1, True),
+        # Zero baselines: any change is relatively significant
+        (0, 5, 10, 0, False),
+        (0, 5, 10, 0.1, True),
+        (0, 0, 10, 0.1, False),
+    ],
+)
+def test_is_significant(monkeypatch, old, new, absolute, relative, significant):
+    monkeypatch.setattr(stats, "stats_absolute_threshold", absolute)
+    monkeypatch.setattr(stats, "stats_relative_threshold", relative)
+    assert stats.is_significant(old, new) is significant
+
+
+@pytest.fixture
+def status_filter(monkeypatch, clock):
+    monkeypatch.setattr(stats, "stats_absolute_threshold", 100)
+    monkeypatch.setattr(stats, "stats_relative_threshold", 0)
+    monkeypatch.setattr(stats, "stats_max_staleness", 900)
+    monkeypatch.setattr(stats, "stats_status_min_interval", 0)
+    status_filter = stats.StatusFilter("test")
+    assert status_filter.should_publish("a", {"size": 1000})
+    status_filter.published("a", {"size": 1000})
+    return status_filter
+
+
+def test_status_filter_suppresses_insignificant_changes(status_filter, clock):
+    assert not status_filter.should_publish("a", {"size": 1050})
+    assert status_filter.should_publish("a", {"size": 1200})
+    assert status_filter.should_publish("a", {"size": 1000, "objects": 1})
+
+
+def test_status_filter_publishes_stale_status(status_filter, clock):
+    clock.now += 899
+    assert not status_filter.should_publish("a", {"size": 1050})
+    clock.now += 1
+    assert status_filter.should_publish("a", {"size": 1050})
+
+
+def test_status_filter_limits_patch_rate(status_filter, clock, monkeypatch):
+    monkeypatch.setattr(stats, "stats_status_min_interval", 60)
+    assert not status_filter.should_publish("a", {"size": 5000})
+    clock.now += 60
+    assert status_filter.should_publish("a", {"size": 5000})
+
+
+def test_status_filter_forgets_removed_resources(status_filter):
+    status_filter.retain([])
+    assert status_filter.should_publish("a", {"size": 1000})
+
+
+def test_status_filter_without_mirror(status_filter, monkeypatch):
+    monkeypatch.setattr(stats, "stats_status_mirror", False)
+    assert not status_filter.should_publish("b", {"size": 1})
@@ -0,0 +1,115 @@
+"""
+Spec checks of the validating webhook
+"""
+import json
+
+import kopf
+import pytest
+
+import validation
+
+POLICY = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Principal": "*",
+            "Action": ["s3:GetObject"],
+            "Resource": ["arn:aws:s3:::data/*"],
+        }
+    ],
+}
+LIFECYCLE = {"Rules": [{"ID": "expire", "Status": "Enabled", "Expiration": {"Days": 30}}]}
+OBJECT_LOCK = {
+    "ObjectLockEnabled": "Enabled",
+    "Rule": {"DefaultRetention": {"Mode": "GOVERNANCE", "Days": 7}},
+}
+
+
+def bucket(**fields):
+    spec = {"bucketName": "data", "ownerAccessKey": "alice", "bucketPolicy": "private"}
+    spec.update({k: json.dumps(v) if isinstance(v, dict) else v for k, v in fields.items()})
+    return spec
+
+
+@pytest.mark.parametrize(
+    "spec, old_spec, error",
+    [
+        (bucket(), None, None),
+        (bucket(bucketPolicy="custom", customBucketPolicy=POLICY), None, None),
+        (bucket(lifeCyclePolicy=LIFECYCLE), None, None),
+        (bucket(objectLock=True, objectLockConfig=OBJECT_LOCK), None, None),
+        # Ignored like the handlers ignore them
+        (bucket(customBucketPolicy="{"), None, None),
+        (bucket(objectLockConfig="{"), None, None),
+        (
+            bucket(bucketPolicy="custom", customBucketPolicy="{"),
+            None,
+            "Failed to parse customBucketPolicy: Expecting property name enclosed in double quotes: "
+            "line 1 column 2 (char 1)",
+        ),
+        (
+            bucket(bucketPolicy="custom", customBucketPolicy={"Statement": []}),
+            None,
+            "Invalid customBucketPolicy: Statement must be a non-empty list",
+        ),
+        (
+            bucket(
+                bucketPolicy="custom",
+                customBucketPolicy={"Statement": [{**POLICY["Statement"][0], "Effect": "Maybe"}]},
+            ),
+            None,
+            "Invalid customBucketPolicy: Effect of statement 0 must be Allow or Deny",
+        ),
+        (
+            bucket(lifeCyclePolicy={"Rules": [{"Status": "Enabled"}]}),
+            None,
+            "Invalid lifeCyclePolicy: Rule 0 has no action",
+        ),
+        (
+            bucket(
+                objectLock=True,
+                objectLockConfig={"Rule": {"DefaultRetention": {"Mode": "GOVERNANCE"}}},
+            ),
+            None,
+            "Invalid objectLockConfig: DefaultRetention must set either Days or Years to a positive number",
+        ),
+        (bucket(lifeCyclePolicy=LIFECYCLE), bucket(), None),
+        (bucket(bucketName="other"), bucket(), "Cannot change bucket name"),
+        (bucket(ownerAccessKey="bob"), bucket(), "Cannot change owner"),
+        (bucket(objectLock=True), bucket(), "Cannot change object locking post-creation"),
+    ],
+)
+def test_validate_bucket_spec(spec, old_spec, error):
+    assert validation.validate_bucket_spec(spec, old_spec) == error
+
+
+@pytest.mark.parametrize(
+    "spec, error",
+    [
+        ({"owner": "alice", "secretName": "alice"}, None),
+        ({"owner": "alice", "secretName": "alice", "template": {}}, None),
+        (
+            {"template": {"data": {"endpoint": "https://{{ access_key_id }}@rgw"}}},
+            None,
+        ),
+        (
+            {"template": {"data": {"endpoint": "line\n{{ access_key_id "}}},
+            "Invalid template at line 2: unexpected end of template, expected 'end of print statement'.",
+        ),
+    ],
+)
+def test_validate_access_key_spec(spec, error):
+    assert validation.validate_access_key_spec(spec, None) == error
+
+
+def test_admit_rejects_invalid_spec(monkeypatch):
+    monkeypatch.setattr(validation, "_results", validation.OrderedDict())
+    with pytest.raises(kopf.AdmissionError, match="Cannot change owner"):
+        validation.validate_bucket(
+            spec=bucket(ownerAccessKey="bob"), old={"spec": bucket()}, operation="UPDATE"
+        )
+    # Deletions and patches that leave the spec untouched are not validated
+    invalid = bucket(bucketPolicy="custom", customBucketPolicy="{")
+    validation.validate_bucket(spec=invalid, old=None, operation="DELETE")
+    validation.validate_bucket(spec=invalid, old={"spec": invalid}, operation="UPDATE")
@@ -0,0 +1,45 @@
+"""
+Lookups answered from the startup snapshot and the misses counted for it
+"""
+import pytest
+from prometheus_client import REGISTRY
+
+import warmup
+
+
+def missed(kind):
+    return REGISTRY.get_sample_value("rgwoperator_startup_rgw_calls_total", {"kind": kind}) or 0
+
+
+@pytest.fixture
+def snapshot(monkeypatch):
+    snapshot = warmup.StartupSnapshot(
+        {"dev-alice"}, {"data": {"bucket": "data", "id": "data-id", "owner": "dev-alice"}}
+    )
+    monkeypatch.setattr(warmup, "_snapshot", snapshot)
+    monkeypatch.setattr(warmup, "_in_startup", True)
+    monkeypatch.setattr(warmup, "_misses", 0)
+    return snapshot
+
+
+def test_only_misses_are_counted(snapshot):
+    users, buckets = missed("user"), missed("bucket")
+    assert warmup.user_exists("dev-alice")
+    assert warmup.bucket_metadata("data")["data"]["owner"] == "dev-alice"
+    assert (missed("user"), missed("bucket")) == (users, buckets)
+
+    assert not warmup.user_exists("dev-bob")
+    assert warmup.bucket_metadata("other") is None
+    assert (missed("user"), missed("bucket")) == (users + 1, buckets + 1)
+    assert warmup._misses == 2
+
+
+def test_misses_without_snapshot_are_counted_until_startup_ends(snapshot, monkeypatch):
+    users = missed("user")
+    monkeypatch.setattr(warmup, "_snapshot", None)
+    assert not warmup.user_exists("dev-alice")
+    assert missed("user") == users + 1
+
+    monkeypatch.setattr(warmup, "_in_startup", False)
+    assert not warmup.user_exists("dev-alice")
+    assert missed("user") == users + 1